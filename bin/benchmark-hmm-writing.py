@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+""" Check that hmmwriter.dump_hmm() writes yamls that read back the same as yaml.dump()'s, and compare how long each takes per gene """
+import argparse
+import os
+import time
+import StringIO
+import yaml
+import sys
+sys.path.insert(1, './python')
+
+import utils
+import hmmwriter
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--parameter-dir', default='test/regression/parameters/simu/hmm', help='Parameter directory to build the hmms from')
+parser.add_argument('--datadir', default='data/imgt')
+parser.add_argument('--only-genes', help='Colon-separated list of genes to write (default: every gene in the parameter dir\'s gene-probs files)')
+parser.add_argument('--naivety', default='M', choices=['N', 'M'])
+parser.add_argument('--joint-emission', action='store_true')
+parser.add_argument('--min_observations_to_write', type=int, default=20)
+parser.add_argument('--allow_unphysical_insertions', action='store_true')
+parser.add_argument('--no-insertion-base-content', dest='insertion_base_content', action='store_false', help='Assume uniform base content in insertions (partis.py\'s --insertion-base-content is always on)')
+parser.add_argument('--debug', type=int, default=0, choices=[0, 1, 2])
+args = parser.parse_args()
+
+# ----------------------------------------------------------------------------------------
+def same(obj_a, obj_b):
+    """ are <obj_a> and <obj_b> (HMMs as read back from yaml, or anything inside them) equal, including the types of their contents? """
+    if type(obj_a) != type(obj_b):
+        return False
+    if isinstance(obj_a, dict):
+        return sorted(obj_a) == sorted(obj_b) and all([same(obj_a[key], obj_b[key]) for key in obj_a])
+    elif isinstance(obj_a, list):
+        return len(obj_a) == len(obj_b) and all([same(val_a, val_b) for val_a, val_b in zip(obj_a, obj_b)])
+    elif hasattr(obj_a, '__dict__'):
+        return same(vars(obj_a), vars(obj_b))
+    else:
+        return repr(obj_a) == repr(obj_b)  # repr so e.g. floats have to match exactly
+
+germline_seqs = utils.read_germlines(args.datadir)
+if args.only_genes is not None:
+    genes = utils.get_arg_list(args.only_genes)
+else:
+    genes = [line[region + '_gene'] for region in utils.regions for line in utils.read_parameter_csv(args.parameter_dir + '/' + region + '_gene-probs.csv')]
+    genes = sorted(set([gene for gene in genes if gene in germline_seqs[utils.get_region(gene)]]))
+
+utils.load_parameter_tables(args.parameter_dir)
+writers = []
+with open(os.devnull, 'w') as devnull:  # don't need all the warnings about genes we didn't see much
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        for gene in genes:
+            writer = hmmwriter.HmmWriter(args.parameter_dir, None, gene, args.naivety, germline_seqs[utils.get_region(gene)][gene], args)
+            writer.add_states()
+            writers.append(writer)
+    finally:
+        sys.stdout = stdout
+utils.clear_parameter_tables()
+
+dumpers = [('yaml.dump', lambda hmm, outfile: yaml.dump(hmm, outfile, width=150)),
+           ('dump_hmm', hmmwriter.dump_hmm)]
+if hasattr(yaml, 'CDumper'):  # only if pyyaml was built with libyaml
+    dumpers.insert(1, ('yaml CDumper', lambda hmm, outfile: yaml.dump(hmm, outfile, width=150, Dumper=yaml.CDumper)))
+
+print '%d genes from %s' % (len(writers), args.parameter_dir)
+outputs = {}
+for name, dumper in dumpers:
+    outputs[name] = []
+    start = time.time()
+    for writer in writers:
+        outfile = StringIO.StringIO()
+        dumper(writer.hmm, outfile)
+        outputs[name].append(outfile.getvalue())
+    print '  %15s %8.2f ms/gene' % (name, 1000. * (time.time() - start) / max(1, len(writers)))
+
+n_different = 0
+for iwriter in range(len(writers)):
+    reference = yaml.load(outputs['yaml.dump'][iwriter], Loader=yaml.Loader)
+    if not same(reference, yaml.load(outputs['dump_hmm'][iwriter], Loader=yaml.Loader)):
+        print '  ERROR dump_hmm output for %s reads back differently to yaml.dump\'s' % writers[iwriter].hmm.name
+        n_different += 1
+if n_different > 0:
+    raise Exception('ERROR %d of %d hmms didn\'t round trip' % (n_different, len(writers)))
+print '  all %d hmms read back the same' % len(writers)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+""" Compare the speed and quality of the preclustering distance backends (see --precluster-distance) on a simulation file """
+import argparse
+import os
+import csv
+import json
+import time
+import itertools
+import sys
+sys.path.insert(1, './python')
+
+import utils
+from seqfileopener import get_seqfile_info
+from clusterer import Clusterer
+from hammer import Hammer
+from kmerdistance import KmerDistance
+from cdr3hammer import Cdr3Hammer
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-b', action='store_true')  # passed on to ROOT when plotting
+parser.add_argument('--seqfile', default='test/simu.csv', help='Simulation file (we need the true rearrangements to tell how good the preclusters are)')
+parser.add_argument('--datadir', default='data/imgt')
+parser.add_argument('--n-max-queries', type=int, default=-1)
+parser.add_argument('--backends', default='hamming:kmer:cdr3-hamming', help='Colon-separated list of backends to compare')
+parser.add_argument('--cutoffs', required=True, help='Colon-separated list of preclustering cutoffs, one for each of <backends>. Each backend has its own units (see --precluster-distance in partis.py), so there\'s no sensible default: pick comparable ones, e.g. several for each backend in separate runs')
+parser.add_argument('--kmer-length', type=int, default=5)
+args = parser.parse_args()
+args.backends = utils.get_arg_list(args.backends)
+args.cutoffs = [float(c) for c in utils.get_arg_list(args.cutoffs)]
+if len(args.backends) != len(args.cutoffs):
+    raise Exception('ERROR need one cutoff for each backend')
+
+germline_seqs = utils.read_germlines(args.datadir)
+with open(args.datadir + '/v-meta.json') as json_file:
+    cyst_positions = json.load(json_file)
+with open(args.datadir + '/j_tryp.csv') as csv_file:
+    tryp_positions = {row[0]:row[1] for row in csv.reader(csv_file)}
+input_info, reco_info = get_seqfile_info(args.seqfile, is_data=False, germline_seqs=germline_seqs, cyst_positions=cyst_positions, tryp_positions=tryp_positions, n_max_queries=args.n_max_queries)
+seqs = {query:input_info[query]['seq'] for query in input_info}
+true_cdr3_info = {query:{key:int(reco_info[query][key]) for key in ('cyst_position', 'tryp_position', 'cdr3_length')} for query in reco_info}  # stands in for sw info, so cdr3-hamming gets the right cdr3s
+
+queries = input_info.keys()
+n_pairs = len(queries) * (len(queries) - 1) / 2
+true_pairs = set([frozenset(pair) for pair in itertools.combinations(queries, 2) if reco_info[pair[0]]['reco_id'] == reco_info[pair[1]]['reco_id']])
+print '%d queries (%d pairs, %d from the same rearrangement)' % (len(queries), n_pairs, len(true_pairs))
+print '  %15s %7s %12s %10s %12s %14s %8s %8s' % ('backend', 'cutoff', 'setup (s)', 'pairs/s', 'clusters', 'within pairs', 'recall', 'purity')
+for backend, cutoff in zip(args.backends, args.cutoffs):
+    start = time.time()
+    if backend == 'hamming':
+        hmr = Hammer(seqs, truncate=True)
+    elif backend == 'kmer':
+        hmr = KmerDistance(seqs, k=args.kmer_length)
+    elif backend == 'cdr3-hamming':
+        hmr = Cdr3Hammer(seqs, true_cdr3_info)
+    else:
+        raise Exception('ERROR unknown backend %s' % backend)
+    setup_time = time.time() - start
+
+    start = time.time()
+    distance_info = hmr.get_distances(itertools.combinations(queries, 2), max_score=cutoff)
+    distance_time = time.time() - start
+
+    linked_queries = set([info['id_a'] for info in distance_info] + [info['id_b'] for info in distance_info])
+    unlinked_queries = [query for query in queries if query not in linked_queries]  # these don't show up in the clusterer's <id_clusters>
+    clust = Clusterer(cutoff, greater_than=False, singletons=unlinked_queries)
+    with open(os.devnull, 'w') as devnull:  # don't need the cluster printout
+        clust.cluster(input_scores=distance_info, debug=False, outfile=devnull)
+    within_pairs = set()  # pairs that end up in the same precluster, i.e. which the pair hmm would have to look at
+    n_pure = len(unlinked_queries)  # number of queries whose precluster contains only queries from its own rearrangement
+    for cluster in clust.id_clusters.values():
+        within_pairs |= set([frozenset(pair) for pair in itertools.combinations(cluster, 2)])
+        if len(set([reco_info[query]['reco_id'] for query in cluster])) == 1:
+            n_pure += len(cluster)
+    recall = float(len(true_pairs & within_pairs)) / max(1, len(true_pairs))
+    purity = float(n_pure) / len(queries)
+    print '  %15s %7.3f %12.3f %10.0f %12d %14d %8.3f %8.3f' % (backend, cutoff, setup_time, n_pairs / max(1e-9, distance_time), len(clust.id_clusters) + len(unlinked_queries), len(within_pairs), recall, purity)
@@ -36,6 +36,10 @@ parser.add_argument('--mimic-data-read-length', action='store_true', help='Simul
 parser.add_argument('--baum-welch-iterations', type=int, default=1, help='Number of Baum-Welch-like iterations.')
 parser.add_argument('--no-plot', action='store_true', help='Don\'t write any plots (we write a *lot* of plots for debugging, which can be slow).')
 parser.add_argument('--pants-seated-clustering', action='store_true', help='Perform seat-of-the-pants estimate of the clusters')
+parser.add_argument('--indexed-hamming-precluster', action='store_true', help='Only calculate hamming distances for pairs that share an identical block of sequence, which (by the pigeonhole principle) includes every pair under <hamming-cluster-cutoff>. Avoids looking at all N^2 pairs, but only helps for fairly small cutoffs.')
+parser.add_argument('--cdr3-length-blocking', action='store_true', help='When partitioning, only compare (with hamming distance and the pair hmm) queries that share a plausible cdr3 length, where a query\'s plausible lengths are those implied by any of the v and j matches passed on to the hmm.')
+parser.add_argument('--precluster-distance', default='hamming', choices=['hamming', 'kmer', 'cdr3-hamming'], help='Distance to use for single-linkage preclustering: hamming distance over the whole sequence, one minus the cosine similarity of k-mer count profiles (alignment-free, so insensitive to indels), or hamming distance over just the cdr3 (needs sw info, and pairs with different cdr3 lengths get distance 1). <hamming-cluster-cutoff> is in the units of whichever one you choose.')
+parser.add_argument('--kmer-length', type=int, default=5, help='k-mer length for --precluster-distance kmer')
 
 # input and output locations
 parser.add_argument('--seqfile', help='input sequence file')
@@ -44,11 +48,17 @@ parser.add_argument('--datadir', default='data/imgt', help='Directory from which
 parser.add_argument('--outfname')
 parser.add_argument('--plotdir', default='/tmp/partis/plots')
 parser.add_argument('--ighutil-dir', default=os.getenv('HOME') + '/.local', help='Path to vdjalign executable. The default is where \'pip install --user\' typically puts things')
+parser.add_argument('--sw-cache-dir', help='Directory in which to keep smith-waterman matches from previous runs (keyed by sequence, germline set, and alignment parameters), so only sequences we haven\'t seen before get run through vdjalign.')
 parser.add_argument('--workdir', default='/tmp/' + os.path.basename(os.getenv('HOME')) + '/hmms/' + str(os.getpid()), help='Temporary working directory (see also <no-clean>)')
 
 # run/batch control
 parser.add_argument('--n-procs', default='1', help='Max number of processes over which to parallelize (Can be colon-separated list: first number is procs for hmm, second (should be smaller) is procs for smith-waterman, hamming, etc.)')
 parser.add_argument('--slurm', action='store_true', help='Run multiple processes with slurm, otherwise just runs them on local machine. NOTE make sure to set <workdir> to something visible on all batch nodes.')
+parser.add_argument('--persistent-hmm-workers', action='store_true', help='Start <n-procs> bcrham processes once and keep feeding them jobs, rather than starting new ones (which re-read all the hmm files) for every step.')
+parser.add_argument('--in-process-hmm', action='store_true', help='Run the hmm in this process with the pybcrham extension (build it with \'python setup.py build_ext --inplace\' in packages/ham/), in <n-procs> threads, rather than writing input files and starting bcrham processes. Each hmm directory is only read once.')
+parser.add_argument('--hmm-io-format', default='text', choices=['text', 'binary'], help='Format of the files we pass to bcrham and (for forward) read back. \'binary\' uses integer ids for query and gene names and packed sequences, so neither side has to format and parse text (see python/hmmbinary.py)')
+parser.add_argument('--hmm-chunks-per-proc', type=int, default=1, help='Split hmm input into this many chunks (of about equal estimated cost) per process, which are handed out to processes as they finish their previous chunk. Values larger than one work best with --persistent-hmm-workers, since otherwise each chunk pays for bcrham startup.')
+parser.add_argument('--incremental-hmm-writing', action='store_true', help='When writing hmms, only rebuild the yaml files for genes whose parameters (or germline sequence) have changed since they were last written.')
 parser.add_argument('--queries', help='Colon-separated list of query names to which we restrict ourselves')
 parser.add_argument('--reco-ids', help='Colon-separated list of rearrangement-event IDs to which we restrict ourselves')  # or recombination events
 parser.add_argument('--n-max-queries', type=int, default=-1, help='Maximum number of query sequences on which to run (except for simulator, where it\'s the number of rearrangement events)')
@@ -62,8 +72,16 @@ parser.add_argument('--n-leaves', type=int, default=5, help='Number of leaves pe
 parser.add_argument('--random-number-of-leaves', action='store_true', help='For each tree choose a random number of leaves. Otherwise give all trees <n-leaves> leaves')
 
 # numerical inputs
-parser.add_argument('--hamming-cluster-cutoff', type=float, default=0.5, help='Threshold for hamming distance single-linkage preclustering')
+parser.add_argument('--hamming-cluster-cutoff', type=float, default=0.5, help='Threshold for single-linkage preclustering with --precluster-distance')
 parser.add_argument('--pair-hmm-cluster-cutoff', type=float, default=0.0, help='Threshold for pair hmm single-linkage preclustering')
+parser.add_argument('--pair-score-cache-dir', help='Directory in which to keep pair hmm forward scores from previous runs (keyed by query pair, sequences, and hmm parameters), so the k=2 pass only runs bcrham on new pairs.')
+parser.add_argument('--max-scores-in-memory', type=int, help='When clustering, sort pair scores in chunks of at most this many, which are written to temporary files in <workdir> and then merged, so memory use doesn\'t grow with the number of pairs (default: sort them all in memory).')
+parser.add_argument('--shard-pair-hmm', action='store_true', help='Write pair hmm input grouped by hamming precluster, keep each precluster in a single chunk, and add each precluster\'s scores to the clusters as soon as they\'re read (rather than waiting for all of them).')
+parser.add_argument('--partition-outfname', help='When partitioning, write the final clusters (with a representative and the sequences for each) to this csv, which can later be passed to --existing-partition.')
+parser.add_argument('--existing-partition', help='Partition file (from --partition-outfname) to which to add the input queries, rather than partitioning from scratch. Queries that are already in it are skipped, and existing clusters are never split.')
+parser.add_argument('--representative-cutoff', type=float, help='If set, collapse each hamming precluster into groups of sequences within this hamming fraction of each other, and run the pair hmm only between group representatives (plus all member pairs for groups whose representative score is ambiguous, see --representative-score-margin).')
+parser.add_argument('--representative-score-margin', type=float, default=5.0, help='With --representative-cutoff, representative pair scores within this distance of --pair-hmm-cluster-cutoff are considered ambiguous, and the member pairs of their groups are scored individually.')
+parser.add_argument('--agglomerate', action='store_true', help='When partitioning, instead of the k=preclusters pass, greedily merge clusters within the pair hmm clusters using multi-sequence forward scores, starting from single queries and always merging the pair with the best likelihood ratio.')
 parser.add_argument('--min_observations_to_write', type=int, default=20, help='For hmmwriter.py, if we see a gene version fewer times than this, we sum over other alleles, or other versions, etc. (see hmmwriter)')
 parser.add_argument('--n-max-per-region', default='3:5:2', help='Number of best smith-waterman matches (per region, in the format v:d:j) to pass on to the hmm')
 parser.add_argument('--default-v-fuzz', type=int, default=5, help='Size of the k space region over which to sum in the v direction')
@@ -98,6 +116,10 @@ if args.slurm and '/tmp' in args.workdir:
     print 'ERROR it appears that <workdir> isn\'t set to something visible to all slurm nodes'
     sys.exit()
 
+if args.in_process_hmm and (args.slurm or args.persistent_hmm_workers):
+    print 'ERROR --in-process-hmm can\'t be used with --slurm or --persistent-hmm-workers'
+    sys.exit()
+
 if args.plot_performance:
     assert not args.is_data
     # assert args.algorithm == 'viterbi'
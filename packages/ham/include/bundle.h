@@ -0,0 +1,58 @@
+#ifndef HAM_BUNDLE_H
+#define HAM_BUNDLE_H
+
+#include <string>
+#include <map>
+#include <vector>
+#include <cstring>
+#include <stdexcept>
+#include <stdint.h>
+
+using namespace std;
+namespace ham {
+
+// ----------------------------------------------------------------------------------------
+// reads little-endian values, one after another, from one model's record in a bundle (NOTE assumes we're on a little-endian machine)
+class BundleReader {
+public:
+  BundleReader(const char *data, size_t size, string description) : data_(data), size_(size), pos_(0), description_(description) {}
+  template <typename T> T Read() {
+    Check(sizeof(T));
+    T value;
+    memcpy(&value, data_ + pos_, sizeof(T));
+    pos_ += sizeof(T);
+    return value;
+  }
+  string ReadString();  // uint16 length, then that many chars
+  inline string description() { return description_; }
+private:
+  void Check(size_t n_bytes) {
+    if(pos_ + n_bytes > size_)
+      throw runtime_error("ERROR ran off the end of " + description_);
+  }
+  const char *data_;
+  size_t size_;
+  size_t pos_;
+  string description_;
+};
+
+// ----------------------------------------------------------------------------------------
+// read-only memory map of a compiled bundle of all the models in an hmm directory (written by python/hmmbundle.py), so concurrent processes
+// share the file's page cache, and none of them has to parse yaml
+class ModelBundle {
+public:
+  ModelBundle(string fname);
+  ~ModelBundle();
+  bool Has(string name) { return index_.count(name) > 0; }
+  bool IsStale(string name, string fname);  // has yaml file <fname> changed since we wrote the record for <name>? (according to its size and mtime)
+  BundleReader Record(string name);  // reader for the model named <name> (i.e. the sanitized gene name)
+private:
+  string fname_;
+  const char *data_;
+  size_t size_;
+  map<string, pair<uint64_t, uint64_t> > index_;  // map from model name to offset and size of its record
+  map<string, pair<uint64_t, double> > yaml_stats_;  // map from model name to the size and mtime of its yaml when the bundle was written
+};
+
+}
+#endif
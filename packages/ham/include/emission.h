@@ -18,6 +18,7 @@ class Emission {
 public:
   Emission();
   void Parse(YAML::Node config, Tracks model_tracks);
+  void SetProbs(Track *tk, vector<double> probs);  // <probs> in the same order as <tk>'s symbols (*not* logged)
   ~Emission();
 
   inline double score(Sequence *seq, size_t pos) { return scores_.LogProb(seq, pos); }
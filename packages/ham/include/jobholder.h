@@ -8,6 +8,7 @@
 #include <set>
 #include <iomanip>
 #include <stdexcept>
+#include <mutex>
 
 #include "trellis.h"
 #include "mathutils.h"
@@ -43,14 +44,17 @@ public:
 // ----------------------------------------------------------------------------------------
 class HMMHolder {
 public:
-  HMMHolder(string hmm_dir, GermLines &gl): hmm_dir_(hmm_dir), gl_(gl) {}
+  HMMHolder(string hmm_dir, GermLines &gl);
   ~HMMHolder();
-  Model *Get(string gene, bool debug);
+  Model *Get(string gene, bool debug);  // NOTE thread safe, so several JobHolders can share one HMMHolder (e.g. in pybcrham)
   void CacheAll();  // read all available hmms into memory
 private:
+  Model *Read(string gene);  // read from <bundle_> if it has an up-to-date record for <gene>, otherwise from the yaml file
   string hmm_dir_;
   GermLines &gl_;
+  ModelBundle *bundle_;  // compiled bundle of all the hmms in <hmm_dir_> (nullptr if there isn't one)
   map<string, Model*> hmms_; // map of gene name to hmm pointer
+  mutex mutex_;  // protects <hmms_>
 };
 
 // ----------------------------------------------------------------------------------------
@@ -80,6 +84,7 @@ public:
   void Clear();
   Result Run(Sequences seqs, KBounds kbounds);  // run all over the kspace specified by bounds in kmin and kmax
   Result Run(Sequence seq, KBounds kbounds);
+  Result RunWithExpansion(Sequences &seqs, KBounds kbounds, double *score, string *errors);  // Run(), expanding the k bounds until the best kset isn't on a boundary
   void RunKSet(Sequences &seqs, KSet kset, map<KSet, double> *best_scores, map<KSet, double> *total_scores, map<KSet, map<string, string> > *best_genes);
   void SetDebug(int debug) { debug_ = debug; };
   void SetChunkCache(bool val) { chunk_cache_ = val; }
@@ -92,6 +97,7 @@ public:
   void WriteBestGeneProbs(ofstream &ofs, string query_name);
 
 private:
+  void PrintForwardScores(double numerator, vector<double> single_scores, double bayes_factor);
   void PrintPath(vector<string> query_strs, string gene, double score, string extra_str = "");
   Sequences GetSubSeqs(Sequences &seqs, KSet kset, string region);
   map<string, Sequences> GetSubSeqs(Sequences &seqs, KSet kset);  // get the subsequences for the v, d, and j regions given a k_v and k_d
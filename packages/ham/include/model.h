@@ -12,6 +12,7 @@ class Model {
 public:
   Model();
   void Parse(string);
+  void Parse(BundleReader &reader);  // read from this model's record in a compiled bundle (see ModelBundle)
   void AddState(State*);
   void Finalize();
 
@@ -38,6 +39,7 @@ private:
   State* ending_;
   bool finalized_;
 
+  void AddParsedState(State *st);
   void FinalizeState(State *st);
   void CheckTopology();
   void AddToStateIndices(State* st, vector<uint16_t>& visited); // that's 'to-state', as in, 'here we push back the to-state indices onto <visited>'
@@ -11,6 +11,7 @@ class Sequence {
 public:
   Sequence(Track* trk, string name, string &undigitized);
   Sequence(Track* trk, string name, string &undigitized, size_t pos, size_t len);  // create the subsequence from <pos> of length <len>
+  Sequence(Track* trk, string name, vector<uint8_t> &digitized);  // create from already-digitized values (e.g. from a binary input file)
   Sequence(Sequence &rhs, size_t pos, size_t len);
   Sequence(const Sequence &rhs);
   ~Sequence();
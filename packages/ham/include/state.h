@@ -11,6 +11,7 @@
 #include "text.h"
 #include "emission.h"
 #include "transitions.h"
+#include "bundle.h"
 #include "yaml-cpp/yaml.h"
 
 using namespace std;
@@ -21,6 +22,7 @@ class State {
 public:
   State();
   void Parse(YAML::Node node, vector<string> state_names, Tracks trks);
+  void Parse(BundleReader &reader, vector<string> state_names, Tracks trks);  // same thing, but from a compiled model bundle
   ~State();
 
   inline string name() { return name_; }
@@ -50,6 +52,8 @@ private:
   Emission emission_;
   Emission pair_emission_;
 
+  void AddTransitions(vector<pair<string, double> > &to_states, vector<string> &state_names);
+
   // hmm model-level information (assigned in model::finalize)
   size_t index_;  // position of this state in the vector model::states_ (set in model::finalize)
   bitset<STATE_MAX> to_states_;
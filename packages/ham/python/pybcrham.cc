@@ -0,0 +1,305 @@
+// python bindings for running bcrham's forward and viterbi algorithms in-process, i.e. without writing an input file, starting a bcrham
+// process, and parsing its csv output for every pass. Build with 'python setup.py build_ext --inplace' in packages/ham/.
+//
+//   import pybcrham
+//   ham = pybcrham.Ham(hmmdir, datadir, n_best_events=3, chunk_cache=True, debug=0)
+//   results = ham.forward(query_sets)
+//
+// where each query set is a dict with the same keys as a line of bcrham's input file (but with lists instead of colon-separated strings):
+//   {'names':[...], 'k_v_min':int, 'k_v_max':int, 'k_d_min':int, 'k_d_max':int, 'only_genes':[...], 'seqs':[...]}
+// and results are dicts with the same keys as the lines of bcrham's csv output (see <columns>), with unique_ids and seqs as lists, deletion
+// lengths as ints, and score as a float. forward() returns one result per query set, and viterbi() returns up to <n_best_events> per query set.
+// The hmms are only read from disk the first time they're needed, and the GIL is released while running, so one Ham can be shared by several
+// python threads.
+
+#include <Python.h>
+#include "jobholder.h"
+#include "germlines.h"
+
+using namespace ham;
+using namespace std;
+
+// ----------------------------------------------------------------------------------------
+class QuerySet {  // one line of bcrham's input file
+public:
+  vector<string> names, seqs, only_genes;
+  int k_v_min, k_v_max, k_d_min, k_d_max;
+};
+
+// ----------------------------------------------------------------------------------------
+class QueryResult {
+public:
+  double score;
+  string errors;
+  vector<RecoEvent> events;  // best viterbi events
+};
+
+// ----------------------------------------------------------------------------------------
+typedef struct {
+  PyObject_HEAD
+  Track *track;
+  GermLines *gl;
+  HMMHolder *hmms;
+  int n_best_events;
+  int debug;
+  bool chunk_cache;
+} Ham;
+
+static PyTypeObject HamType = { PyVarObject_HEAD_INIT(NULL, 0) };
+
+// ----------------------------------------------------------------------------------------
+static void Ham_clear(Ham *self) {
+  delete self->hmms;  // NOTE holds a reference to <gl>, so delete it first
+  delete self->gl;
+  delete self->track;
+  self->hmms = NULL;
+  self->gl = NULL;
+  self->track = NULL;
+}
+
+// ----------------------------------------------------------------------------------------
+static void Ham_dealloc(Ham *self) {
+  Ham_clear(self);
+  Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+// ----------------------------------------------------------------------------------------
+static int Ham_init(Ham *self, PyObject *args, PyObject *kwds) {
+  static const char *kwlist[] = {"hmmdir", "datadir", "n_best_events", "chunk_cache", "debug", NULL};
+  const char *hmmdir, *datadir;
+  int n_best_events(3), chunk_cache(1), debug(0);
+  if(!PyArg_ParseTupleAndKeywords(args, kwds, "ss|iii", const_cast<char**>(kwlist), &hmmdir, &datadir, &n_best_events, &chunk_cache, &debug))
+    return -1;
+  if(!ifstream(string(datadir) + "/ighv.fasta")) {  // GermLines asserts, which would take python down with it
+    PyErr_SetString(PyExc_IOError, ("ERROR couldn't find germline sequences in " + string(datadir)).c_str());
+    return -1;
+  }
+
+  Ham_clear(self);  // in case __init__ gets called twice
+  vector<string> characters {"A", "C", "G", "T"};
+  self->track = new Track("NUKES", characters);
+  self->gl = new GermLines(datadir);
+  self->hmms = new HMMHolder(hmmdir, *self->gl);
+  self->n_best_events = n_best_events;
+  self->chunk_cache = chunk_cache;
+  self->debug = debug;
+  return 0;
+}
+
+// ----------------------------------------------------------------------------------------
+// set <values> to the strings in the list <key> in <dict>, or return false with a python exception set
+static bool GetStrList(PyObject *dict, const char *key, vector<string> *values) {
+  PyObject *list = PyDict_GetItemString(dict, key);  // borrowed reference
+  if(list == NULL || !PyList_Check(list)) {
+    PyErr_Format(PyExc_ValueError, "ERROR query set needs a list for '%s'", key);
+    return false;
+  }
+  for(Py_ssize_t ival = 0; ival < PyList_GET_SIZE(list); ++ival) {
+    PyObject *val = PyList_GET_ITEM(list, ival);
+    if(!PyString_Check(val)) {
+      PyErr_Format(PyExc_TypeError, "ERROR entries in '%s' have to be strings", key);
+      return false;
+    }
+    values->push_back(string(PyString_AS_STRING(val), PyString_GET_SIZE(val)));
+  }
+  return true;
+}
+
+// ----------------------------------------------------------------------------------------
+static bool GetInt(PyObject *dict, const char *key, int *value) {
+  PyObject *val = PyDict_GetItemString(dict, key);
+  if(val == NULL) {
+    PyErr_Format(PyExc_ValueError, "ERROR query set missing '%s'", key);
+    return false;
+  }
+  *value = PyInt_AsLong(val);
+  return !(*value == -1 && PyErr_Occurred());
+}
+
+// ----------------------------------------------------------------------------------------
+// convert the python list of dicts <pysets> to <qsets>, checking for anything that would trip an assert (rather than an exception) in ham
+static bool GetQuerySets(Ham *self, PyObject *pysets, vector<QuerySet> *qsets) {
+  PyObject *seq = PySequence_Fast(pysets, "ERROR query sets have to be a sequence");
+  if(seq == NULL)
+    return false;
+  bool ok(true);
+  for(Py_ssize_t iset = 0; ok && iset < PySequence_Fast_GET_SIZE(seq); ++iset) {
+    PyObject *dict = PySequence_Fast_GET_ITEM(seq, iset);
+    if(!PyDict_Check(dict)) {
+      PyErr_SetString(PyExc_TypeError, "ERROR each query set has to be a dict");
+      ok = false;
+      break;
+    }
+    qsets->push_back(QuerySet());
+    QuerySet &qs(qsets->back());
+    ok = GetStrList(dict, "names", &qs.names) && GetStrList(dict, "seqs", &qs.seqs) && GetStrList(dict, "only_genes", &qs.only_genes)
+         && GetInt(dict, "k_v_min", &qs.k_v_min) && GetInt(dict, "k_v_max", &qs.k_v_max) && GetInt(dict, "k_d_min", &qs.k_d_min) && GetInt(dict, "k_d_max", &qs.k_d_max);
+    if(!ok)
+      break;
+    if(qs.names.size() == 0 || qs.names.size() != qs.seqs.size()) {
+      PyErr_SetString(PyExc_ValueError, "ERROR query sets need the same (non-zero) number of names and seqs");
+      ok = false;
+    } else if(qs.only_genes.size() == 0) {  // otherwise ham would try to read an hmm for every gene in the germline set
+      PyErr_SetString(PyExc_ValueError, "ERROR query sets need at least one gene in only_genes");
+      ok = false;
+    } else if(qs.k_v_min < 1 || qs.k_d_min < 1 || qs.k_v_max <= qs.k_v_min || qs.k_d_max <= qs.k_d_min) {
+      PyErr_Format(PyExc_ValueError, "ERROR bad k bounds %d-%d, %d-%d", qs.k_v_min, qs.k_v_max, qs.k_d_min, qs.k_d_max);
+      ok = false;
+    }
+    for(size_t igene = 0; ok && igene < qs.only_genes.size(); ++igene) {
+      if(self->gl->seqs_.count(qs.only_genes[igene]) == 0) {
+        PyErr_Format(PyExc_ValueError, "ERROR gene %s not in the germline set", qs.only_genes[igene].c_str());
+        ok = false;
+      }
+    }
+  }
+  Py_DECREF(seq);
+  return ok;
+}
+
+// ----------------------------------------------------------------------------------------
+// return a new python list of the strings in <values>
+static PyObject *GetPyList(vector<string> &values) {
+  PyObject *list = PyList_New(values.size());
+  if(list == NULL)
+    return NULL;
+  for(size_t ival = 0; ival < values.size(); ++ival)
+    PyList_SET_ITEM(list, ival, PyString_FromStringAndSize(values[ival].data(), values[ival].size()));  // steals the reference
+  return list;
+}
+
+// ----------------------------------------------------------------------------------------
+// set <key> in <dict> to <value>, taking ownership of <value>
+static void SetItem(PyObject *dict, const char *key, PyObject *value) {
+  PyDict_SetItemString(dict, key, value);
+  Py_DECREF(value);
+}
+
+// ----------------------------------------------------------------------------------------
+static PyObject *GetForwardResult(QuerySet &qs, QueryResult &qr) {
+  PyObject *dict = PyDict_New();
+  SetItem(dict, "unique_ids", GetPyList(qs.names));
+  SetItem(dict, "score", PyFloat_FromDouble(qr.score));
+  SetItem(dict, "errors", PyString_FromString(qr.errors.c_str()));
+  return dict;
+}
+
+// ----------------------------------------------------------------------------------------
+static PyObject *GetViterbiResult(QuerySet &qs, QueryResult &qr, RecoEvent &event) {
+  PyObject *dict = PyDict_New();
+  SetItem(dict, "unique_ids", GetPyList(qs.names));
+  for(auto & region : vector<string> {"v", "d", "j"})
+    SetItem(dict, (region + "_gene").c_str(), PyString_FromString(event.genes_[region].c_str()));
+  for(auto & boundary : vector<string> {"fv", "vd", "dj", "jf"})
+    SetItem(dict, (boundary + "_insertion").c_str(), PyString_FromString(event.insertions_[boundary].c_str()));
+  for(auto & del : vector<string> {"v_5p", "v_3p", "d_5p", "d_3p", "j_5p", "j_3p"})
+    SetItem(dict, (del + "_del").c_str(), PyInt_FromSize_t(event.deletions_[del]));
+  SetItem(dict, "score", PyFloat_FromDouble(event.score_));
+  SetItem(dict, "seqs", GetPyList(qs.seqs));
+  SetItem(dict, "errors", PyString_FromString(qr.errors.c_str()));
+  return dict;
+}
+
+// ----------------------------------------------------------------------------------------
+static PyObject *Ham_run(Ham *self, PyObject *pysets, string algorithm) {
+  if(self->hmms == NULL) {
+    PyErr_SetString(PyExc_RuntimeError, "ERROR Ham wasn't initialized");
+    return NULL;
+  }
+  vector<QuerySet> qsets;
+  if(!GetQuerySets(self, pysets, &qsets))
+    return NULL;
+
+  vector<QueryResult> qresults(qsets.size());
+  string error;
+  Py_BEGIN_ALLOW_THREADS  // nothing in here can touch python objects
+  try {
+    for(size_t iset = 0; iset < qsets.size(); ++iset) {
+      QuerySet &qs(qsets[iset]);
+      Sequences seqs;
+      for(size_t iseq = 0; iseq < qs.names.size(); ++iseq)
+        seqs.AddSeq(Sequence(self->track, qs.names[iseq], qs.seqs[iseq]));
+      JobHolder jh(*self->gl, *self->hmms, algorithm, qs.only_genes);
+      jh.SetDebug(self->debug);
+      jh.SetChunkCache(self->chunk_cache);
+      jh.SetNBestEvents(self->n_best_events);
+      KBounds kbounds(KSet(qs.k_v_min, qs.k_d_min), KSet(qs.k_v_max, qs.k_d_max));
+      Result result(jh.RunWithExpansion(seqs, kbounds, &qresults[iset].score, &qresults[iset].errors));
+      if(algorithm == "viterbi") {
+        size_t n_events(min(size_t(self->n_best_events), result.events_.size()));
+        qresults[iset].events.assign(result.events_.begin(), result.events_.begin() + n_events);
+      }
+    }
+  } catch(exception &e) {
+    error = e.what();
+  }
+  Py_END_ALLOW_THREADS
+  if(error != "") {
+    PyErr_SetString(PyExc_RuntimeError, error.c_str());
+    return NULL;
+  }
+
+  PyObject *results = PyList_New(0);
+  for(size_t iset = 0; iset < qsets.size(); ++iset) {
+    if(algorithm == "forward") {
+      PyObject *dict = GetForwardResult(qsets[iset], qresults[iset]);
+      PyList_Append(results, dict);
+      Py_DECREF(dict);
+    } else {
+      for(auto & event : qresults[iset].events) {
+        PyObject *dict = GetViterbiResult(qsets[iset], qresults[iset], event);
+        PyList_Append(results, dict);
+        Py_DECREF(dict);
+      }
+    }
+  }
+  return results;
+}
+
+// ----------------------------------------------------------------------------------------
+static PyObject *Ham_forward(Ham *self, PyObject *pysets) {
+  return Ham_run(self, pysets, "forward");
+}
+
+// ----------------------------------------------------------------------------------------
+static PyObject *Ham_viterbi(Ham *self, PyObject *pysets) {
+  return Ham_run(self, pysets, "viterbi");
+}
+
+// ----------------------------------------------------------------------------------------
+static PyMethodDef Ham_methods[] = {
+  {"forward", (PyCFunction)Ham_forward, METH_O, "forward(query_sets): list with the forward score of each query set (as {'unique_ids', 'score', 'errors'} dicts)"},
+  {"viterbi", (PyCFunction)Ham_viterbi, METH_O, "viterbi(query_sets): list with the best (up to n_best_events) viterbi events for each query set, in order"},
+  {NULL}
+};
+
+static PyMethodDef module_methods[] = {
+  {NULL}
+};
+
+// ----------------------------------------------------------------------------------------
+PyMODINIT_FUNC initpybcrham(void) {
+  HamType.tp_name = "pybcrham.Ham";
+  HamType.tp_basicsize = sizeof(Ham);
+  HamType.tp_dealloc = (destructor)Ham_dealloc;
+  HamType.tp_flags = Py_TPFLAGS_DEFAULT;
+  HamType.tp_doc = "Ham(hmmdir, datadir, n_best_events=3, chunk_cache=True, debug=0): the hmms in <hmmdir>, and the germline genes in <datadir>";
+  HamType.tp_methods = Ham_methods;
+  HamType.tp_init = (initproc)Ham_init;
+  HamType.tp_new = PyType_GenericNew;
+  if(PyType_Ready(&HamType) < 0)
+    return;
+
+  PyObject *module = Py_InitModule3("pybcrham", module_methods, "in-process bcrham forward and viterbi (see pybcrham.cc)");
+  if(module == NULL)
+    return;
+  PyEval_InitThreads();  // we release the GIL while running
+
+  Py_INCREF(&HamType);
+  PyModule_AddObject(module, "Ham", (PyObject*)&HamType);
+  PyObject *columns = Py_BuildValue("{s:(sss),s:(sssssssssssssssss)}",  // column order in bcrham's csv output, for writing our results the same way
+                                    "forward", "unique_ids", "score", "errors",
+                                    "viterbi", "unique_ids", "v_gene", "d_gene", "j_gene", "fv_insertion", "vd_insertion", "dj_insertion", "jf_insertion",
+                                    "v_5p_del", "v_3p_del", "d_5p_del", "d_3p_del", "j_5p_del", "j_3p_del", "score", "seqs", "errors");
+  PyModule_AddObject(module, "columns", columns);
+}
@@ -0,0 +1,16 @@
+""" Builds pybcrham, the in-process python bindings for bcrham (see python/pybcrham.cc). Run 'python setup.py build_ext --inplace' in this directory. """
+import glob
+from distutils.core import setup, Extension
+
+binary_names = ['bcrham', 'hample', 'bench']  # sources with a main()
+sources = [fname for fname in glob.glob('src/*.cc') if not any(bname in fname for bname in binary_names)]
+sources += glob.glob('yaml-cpp/*.cpp')
+
+pybcrham = Extension('pybcrham',
+                     sources=['python/pybcrham.cc'] + sources,
+                     include_dirs=['include'],
+                     define_macros=[('STATE_MAX', '1024'), ('SIZE_MAX', '((size_t)-1)'), ('UINT16_MAX', '65535'), ('PI', '3.1415926535897932'), ('EPS', '1e-6')],  # keep the same as src/SConscript
+                     extra_compile_args=['-std=c++0x', '-Ofast'],
+                     language='c++')
+
+setup(name='pybcrham', ext_modules=[pybcrham])
@@ -31,6 +31,10 @@ public:
   // int debug() { return debug_; }
   int n_best_events() { return n_best_events_arg_.getValue(); }
   bool chunk_cache() { return chunk_cache_arg_.getValue(); }
+  bool worker() { return worker_arg_.getValue(); }
+  bool binary_io() { return binary_io_arg_.getValue(); }
+  void ReadInfile(string infname);  // read the per-query info in <infname> into the maps below (replacing whatever was there before)
+  void ReadBinaryInfile(string infname);  // same, but for the binary format (see python/hmmbinary.py)
 
   // command line arguments
   vector<string> algo_strings_;
@@ -39,7 +43,7 @@ public:
   ValuesConstraint<int> debug_vals_;
   ValueArg<string> hmmdir_arg_, datadir_arg_, infile_arg_, outfile_arg_, algorithm_arg_;
   ValueArg<int> debug_arg_, n_best_events_arg_;
-  SwitchArg chunk_cache_arg_;
+  SwitchArg chunk_cache_arg_, worker_arg_, binary_io_arg_;
 
   // arguments read from csv input file
   map<string, vector<string> > strings_;
@@ -47,6 +51,11 @@ public:
   map<string, vector<vector<string> > > str_lists_;
   set<string> str_headers_, int_headers_, str_list_headers_;
 
+  // only filled for binary input
+  vector<string> name_table_;  // query names, which are passed back in the same table in binary output
+  vector<vector<uint32_t> > name_ids_;  // for each query set, the index in <name_table_> of each query
+  vector<vector<vector<uint8_t> > > digitized_seqs_;  // for each query set, each query's sequence as track indices
+
   // // extra values to cache command line args (TCLAP calls to ValuesConstraint::check() seem to be really slow
   // UPDATE hmm, didn't seem to help. leave it for the moment
   // string algorithm_;
@@ -59,14 +68,16 @@ Args::Args(int argc, const char * argv[]):
               debug_ints_ {0, 1, 2},
               algo_vals_(algo_strings_),
               debug_vals_(debug_ints_),
-              hmmdir_arg_("m", "hmmdir", "directory in which to look for hmm model files", true, "", "string"),
+              hmmdir_arg_("m", "hmmdir", "directory in which to look for hmm model files", false, "", "string"),
               datadir_arg_("d", "datadir", "directory in which to look for non-sample-specific data (eg human germline seqs)", true, "", "string"),
-              infile_arg_("i", "infile", "input (whitespace-separated) file", true, "", "string"),
-              outfile_arg_("o", "outfile", "output csv file", true, "", "string"),
-              algorithm_arg_("a", "algorithm", "algorithm to run", true, "", &algo_vals_),
+              infile_arg_("i", "infile", "input (whitespace-separated) file", false, "", "string"),
+              outfile_arg_("o", "outfile", "output csv file", false, "", "string"),
+              algorithm_arg_("a", "algorithm", "algorithm to run", false, "", &algo_vals_),
               debug_arg_("g", "debug", "debug level", false, 0, &debug_vals_),
               n_best_events_arg_("n", "n_best_events", "number of candidate recombination events to write to file", true, -1, "int"),
               chunk_cache_arg_("c", "chunk-cache", "perform chunk caching?", false),
+              worker_arg_("w", "worker", "instead of running on <infile>, stay alive and read jobs from stdin (one per line: <algorithm> <hmmdir> <infile> <outfile>), so hmms only get read from disk once", false),
+              binary_io_arg_("b", "binary-io", "read binary input files, and (for forward) write binary output files, instead of text (see python/hmmbinary.py)", false),
               str_headers_ {},
               int_headers_ {"k_v_min", "k_v_max", "k_d_min", "k_d_max"},
 str_list_headers_ {"names", "seqs", "only_genes"} { // args that are passed as colon-separated lists
@@ -80,6 +91,8 @@ str_list_headers_ {"names", "seqs", "only_genes"} { // args that are passed as c
     cmd.add(debug_arg_);
     cmd.add(n_best_events_arg_);
     cmd.add(chunk_cache_arg_);
+    cmd.add(worker_arg_);
+    cmd.add(binary_io_arg_);
 
     cmd.parse(argc, argv);
 
@@ -90,12 +103,32 @@ str_list_headers_ {"names", "seqs", "only_genes"} { // args that are passed as c
     throw;
   }
 
+  if(!worker() && (hmmdir() == "" || infile() == "" || outfile() == "" || algorithm() == ""))
+    throw runtime_error("ERROR --hmmdir, --infile, --outfile, and --algorithm are required unless running with --worker");
+
+  if(!worker())
+    ReadInfile(infile());
+}
+
+// ----------------------------------------------------------------------------------------
+void Args::ReadInfile(string infname) {
+  strings_.clear();
+  integers_.clear();
+  str_lists_.clear();
+  name_table_.clear();
+  name_ids_.clear();
+  digitized_seqs_.clear();
   for(auto & head : str_headers_)
     strings_[head] = vector<string>();
   for(auto & head : int_headers_)
     integers_[head] = vector<int>();
 
-  ifstream ifs(infile());
+  if(binary_io()) {
+    ReadBinaryInfile(infname);
+    return;
+  }
+
+  ifstream ifs(infname);
   assert(ifs.is_open());
   string line;
   // get header line
@@ -129,12 +162,103 @@ str_list_headers_ {"names", "seqs", "only_genes"} { // args that are passed as c
   }
 }
 
+// ----------------------------------------------------------------------------------------
+// read <count> little-endian values of type T from <ifs> (NOTE assumes we're on a little-endian machine)
+template <typename T> vector<T> ReadValues(ifstream &ifs, size_t count) {
+  vector<T> values(count);
+  if(count > 0)
+    ifs.read(reinterpret_cast<char*>(&values[0]), count * sizeof(T));
+  if(!ifs)
+    throw runtime_error("ERROR unexpected end of binary input file");
+  return values;
+}
+
+// ----------------------------------------------------------------------------------------
+vector<string> ReadTable(ifstream &ifs) {
+  vector<string> entries;
+  uint32_t n_entries(ReadValues<uint32_t>(ifs, 1)[0]);
+  for(size_t ientry = 0; ientry < n_entries; ++ientry) {
+    uint16_t length(ReadValues<uint16_t>(ifs, 1)[0]);
+    vector<char> chars(ReadValues<char>(ifs, length));
+    entries.push_back(string(chars.begin(), chars.end()));
+  }
+  return entries;
+}
+
+// ----------------------------------------------------------------------------------------
+void WriteTable(ofstream &ofs, vector<string> &entries) {
+  uint32_t n_entries(entries.size());
+  ofs.write(reinterpret_cast<char*>(&n_entries), sizeof(n_entries));
+  for(auto & entry : entries) {
+    uint16_t length(entry.size());
+    ofs.write(reinterpret_cast<char*>(&length), sizeof(length));
+    ofs.write(entry.data(), length);
+  }
+}
+
+// ----------------------------------------------------------------------------------------
+void Args::ReadBinaryInfile(string infname) {
+  ifstream ifs(infname, ios::binary);
+  if(!ifs.is_open())
+    throw runtime_error("ERROR couldn't open binary input file " + infname);
+  uint16_t one(1);
+  if(*reinterpret_cast<uint8_t*>(&one) != 1)
+    throw runtime_error("ERROR binary input files are little-endian, but this machine isn't");
+  vector<char> magic(ReadValues<char>(ifs, 8));
+  if(string(magic.begin(), magic.end()) != "BCRHAMI1")
+    throw runtime_error("ERROR " + infname + " isn't a binary bcrham input file");
+
+  name_table_ = ReadTable(ifs);
+  vector<string> gene_table(ReadTable(ifs));
+  uint32_t n_records(ReadValues<uint32_t>(ifs, 1)[0]);
+  vector<uint16_t> n_seqs(ReadValues<uint16_t>(ifs, n_records));
+  vector<uint16_t> seq_lengths(ReadValues<uint16_t>(ifs, n_records));
+  vector<uint16_t> n_genes(ReadValues<uint16_t>(ifs, n_records));
+  for(auto & head : vector<string> {"k_v_min", "k_v_max", "k_d_min", "k_d_max"}) {  // NOTE same order as the python side
+    vector<int32_t> values(ReadValues<int32_t>(ifs, n_records));
+    integers_[head] = vector<int>(values.begin(), values.end());
+  }
+  size_t n_total_seqs(0), n_total_genes(0), n_total_bases(0);
+  for(size_t irec = 0; irec < n_records; ++irec) {
+    n_total_seqs += n_seqs[irec];
+    n_total_genes += n_genes[irec];
+    n_total_bases += n_seqs[irec] * seq_lengths[irec];
+  }
+  vector<uint32_t> name_ids(ReadValues<uint32_t>(ifs, n_total_seqs));
+  vector<uint32_t> gene_ids(ReadValues<uint32_t>(ifs, n_total_genes));
+  vector<uint8_t> packed_bases(ReadValues<uint8_t>(ifs, (n_total_bases + 3) / 4));  // two bits per base, four to a byte, first one in the high bits
+  vector<uint8_t> bases(n_total_bases);
+  for(size_t ib = 0; ib < n_total_bases; ++ib)
+    bases[ib] = (packed_bases[ib / 4] >> (6 - 2 * (ib % 4))) & 3;
+
+  size_t iname(0), igene(0), ibase(0);
+  for(size_t irec = 0; irec < n_records; ++irec) {
+    name_ids_.push_back(vector<uint32_t>(name_ids.begin() + iname, name_ids.begin() + iname + n_seqs[irec]));
+    str_lists_["names"].push_back(vector<string>());
+    digitized_seqs_.push_back(vector<vector<uint8_t> >());
+    for(size_t iseq = 0; iseq < n_seqs[irec]; ++iseq) {
+      str_lists_["names"].back().push_back(name_table_.at(name_ids[iname++]));
+      digitized_seqs_.back().push_back(vector<uint8_t>(bases.begin() + ibase, bases.begin() + ibase + seq_lengths[irec]));
+      ibase += seq_lengths[irec];
+    }
+    str_lists_["only_genes"].push_back(vector<string>());
+    for(size_t ig = 0; ig < n_genes[irec]; ++ig)
+      str_lists_["only_genes"].back().push_back(gene_table.at(gene_ids[igene++]));
+  }
+}
+
 // ----------------------------------------------------------------------------------------
 // read input sequences from file and return as vector of sequences
 vector<Sequences> GetSeqs(Args &args, Track *trk) {
   vector<Sequences> all_seqs;
   for(size_t iqry = 0; iqry < args.str_lists_["names"].size(); ++iqry) { // loop over queries, where each query can be composed of one, two, or k sequences
     Sequences seqs;
+    if(args.binary_io()) {
+      for(size_t iseq = 0; iseq < args.str_lists_["names"][iqry].size(); ++iseq)
+        seqs.AddSeq(Sequence(trk, args.str_lists_["names"][iqry][iseq], args.digitized_seqs_[iqry][iseq]));
+      all_seqs.push_back(seqs);
+      continue;
+    }
     assert(args.str_lists_["names"][iqry].size() == args.str_lists_["seqs"][iqry].size());
     for(size_t iseq = 0; iseq < args.str_lists_["names"][iqry].size(); ++iseq) { // loop over each sequence in that query
       Sequence sq(trk, args.str_lists_["names"][iqry][iseq], args.str_lists_["seqs"][iqry][iseq]);
@@ -147,29 +271,74 @@ vector<Sequences> GetSeqs(Args &args, Track *trk) {
 }
 
 // ----------------------------------------------------------------------------------------
-void StreamOutput(ofstream &ofs, Args &args, vector<RecoEvent> &events, Sequences &seqs, double total_score, string errors);
-void print_forward_scores(double numerator, vector<double> single_scores, double bayes_factor);
+void RunJob(Args &args, GermLines &gl, HMMHolder &hmms, Track *trk, string algorithm, string outfname);
+void RunWorker(Args &args, GermLines &gl, Track *trk);
+void StreamOutput(ofstream &ofs, Args &args, string algorithm, vector<RecoEvent> &events, Sequences &seqs, double total_score, string errors);
+void WriteBinaryForwardOutput(string outfname, Args &args, vector<double> &scores, vector<uint8_t> &errors);
 // ----------------------------------------------------------------------------------------
 int main(int argc, const char * argv[]) {
   srand(time(NULL));
   Args args(argc, argv);
-  // write csv output headers
-  ofstream ofs;
-  ofs.open(args.outfile());
-  assert(ofs.is_open());
-  if(args.algorithm() == "viterbi")
-    ofs << "unique_ids,v_gene,d_gene,j_gene,fv_insertion,vd_insertion,dj_insertion,jf_insertion,v_5p_del,v_3p_del,d_5p_del,d_3p_del,j_5p_del,j_3p_del,score,seqs,errors" << endl;
-  else
-    ofs << "unique_ids,score,errors" << endl;
 
   // init some infrastructure
   vector<string> characters {"A", "C", "G", "T"};
   Track trk("NUKES", characters);
-  vector<Sequences> qry_seq_list(GetSeqs(args, &trk));
   GermLines gl(args.datadir());
-  HMMHolder hmms(args.hmmdir(), gl);
-  // hmms.CacheAll();
 
+  if(args.worker()) {
+    RunWorker(args, gl, &trk);
+  } else {
+    HMMHolder hmms(args.hmmdir(), gl);
+    // hmms.CacheAll();
+    RunJob(args, gl, hmms, &trk, args.algorithm(), args.outfile());
+  }
+
+  return 0;
+}
+
+// ----------------------------------------------------------------------------------------
+// read jobs from stdin until it closes (or we get "exit"), keeping one HMMHolder for each hmm directory so each model only gets parsed once
+void RunWorker(Args &args, GermLines &gl, Track *trk) {
+  map<string, HMMHolder*> hmm_holders;
+  string line;
+  while(getline(cin, line)) {
+    stringstream ss(line);
+    string algorithm, hmmdir, infname, outfname;
+    ss >> algorithm >> hmmdir >> infname >> outfname;
+    if(algorithm == "exit")
+      break;
+    if((algorithm != "viterbi" && algorithm != "forward") || outfname == "")
+      throw runtime_error("ERROR couldn't understand worker job '" + line + "'");
+    if(hmm_holders.find(hmmdir) == hmm_holders.end())
+      hmm_holders[hmmdir] = new HMMHolder(hmmdir, gl);
+    args.ReadInfile(infname);
+    RunJob(args, gl, *hmm_holders[hmmdir], trk, algorithm, outfname);
+    cout << "bcrham-done " << outfname << endl;  // let the driver know it can read <outfname> (endl also flushes)
+  }
+
+  for(auto & entry : hmm_holders)
+    delete entry.second;
+}
+
+// ----------------------------------------------------------------------------------------
+// run <algorithm> on the queries that were read into <args> and write the results to <outfname>
+void RunJob(Args &args, GermLines &gl, HMMHolder &hmms, Track *trk, string algorithm, string outfname) {
+  bool binary_output(args.binary_io() && algorithm == "forward");  // viterbi output is always csv
+  vector<double> binary_scores;
+  vector<uint8_t> binary_errors;
+
+  // write csv output headers
+  ofstream ofs;
+  if(!binary_output) {
+    ofs.open(outfname);
+    assert(ofs.is_open());
+    if(algorithm == "viterbi")
+      ofs << "unique_ids,v_gene,d_gene,j_gene,fv_insertion,vd_insertion,dj_insertion,jf_insertion,v_5p_del,v_3p_del,d_5p_del,d_3p_del,j_5p_del,j_3p_del,score,seqs,errors" << endl;
+    else
+      ofs << "unique_ids,score,errors" << endl;
+  }
+
+  vector<Sequences> qry_seq_list(GetSeqs(args, trk));
   for(size_t iqry = 0; iqry < qry_seq_list.size(); iqry++) {
     if(args.debug()) cout << "  ---------" << endl;
     KSet kmin(args.integers_["k_v_min"][iqry], args.integers_["k_d_min"][iqry]);
@@ -177,74 +346,65 @@ int main(int argc, const char * argv[]) {
     KBounds kbounds(kmin, kmax);
     Sequences qry_seqs(qry_seq_list[iqry]);
 
-    JobHolder jh(gl, hmms, args.algorithm(), args.str_lists_["only_genes"][iqry]);
+    JobHolder jh(gl, hmms, algorithm, args.str_lists_["only_genes"][iqry]);
     jh.SetDebug(args.debug());
     jh.SetChunkCache(args.chunk_cache());
     jh.SetNBestEvents(args.n_best_events());
 
-    Result result(kbounds);
-    vector<Result> denom_results(qry_seqs.n_seqs(), result);  // only used for forward if n_seqs > 1
-    double numerator(-INFINITY);  // numerator in P(A,B,C,...) / (P(A)P(B)P(C)...)
-    double bayes_factor(-INFINITY); // final result
-    vector<double> single_scores(qry_seqs.n_seqs(), -INFINITY);  // NOTE log probs, not scores, but I haven't managed to finish switching over to the new terminology
-    bool stop(false);
+    double bayes_factor(-INFINITY);  // log of P(A,B,C,...) / (P(A)P(B)P(C)...) for forward (or just the total score, for single sequences or viterbi)
     string errors;
-    do {
-      errors = "";
-      // clock_t run_start(clock());
-      if(args.debug()) cout << "       ----" << endl;
-      result = jh.Run(qry_seqs, kbounds);
-      numerator = result.total_score();
-      bayes_factor = numerator;
-      if(args.algorithm() == "forward" && qry_seqs.n_seqs() > 1) {  // calculate factors for denominator
-        for(size_t iseq = 0; iseq < qry_seqs.n_seqs(); ++iseq) {
-          denom_results[iseq] = jh.Run(qry_seqs[iseq], kbounds);  // result for a single sequence
-          single_scores[iseq] = denom_results[iseq].total_score();
-          bayes_factor -= single_scores[iseq];
-        }
-      }
+    Result result(jh.RunWithExpansion(qry_seqs, kbounds, &bayes_factor, &errors));
 
-      kbounds = result.better_kbounds();
-      for(auto & res : denom_results)
-        kbounds = kbounds.LogicalOr(res.better_kbounds());
-
-      stop = !result.boundary_error() || result.could_not_expand();  // stop if the max is not on the boundary, or if the boundary's at zero or the sequence length
-      for(auto & res : denom_results)
-        stop &= !res.boundary_error() || res.could_not_expand();
-      if(args.debug() && !stop)
-        cout << "      expand and run again" << endl;  // note that subsequent runs are much faster than the first one because of chunk caching
-      // cout << "      time " << ((clock() - run_start) / (double)CLOCKS_PER_SEC) << endl;
-      if(result.boundary_error())
-        errors = "boundary";
-      for(auto & res : denom_results) // NOTE <errors> will still just have one "boundary" in it even if multiple results had boundary errors
-        if(res.boundary_error())
-          errors = "boundary";
-    } while(!stop);
-
-    // if(result.could_not_expand())
-    //   cout << "WARNING " << qry_seqs.name_str() << " couldn't expand k bounds for " << kbounds.stringify() << endl;
-    // if(single_result.boundary_error())
-    //   cout << "WARNING boundary errors for " << qry_seqs[iseq].name() << " when together with " << qry_seqs.name_str() << endl;
-
-    if(args.debug() && args.algorithm() == "forward" && qry_seqs.n_seqs() > 1)
-      print_forward_scores(numerator, single_scores, bayes_factor);
-
-    if(args.algorithm() == "viterbi" && size_t(args.n_best_events()) > result.events_.size()) {   // if we were asked for more events than we found
+    if(algorithm == "viterbi" && size_t(args.n_best_events()) > result.events_.size()) {   // if we were asked for more events than we found
       if(result.events_.size() > 0)
         cout << "WARNING asked for " << args.n_best_events() << " events but only found " << result.events_.size() << endl;
       else
         assert(result.no_path_);  // if there's some *other* way we can end up with no events, I want to know about it
     }
-    StreamOutput(ofs, args, result.events_, qry_seqs, bayes_factor, errors);
+    if(binary_output) {
+      binary_scores.push_back(bayes_factor);
+      binary_errors.push_back(errors == "boundary" ? 1 : 0);
+    } else {
+      StreamOutput(ofs, args, algorithm, result.events_, qry_seqs, bayes_factor, errors);
+    }
   }
 
+  if(binary_output)
+    WriteBinaryForwardOutput(outfname, args, binary_scores, binary_errors);
+  else
+    ofs.close();
+}
+
+// ----------------------------------------------------------------------------------------
+// write forward scores in the binary columnar format (see python/hmmbinary.py), with one entry in <scores> and <errors> for each query set in <args>
+void WriteBinaryForwardOutput(string outfname, Args &args, vector<double> &scores, vector<uint8_t> &errors) {
+  assert(scores.size() == args.name_ids_.size() && errors.size() == scores.size());
+  ofstream ofs(outfname, ios::binary);
+  if(!ofs.is_open())
+    throw runtime_error("ERROR couldn't open binary output file " + outfname);
+  ofs.write("BCRHAMO1", 8);
+  WriteTable(ofs, args.name_table_);
+  uint32_t n_records(scores.size());
+  ofs.write(reinterpret_cast<char*>(&n_records), sizeof(n_records));
+  vector<uint16_t> n_seqs;
+  vector<uint32_t> name_ids;
+  for(auto & ids : args.name_ids_) {
+    n_seqs.push_back(ids.size());
+    name_ids.insert(name_ids.end(), ids.begin(), ids.end());
+  }
+  if(n_records > 0) {
+    ofs.write(reinterpret_cast<char*>(&n_seqs[0]), n_records * sizeof(uint16_t));
+    ofs.write(reinterpret_cast<char*>(&scores[0]), n_records * sizeof(double));
+    ofs.write(reinterpret_cast<char*>(&errors[0]), n_records * sizeof(uint8_t));
+  }
+  if(name_ids.size() > 0)
+    ofs.write(reinterpret_cast<char*>(&name_ids[0]), name_ids.size() * sizeof(uint32_t));
   ofs.close();
-  return 0;
 }
 
 // ----------------------------------------------------------------------------------------
-void StreamOutput(ofstream &ofs, Args &args, vector<RecoEvent> &events, Sequences &seqs, double total_score, string errors) {
-  if(args.algorithm() == "viterbi") {
+void StreamOutput(ofstream &ofs, Args &args, string algorithm, vector<RecoEvent> &events, Sequences &seqs, double total_score, string errors) {
+  if(algorithm == "viterbi") {
     size_t n_max = min(size_t(args.n_best_events()), events.size());
     for(size_t ievt = 0; ievt < n_max; ++ievt) {
       RecoEvent *event = &events[ievt];
@@ -277,12 +437,3 @@ void StreamOutput(ofstream &ofs, Args &args, vector<RecoEvent> &events, Sequence
         << endl;
   }
 }
-// ----------------------------------------------------------------------------------------
-void print_forward_scores(double numerator, vector<double> single_scores, double bayes_factor) {
-  printf("   %8.3f = ", bayes_factor);
-  printf("%2s %8.2f", "", numerator);
-  for(auto & score : single_scores)
-    printf(" - %8.2f", score);
-  printf("\n");
-}
-
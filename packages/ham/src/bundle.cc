@@ -0,0 +1,88 @@
+#include "bundle.h"
+
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <cmath>
+
+namespace ham {
+
+// ----------------------------------------------------------------------------------------
+string BundleReader::ReadString() {
+  uint16_t length(Read<uint16_t>());
+  Check(length);
+  string str(data_ + pos_, length);
+  pos_ += length;
+  return str;
+}
+
+// ----------------------------------------------------------------------------------------
+ModelBundle::ModelBundle(string fname) : fname_(fname), data_(nullptr), size_(0) {
+  uint16_t one(1);
+  if(*reinterpret_cast<uint8_t*>(&one) != 1)
+    throw runtime_error("ERROR hmm bundles are little-endian, but this machine isn't");
+  int fd(open(fname.c_str(), O_RDONLY));
+  if(fd < 0)
+    throw runtime_error("ERROR couldn't open hmm bundle " + fname);
+  struct stat st;
+  if(fstat(fd, &st) != 0) {
+    close(fd);
+    throw runtime_error("ERROR couldn't stat hmm bundle " + fname);
+  }
+  size_ = st.st_size;
+  void *mapped(size_ > 0 ? mmap(nullptr, size_, PROT_READ, MAP_SHARED, fd, 0) : MAP_FAILED);
+  close(fd);  // the mapping stays valid
+  if(mapped == MAP_FAILED)
+    throw runtime_error("ERROR couldn't map hmm bundle " + fname);
+  data_ = static_cast<const char*>(mapped);
+
+  try {
+    BundleReader reader(data_, size_, fname);
+    string magic;
+    for(size_t ic = 0; ic < 8; ++ic)
+      magic += reader.Read<char>();
+    if(magic == "HAMBNDL1")  // older format without the yaml stats, so leave the index empty and read everything from the yamls (NOTE also in python/hmmbundle.py)
+      return;
+    if(magic != "HAMBNDL2")
+      throw runtime_error("ERROR " + fname + " isn't an hmm bundle");
+    uint32_t n_models(reader.Read<uint32_t>());
+    for(size_t imodel = 0; imodel < n_models; ++imodel) {
+      string name(reader.ReadString());
+      uint64_t offset(reader.Read<uint64_t>());
+      uint64_t size(reader.Read<uint64_t>());
+      uint64_t yaml_size(reader.Read<uint64_t>());
+      double yaml_mtime(reader.Read<double>());
+      if(offset + size > size_)
+        throw runtime_error("ERROR record for " + name + " runs off the end of " + fname);
+      index_[name] = pair<uint64_t, uint64_t>(offset, size);
+      yaml_stats_[name] = pair<uint64_t, double>(yaml_size, yaml_mtime);
+    }
+  } catch(...) {
+    munmap(const_cast<char*>(data_), size_);  // destructor doesn't get called if we throw from the constructor
+    throw;
+  }
+}
+
+// ----------------------------------------------------------------------------------------
+ModelBundle::~ModelBundle() {
+  munmap(const_cast<char*>(data_), size_);
+}
+
+// ----------------------------------------------------------------------------------------
+bool ModelBundle::IsStale(string name, string fname) {
+  struct stat st;
+  if(stat(fname.c_str(), &st) != 0)  // no file, so nothing to be out of date with
+    return false;
+  double mtime((double)st.st_mtim.tv_sec + (double)st.st_mtim.tv_nsec * 1e-9);  // same as python's os.stat() (to within rounding, which is why we don't test for equality)
+  return (uint64_t)st.st_size != yaml_stats_[name].first || fabs(mtime - yaml_stats_[name].second) > 1e-6;
+}
+
+// ----------------------------------------------------------------------------------------
+BundleReader ModelBundle::Record(string name) {
+  if(!Has(name))
+    throw runtime_error("ERROR no model " + name + " in " + fname_);
+  return BundleReader(data_ + index_[name].first, index_[name].second, name + " in " + fname_);
+}
+
+}
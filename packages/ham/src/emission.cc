@@ -15,14 +15,29 @@ Emission::~Emission() {
 
 // ----------------------------------------------------------------------------------------
 void Emission::Parse(YAML::Node config, Tracks model_tracks) {
-  scores_.Init();
-  tracks_ = new vector<Track*>();  // list of the tracks used by *this* emission. Note that this may not be all the tracks used in the model.
   Track *tk(model_tracks.track(config["track"].as<string>()));
   assert(tk);  // assures we actualy found the track in model_tracks
+  YAML::Node yprobs(config["probs"]);
+  if(yprobs.size() != tk->alphabet_size())
+    throw runtime_error("ERROR emission probabilities (" + to_string(yprobs.size()) + ") not the same length as the alphavet passed to lexical table constructor (" + to_string(tk->alphabet_size()) + "). Yes, a v! Hobgoblins and smallness, yo.");
+  vector<double> probs;
+  for(size_t ip = 0; ip < tk->alphabet_size(); ++ip)
+    probs.push_back(yprobs[tk->symbol(ip)].as<double>());  // NOTE probs are stored as dicts in the file, so <yprobs> is unordered
+  try {
+    SetProbs(tk, probs);
+  } catch(...) {
+    cerr << config << endl;
+    throw;
+  }
+}
+
+// ----------------------------------------------------------------------------------------
+void Emission::SetProbs(Track *tk, vector<double> probs) {
+  scores_.Init();
+  tracks_ = new vector<Track*>();  // list of the tracks used by *this* emission. Note that this may not be all the tracks used in the model.
   tracks_->push_back(tk);
   scores_.AddTrack(tk, 0);
 
-  YAML::Node probs(config["probs"]);
   if(probs.size() != scores_.alphabet_size(0))
     throw runtime_error("ERROR emission probabilities (" + to_string(probs.size()) + ") not the same length as the alphavet passed to lexical table constructor (" + to_string(scores_.alphabet_size(0)) + "). Yes, a v! Hobgoblins and smallness, yo.");
   if(scores_.alphabet_size(0) != tk->alphabet_size())
@@ -30,13 +45,11 @@ void Emission::Parse(YAML::Node config, Tracks model_tracks) {
   vector<double> log_probs;
   total_ = 0.0; // make sure things add to 1.0
   for(size_t ip = 0; ip < scores_.alphabet_size(0); ++ip) {
-    double prob(probs[tk->symbol(ip)].as<double>());  // NOTE probs are stored as dicts in the file, so <probs> is unordered
-    log_probs.push_back(log(prob));
-    total_ += prob;
+    log_probs.push_back(log(probs[ip]));
+    total_ += probs[ip];
   }
   if(fabs(total_ - 1.0) >= EPS) { // make sure emissions probs sum to 1.0
     cerr << "ERROR normalization failed for emissions:" << endl;
-    cerr << config << endl;
     throw runtime_error("configuration");
   }
   scores_.AddColumn(log_probs);  // NOTE <log_probs> must already be logged
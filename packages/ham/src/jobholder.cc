@@ -38,15 +38,21 @@ void Result::check_boundaries(KSet best, KBounds kbounds) {
     could_not_expand_ = true;
 }
 
+// ----------------------------------------------------------------------------------------
+HMMHolder::HMMHolder(string hmm_dir, GermLines &gl): hmm_dir_(hmm_dir), gl_(gl), bundle_(nullptr) {
+  string bundle_fname(hmm_dir_ + "/bundle.bin");  // NOTE name is also set in python/hmmbundle.py
+  if(ifstream(bundle_fname))
+    bundle_ = new ModelBundle(bundle_fname);
+}
+
 // ----------------------------------------------------------------------------------------
 void HMMHolder::CacheAll() {
   for(auto & region : gl_.regions_) {
     for(auto & gene : gl_.names_[region]) {
       string infname(hmm_dir_ + "/" + gl_.SanitizeName(gene) + ".yaml");
-      if(ifstream(infname)) {
+      if((bundle_ && bundle_->Has(gl_.SanitizeName(gene))) || ifstream(infname)) {
         cout << "    read " << infname << endl;
-        hmms_[gene] = new Model;
-        hmms_[gene]->Parse(infname);
+        hmms_[gene] = Read(gene);
       }
     }
   }
@@ -54,19 +60,31 @@ void HMMHolder::CacheAll() {
 
 // ----------------------------------------------------------------------------------------
 Model *HMMHolder::Get(string gene, bool debug) {
-  if(hmms_.find(gene) == hmms_.end()) {   // if we don't already have it, read it from disk
-    hmms_[gene] = new Model;
-    string infname(hmm_dir_ + "/" + gl_.SanitizeName(gene) + ".yaml");
-    // if (true) cout << "    read " << infname << endl;
-    hmms_[gene]->Parse(infname);
-  }
+  lock_guard<mutex> lock(mutex_);
+  if(hmms_.find(gene) == hmms_.end())   // if we don't already have it, read it from disk
+    hmms_[gene] = Read(gene);
   return hmms_[gene];
 }
 
+// ----------------------------------------------------------------------------------------
+Model *HMMHolder::Read(string gene) {
+  Model *hmm(new Model);
+  string name(gl_.SanitizeName(gene));
+  string infname(hmm_dir_ + "/" + name + ".yaml");
+  if(bundle_ && bundle_->Has(name) && !bundle_->IsStale(name, infname)) {  // if someone's rewritten the yaml since the bundle was made, use the yaml
+    BundleReader reader(bundle_->Record(name));
+    hmm->Parse(reader);
+  } else {
+    hmm->Parse(infname);
+  }
+  return hmm;
+}
+
 // ----------------------------------------------------------------------------------------
 HMMHolder::~HMMHolder() {
   for(auto & entry : hmms_)
     delete entry.second;
+  delete bundle_;
 }
 
 // ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -225,6 +243,63 @@ Result JobHolder::Run(Sequences seqs, KBounds kbounds) {
   return result;
 }
 
+// ----------------------------------------------------------------------------------------
+// Run on <seqs>, and keep re-running with expanded k bounds until the best kset isn't on the boundary (or the bounds can't be expanded).
+// For forward with more than one sequence, also runs each sequence on its own, and sets <score> to log P(A,B,...) / (P(A)P(B)...), otherwise
+// it's just the total score. <errors> is set to "boundary" if the final run still had boundary errors.
+Result JobHolder::RunWithExpansion(Sequences &seqs, KBounds kbounds, double *score, string *errors) {
+  Result result(kbounds);
+  vector<Result> denom_results(seqs.n_seqs(), result);  // only used for forward if n_seqs > 1
+  double numerator(-INFINITY);  // numerator in P(A,B,C,...) / (P(A)P(B)P(C)...)
+  double bayes_factor(-INFINITY); // final result
+  vector<double> single_scores(seqs.n_seqs(), -INFINITY);  // NOTE log probs, not scores, but I haven't managed to finish switching over to the new terminology
+  bool stop(false);
+  do {
+    *errors = "";
+    if(debug_) cout << "       ----" << endl;
+    result = Run(seqs, kbounds);
+    numerator = result.total_score();
+    bayes_factor = numerator;
+    if(algorithm_ == "forward" && seqs.n_seqs() > 1) {  // calculate factors for denominator
+      for(size_t iseq = 0; iseq < seqs.n_seqs(); ++iseq) {
+        denom_results[iseq] = Run(seqs[iseq], kbounds);  // result for a single sequence
+        single_scores[iseq] = denom_results[iseq].total_score();
+        bayes_factor -= single_scores[iseq];
+      }
+    }
+
+    kbounds = result.better_kbounds();
+    for(auto & res : denom_results)
+      kbounds = kbounds.LogicalOr(res.better_kbounds());
+
+    stop = !result.boundary_error() || result.could_not_expand();  // stop if the max is not on the boundary, or if the boundary's at zero or the sequence length
+    for(auto & res : denom_results)
+      stop &= !res.boundary_error() || res.could_not_expand();
+    if(debug_ && !stop)
+      cout << "      expand and run again" << endl;  // note that subsequent runs are much faster than the first one because of chunk caching
+    if(result.boundary_error())
+      *errors = "boundary";
+    for(auto & res : denom_results) // NOTE <errors> will still just have one "boundary" in it even if multiple results had boundary errors
+      if(res.boundary_error())
+        *errors = "boundary";
+  } while(!stop);
+
+  if(debug_ && algorithm_ == "forward" && seqs.n_seqs() > 1)
+    PrintForwardScores(numerator, single_scores, bayes_factor);
+
+  *score = bayes_factor;
+  return result;
+}
+
+// ----------------------------------------------------------------------------------------
+void JobHolder::PrintForwardScores(double numerator, vector<double> single_scores, double bayes_factor) {
+  printf("   %8.3f = ", bayes_factor);
+  printf("%2s %8.2f", "", numerator);
+  for(auto & score : single_scores)
+    printf(" - %8.2f", score);
+  printf("\n");
+}
+
 // ----------------------------------------------------------------------------------------
 void JobHolder::FillTrellis(Sequences query_seqs, vector<string> query_strs, string gene, double *score, string &origin) {
   *score = -INFINITY;
@@ -68,19 +68,60 @@ void Model::Parse(string infname) {
       throw;
     }
 
-    if(st->name() == "init") {
-      initial_ = st;
-      states_by_name_[st->name()] = st;
-    } else {
-      assert(states_.size() < STATE_MAX);
-      states_.push_back(st);
-      states_by_name_[st->name()] = st;
-    }
+    AddParsedState(st);
   }
 
   Finalize(); // post process states and/to create an end state with only transitions-from
 }
 
+// ----------------------------------------------------------------------------------------
+void Model::Parse(BundleReader &reader) {
+  name_ = reader.ReadString();
+  overall_prob_ = reader.Read<double>();
+
+  uint16_t n_tracks(reader.Read<uint16_t>());
+  for(size_t it = 0; it < n_tracks; ++it) {
+    Track *trk = new Track;
+    trk->set_name(reader.ReadString());
+    uint16_t n_symbols(reader.Read<uint16_t>());
+    for(size_t ic = 0; ic < n_symbols; ++ic)
+      trk->AddSymbol(reader.ReadString());
+    tracks_.push_back(trk);
+  }
+
+  // state names are all up front, so transitions can refer to them by index
+  vector<string> state_names;
+  uint16_t n_states(reader.Read<uint16_t>());
+  for(size_t is = 0; is < n_states; ++is) {
+    string name(reader.ReadString());
+    if(find(state_names.begin(), state_names.end(), name) != state_names.end())
+      throw runtime_error("ERROR added two states with name '" + name + "' in " + reader.description());
+    state_names.push_back(name);
+  }
+
+  for(size_t ist = 0; ist < state_names.size(); ++ist) {
+    State *st(new State);
+    st->Parse(reader, state_names, tracks_);
+    if(st->name() != state_names[ist])
+      throw runtime_error("ERROR state '" + st->name() + "' out of order in " + reader.description());
+    AddParsedState(st);
+  }
+
+  Finalize();
+}
+
+// ----------------------------------------------------------------------------------------
+void Model::AddParsedState(State *st) {
+  if(st->name() == "init") {
+    initial_ = st;
+    states_by_name_[st->name()] = st;
+  } else {
+    assert(states_.size() < STATE_MAX);
+    states_.push_back(st);
+    states_by_name_[st->name()] = st;
+  }
+}
+
 // ----------------------------------------------------------------------------------------
 void Model::AddState(State* state) {
   assert(states_.size() < STATE_MAX);
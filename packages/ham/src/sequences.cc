@@ -20,6 +20,19 @@ Sequence::Sequence(Track* trk, string name, string &undigitized, size_t pos, siz
   Digitize();
 }
 
+// ----------------------------------------------------------------------------------------
+Sequence::Sequence(Track* trk, string name, vector<uint8_t> &digitized):
+  name_(name),
+  track_(trk) {
+  seq_ = new vector<uint8_t>(digitized);
+  undigitized_.reserve(digitized.size());
+  for(auto & value : digitized) {
+    if(value >= track_->alphabet_size())
+      throw runtime_error("ERROR digitized value " + to_string(int(value)) + " out of range for track " + track_->name() + " in sequence " + name_);
+    undigitized_ += track_->symbol(value);
+  }
+}
+
 // ----------------------------------------------------------------------------------------
 Sequence::Sequence(Sequence &rhs, size_t pos, size_t len) {
   name_ = rhs.name_;
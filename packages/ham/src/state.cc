@@ -18,14 +18,66 @@ void State::Parse(YAML::Node node, vector<string> state_names, Tracks trks) {
   name_ = node["name"].as<string>();
   assert(name_.size() > 0);
 
+  vector<pair<string, double> > to_states;
+  for(YAML::const_iterator it = node["transitions"].begin(); it != node["transitions"].end(); ++it)
+    to_states.push_back(pair<string, double>(it->first.as<string>(), it->second.as<double>()));
+  try {
+    AddTransitions(to_states, state_names);
+  } catch(...) {
+    cerr << node << endl;
+    throw;
+  }
+
+  // emissions
+  if(name_ == "init")
+    return;
+
+  // make sure at least one emission was specified
+  if(node["emissions"].IsNull()) {
+    stringstream node_ss;
+    node_ss << node;
+    throw runtime_error("ERROR no emissions found in " + node_ss.str());
+  }
+  emission_.Parse(node["emissions"], trks);
+}
+
+// ----------------------------------------------------------------------------------------
+void State::Parse(BundleReader &reader, vector<string> state_names, Tracks trks) {
+  name_ = reader.ReadString();
+  assert(name_.size() > 0);
+
+  vector<pair<string, double> > to_states;
+  uint16_t n_transitions(reader.Read<uint16_t>());
+  for(size_t it = 0; it < n_transitions; ++it) {
+    uint16_t ito(reader.Read<uint16_t>());  // index in <state_names>, or 0xFFFF for 'end'
+    if(ito != 0xFFFF && ito >= state_names.size())
+      throw runtime_error("ERROR transition to state index " + to_string(ito) + " out of range in " + reader.description());
+    to_states.push_back(pair<string, double>(ito == 0xFFFF ? "end" : state_names[ito], reader.Read<double>()));
+  }
+  AddTransitions(to_states, state_names);
+
+  bool has_emission(reader.Read<uint8_t>());
+  if(name_ == "init")
+    return;
+  if(!has_emission)
+    throw runtime_error("ERROR no emissions found for state " + name_ + " in " + reader.description());
+  Track *tk(trks.track(reader.ReadString()));
+  vector<double> probs(reader.Read<uint16_t>());
+  for(size_t ip = 0; ip < probs.size(); ++ip)
+    probs[ip] = reader.Read<double>();
+  emission_.SetProbs(tk, probs);
+}
+
+// ----------------------------------------------------------------------------------------
+void State::AddTransitions(vector<pair<string, double> > &to_states, vector<string> &state_names) {
   double total(0.0); // make sure things add to 1.0
-  for(YAML::const_iterator it = node["transitions"].begin(); it != node["transitions"].end(); ++it) {
-    string to_state(it->first.as<string>());
+  for(auto &to_state_prob : to_states) {
+    string to_state(to_state_prob.first);
     if(to_state != "end" && find(state_names.begin(), state_names.end(), to_state) == state_names.end()) {   // make sure transition is either to "end", or to a state that we know about
       cout << "ERROR attempted to add transition to unknown state \"" << to_state << "\"" << endl;
       throw runtime_error("configuration");
     }
-    double prob(it->second.as<double>());
+    double prob(to_state_prob.second);
     total += prob;
     Transition *trans = new Transition(to_state, prob);
     if(trans->to_state_name() == "end")
@@ -36,21 +88,8 @@ void State::Parse(YAML::Node node, vector<string> state_names, Tracks trks) {
   // NOTE it would be better to use something cleverer than a hard coded EPS that I just pulled ooma
   if(fabs(total - 1.0) >= EPS) { // make sure transition probs sum to 1.0
     cerr << "ERROR normalization failed on transitions in state \"" << name_ << "\"" << endl;
-    cerr << node << endl;
     throw runtime_error("configuration");
   }
-
-  // emissions
-  if(name_ == "init")
-    return;
-
-  // make sure at least one emission was specified
-  if(node["emissions"].IsNull()) {
-    stringstream node_ss;
-    node_ss << node;
-    throw runtime_error("ERROR no emissions found in " + node_ss.str());
-  }
-  emission_.Parse(node["emissions"], trks);
 }
 
 // ----------------------------------------------------------------------------------------
@@ -0,0 +1,110 @@
+""" Greedy agglomerative clustering using multi-sequence forward scores """
+
+# ----------------------------------------------------------------------------------------
+class Agglomerator(object):
+    """
+    Start with each query in its own cluster, and repeatedly merge pairs of clusters with the best likelihood ratio
+        log P(A+B) - log P(A) - log P(B) = score(A+B) - score(A) - score(B)
+    where score(X) is bcrham's forward score for the set X, i.e. log P(X together) / prod P(each member alone) (which is zero for single queries).
+    Scores for every set we've seen are cached, so each merge only needs new forward runs for the merged cluster together with each of its
+    remaining candidate partners. Clusters are only candidate partners if they were linked (ratio above <threshold>) to one of the merged clusters,
+    so the number of hmm calls grows with the number of merges rather than with the number of pairs.
+    The caller alternates between running bcrham on get_missing_sets() (and passing the results to add_set_scores()) and calling merge(), until
+    merge() returns zero.
+    """
+    def __init__(self, threshold, queries, pairscores):
+        """ <pairscores> is a PairScores with the k=2 forward scores (e.g. from the Clusterer that clustered them) """
+        self.threshold = threshold
+        self.set_scores = {}  # map from frozenset of query names to its forward score
+        self.neighbors = {}  # map from each current cluster (frozenset of query names) to the set of clusters it might be merged with
+        for query in queries:
+            self.add_cluster(frozenset([query]))
+        for id_a, id_b, score in pairscores.iteritems():
+            cluster_a, cluster_b = frozenset([id_a]), frozenset([id_b])
+            self.add_cluster(cluster_a)
+            self.add_cluster(cluster_b)
+            self.set_scores[cluster_a | cluster_b] = score
+            if score > self.threshold:
+                self.neighbors[cluster_a].add(cluster_b)
+                self.neighbors[cluster_b].add(cluster_a)
+        self.n_merges = 0
+        self.n_failed_sets = 0
+
+    # ----------------------------------------------------------------------------------------
+    def add_cluster(self, cluster):
+        if cluster not in self.neighbors:
+            self.neighbors[cluster] = set()
+            self.set_scores[cluster] = 0.
+
+    # ----------------------------------------------------------------------------------------
+    def get_ratio(self, cluster_a, cluster_b):
+        return self.set_scores[cluster_a | cluster_b] - self.set_scores[cluster_a] - self.set_scores[cluster_b]
+
+    # ----------------------------------------------------------------------------------------
+    def get_missing_sets(self):
+        """ return a list of the (sorted) query name lists for which we need forward scores before we can call merge() """
+        missing = set()
+        for cluster, neighbors in self.neighbors.iteritems():
+            for neighbor in neighbors:
+                if cluster | neighbor not in self.set_scores:
+                    missing.add(cluster | neighbor)
+        return [sorted(nset) for nset in missing]
+
+    # ----------------------------------------------------------------------------------------
+    def add_set_scores(self, nsets, hmminfo):
+        """
+        Add forward scores from bcrham (list of dicts with either 'unique_ids' or 'id_a' and 'id_b', plus 'score') for the sets in <nsets>.
+        Sets which didn't get a score (e.g. because of sw failures) are never merged.
+        """
+        for info in hmminfo:
+            ids = info['unique_ids'] if 'unique_ids' in info else [info['id_a'], info['id_b']]
+            self.set_scores[frozenset(ids)] = info['score']
+        for nset in nsets:
+            if frozenset(nset) not in self.set_scores:
+                self.set_scores[frozenset(nset)] = float('-inf')
+                self.n_failed_sets += 1
+
+    # ----------------------------------------------------------------------------------------
+    def merge(self, debug=False):
+        """
+        Merge each pair of clusters that are each other's best partner (so the globally best pair is always merged) and whose ratio is above
+        <threshold>. Returns the number of merges.
+        """
+        best_partners = {}  # map from cluster to (ratio, partner) for its best partner
+        for cluster, neighbors in self.neighbors.iteritems():
+            for neighbor in list(neighbors):
+                ratio = self.get_ratio(cluster, neighbor)
+                if ratio <= self.threshold:  # not worth keeping around
+                    neighbors.remove(neighbor)
+                    continue
+                if cluster not in best_partners or ratio > best_partners[cluster][0]:
+                    best_partners[cluster] = (ratio, neighbor)
+
+        n_merges = 0
+        for cluster, (ratio, partner) in best_partners.items():
+            if cluster not in self.neighbors or partner not in self.neighbors:  # already merged this round
+                continue
+            if best_partners[partner][1] != cluster:
+                continue
+            if debug:
+                print '      merging %s and %s  (%.2f)' % (':'.join([str(q) for q in cluster]), ':'.join([str(q) for q in partner]), ratio)
+            self.merge_clusters(cluster, partner)
+            n_merges += 1
+        self.n_merges += n_merges
+        return n_merges
+
+    # ----------------------------------------------------------------------------------------
+    def merge_clusters(self, cluster_a, cluster_b):
+        """ replace <cluster_a> and <cluster_b> with their union, whose candidate partners are whatever either of them was linked to """
+        merged_cluster = cluster_a | cluster_b
+        neighbors = (self.neighbors.pop(cluster_a) | self.neighbors.pop(cluster_b)) - set([cluster_a, cluster_b])
+        for neighbor in neighbors:
+            self.neighbors[neighbor].discard(cluster_a)
+            self.neighbors[neighbor].discard(cluster_b)
+            self.neighbors[neighbor].add(merged_cluster)
+        self.neighbors[merged_cluster] = neighbors
+
+    # ----------------------------------------------------------------------------------------
+    def get_clusters(self):
+        """ return the current clusters as a list of lists of query names """
+        return [sorted(cluster) for cluster in self.neighbors]
@@ -0,0 +1,31 @@
+""" Hamming distances restricted to the cdr3 """
+
+import numpy
+
+from hammer import Hammer
+
+# ----------------------------------------------------------------------------------------
+class Cdr3Hammer(Hammer):
+    """
+    Hamming distance (fraction of mismatches) between the cdr3s of query sequences, from the conserved cysteine through the conserved tryptophan as
+    found by sw. This is where sequences from different rearrangements of the same genes mostly differ, and it's short, so it's cheap.
+    Pairs with different cdr3 lengths (which can't be from the same rearrangement), or where either one has no cdr3 (e.g. sw failures), get
+    distance 1.
+    """
+    def __init__(self, seqs, sw_info, block_size=10000):
+        """ <seqs> is a dict mapping query name to sequence, and <sw_info> is Waterer.info """
+        cdr3_seqs = {}
+        for name, seq in seqs.items():
+            if name in sw_info and sw_info[name]['cdr3_length'] > 0:
+                cdr3_seqs[name] = seq[sw_info[name]['cyst_position'] : sw_info[name]['tryp_position'] + 3]
+            else:
+                cdr3_seqs[name] = ''
+        Hammer.__init__(self, cdr3_seqs, truncate=True, block_size=block_size)
+
+    # ----------------------------------------------------------------------------------------
+    def get_fractions(self, ia, ib):
+        """ Return an array of cdr3 mutation fractions between the rows in index arrays <ia> and <ib> """
+        with numpy.errstate(divide='ignore', invalid='ignore'):  # zero-length cdr3s
+            fractions = Hammer.get_fractions(self, ia, ib)
+        fractions[(self.lengths[ia] != self.lengths[ib]) | (self.lengths[ia] == 0)] = 1.
+        return fractions
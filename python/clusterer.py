@@ -1,73 +1,101 @@
 import sys
+import os
 import csv
 import math
+import heapq
+import marshal
+import tempfile
 from operator import itemgetter
 from subprocess import check_call
 
 import utils
 import plotting
 from opener import opener
+from pairscores import PairScores
 # ./venv/bin/linsim compare-clustering --true-name-column unique_id --inferred-name-column unique_id  --true-group-column reco_id --inferred-group-column reco_id /tmp/dralph/true.csv /tmp/dralph/inf.csv
 
 class Clusterer(object):
     # ----------------------------------------------------------------------------------------
-    def __init__(self, threshold, greater_than=True, singletons=[]):  # put in same cluster if greater than threshold, or less than equal to?
+    def __init__(self, threshold, greater_than=True, singletons=None):  # put in same cluster if greater than threshold, or less than equal to?
         self.threshold = threshold
         self.debug = False
         self.greater_than = greater_than
         self.max_id = -1  # maximum previously used id
-        self.cluster_ids = []
-        self.query_clusters = {}  # map from query name to cluster id
+        self.cluster_ids = set()  # ids of the clusters that are currently roots (i.e. haven't been merged into another cluster)
+        self.parents = {}  # disjoint-set forest: map from cluster id to its parent cluster id (roots are their own parents)
+        self.ranks = {}  # upper bound on the height of each root's tree (union by rank)
+        self.query_clusters = {}  # map from query name to cluster id (NOTE only guaranteed to point at the root cluster id after cluster() returns -- use find_cluster() before then)
         self.id_clusters = {}  # map from cluster id to list of query names
+        if singletons is None:  # NOTE not a default argument, since finalize() appends to it
+            singletons = []
         for st in singletons:
             self.add_new_cluster(st, dbg_str_list=[])
         self.singletons = singletons
-        self.pairscores = {}  # used by external code to see if we saw a given pair
-        self.plotscores = { 'all':[], 'same':[], 'diff':[]}  # keep track of scores for plotting
+        self.pairscores = PairScores()  # used by external code to see if we saw a given pair
+        self.plotscores = { 'all':[], 'same':[], 'diff':[]}  # keep track of scores for plotting (only filled if we're actually plotting)
 
         # self.nearest_true_mate = {}  #
 
     # ----------------------------------------------------------------------------------------
-    def cluster(self, input_scores=None, infname=None, debug=False, reco_info=None, outfile=None, plotdir=''):
+    def cluster(self, input_scores=None, infname=None, debug=False, reco_info=None, outfile=None, plotdir='', max_scores_in_memory=None, workdir=None):
+        """
+        Single-linkage cluster the pairs in <input_scores> (iterable of dicts with 'id_a', 'id_b', and 'score') or in csv file <infname>.
+        If <max_scores_in_memory> is set, sort the scores out of core (see external_sort()) in temporary files in <workdir>.
+        """
         if infname is None:
             assert input_scores is not None
         else:
             assert input_scores is None  # should only specify <input_scores> *or* <infname>
-            input_scores = []
-            with opener('r')(infname) as infile:
-                reader = csv.DictReader(infile)
-                for line in reader:
-                    input_scores.append(line)
-        sorted_lines = sorted(input_scores, key=lambda k: float(k['score']))
+            input_scores = self.read_scores(infname)
+        self.add_scores(input_scores, debug=debug, reco_info=reco_info, outfile=outfile, plotdir=plotdir, max_scores_in_memory=max_scores_in_memory, workdir=workdir)
+        self.finalize(outfile=outfile, plotdir=plotdir)
+
+    # ----------------------------------------------------------------------------------------
+    def add_scores(self, input_scores, debug=False, reco_info=None, outfile=None, plotdir='', max_scores_in_memory=None, workdir=None):
+        """
+        Incorporate the links in <input_scores> into the clusters, in order of increasing score (within this batch).
+        Can be called several times (e.g. once for each independent group of queries) before finalize(): since this is single linkage, the
+        partition we end up with doesn't depend on the order in which we see the links.
+        """
+        if max_scores_in_memory is None:
+            sorted_lines = sorted(input_scores, key=lambda k: float(k['score']))
+        else:
+            sorted_lines = self.external_sort(input_scores, max_scores_in_memory, workdir)
         for line in sorted_lines:
-            a_name = line['id_a']
-            b_name = line['id_b']
-            score = float(line['score'])
-            from_same_event = -1 if (reco_info == None or a_name not in reco_info or b_name not in reco_info) else reco_info[a_name]['reco_id'] == reco_info[b_name]['reco_id']
-            dbg_str_list = ['%22s %22s   %8.3f   %d' % (a_name, b_name, score, from_same_event), ]
-            self.incorporate_into_clusters(a_name, b_name, score, dbg_str_list)
-            self.pairscores[(utils.get_key((a_name, b_name)))] = score
+            self.add_score(line['id_a'], line['id_b'], float(line['score']), debug=debug, reco_info=reco_info, outfile=outfile, plotdir=plotdir)
+
+    # ----------------------------------------------------------------------------------------
+    def add_score(self, a_name, b_name, score, debug=False, reco_info=None, outfile=None, plotdir=''):
+        """ incorporate a single link into the clusters (single linkage doesn't care what order the links come in, so scores can be streamed in one at a time) """
+        from_same_event = -1 if (reco_info == None or a_name not in reco_info or b_name not in reco_info) else reco_info[a_name]['reco_id'] == reco_info[b_name]['reco_id']
+        dbg_str_list = ['%22s %22s   %8.3f   %d' % (a_name, b_name, score, from_same_event), ]
+        self.incorporate_into_clusters(a_name, b_name, score, dbg_str_list)
+        self.pairscores.add(a_name, b_name, score)
+        if plotdir != '':
             self.plotscores['all'].append(score)
             if reco_info != None:
                 if from_same_event:
                     self.plotscores['same'].append(score)
                 else:
                     self.plotscores['diff'].append(score)
-            # if reco_info != None and reco_info[a_name]['reco_id'] == reco_info[b_name]['reco_id']:
-            #     for query,score in {a_name:score, b_name:score}.iteritems():
-            #         if query not in self.nearest_true_mate:
-            #             self.nearest_true_mate[query] = score
-            #         elif self.greater_than and score > self.nearest_true_mate[query]:
-            #             self.nearest_true_mate[query] = score
-            #         elif not self.greater_than and score < self.nearest_true_mate[query]:
-            #             self.nearest_true_mate[query] = score
-            if debug:
-                outstr = ''.join(dbg_str_list)
-                if outfile == None:
-                    print outstr
-                else:
-                    outfile.write(outstr + '\n')
+        # if reco_info != None and reco_info[a_name]['reco_id'] == reco_info[b_name]['reco_id']:
+        #     for query,score in {a_name:score, b_name:score}.iteritems():
+        #         if query not in self.nearest_true_mate:
+        #             self.nearest_true_mate[query] = score
+        #         elif self.greater_than and score > self.nearest_true_mate[query]:
+        #             self.nearest_true_mate[query] = score
+        #         elif not self.greater_than and score < self.nearest_true_mate[query]:
+        #             self.nearest_true_mate[query] = score
+        if debug:
+            outstr = ''.join(dbg_str_list)
+            if outfile == None:
+                print outstr
+            else:
+                outfile.write(outstr + '\n')
 
+    # ----------------------------------------------------------------------------------------
+    def finalize(self, outfile=None, plotdir=''):
+        """ make plots, fill <id_clusters> and <singletons>, and print the clusters """
         if plotdir != '':
             utils.prep_dir(plotdir + '/plots', '*.svg')
             hists = {}
@@ -78,12 +106,15 @@ class Clusterer(object):
             check_call(['./bin/makeHtml', plotdir, '3', 'null', 'svg'])
             check_call(['./bin/permissify-www', plotdir])
 
+        for query in self.query_clusters:  # flatten the forest so external code can compare cluster ids directly
+            self.query_clusters[query] = self.find_cluster(query)
         for query, cluster_id in self.query_clusters.iteritems():
             if cluster_id not in self.id_clusters:
                 self.id_clusters[cluster_id] = []
             self.id_clusters[cluster_id].append(query)
+        already_singletons = set(self.singletons)  # don't double-count the ones we were passed in __init__
         for cluster_id, queries in self.id_clusters.items():
-            if len(queries) == 1:
+            if len(queries) == 1 and queries[0] not in already_singletons:
                 self.singletons.append(queries[0])
 
         # print 'nearest',self.nearest_true_mate
@@ -95,37 +126,112 @@ class Clusterer(object):
         else:
             outfile.write(''.join(out_str_list))
 
+    # ----------------------------------------------------------------------------------------
+    def read_scores(self, infname):
+        with opener('r')(infname) as infile:
+            reader = csv.DictReader(infile)
+            for line in reader:
+                yield line
+
+    # ----------------------------------------------------------------------------------------
+    def external_sort(self, input_scores, max_scores_in_memory, workdir):
+        """
+        Generate the lines in <input_scores> in order of increasing score, holding at most <max_scores_in_memory> of them in memory at once:
+        sort chunks of that size and spill them to temporary files, then k-way merge the files.
+        Ties come out in input order, i.e. the same order as python's (stable) sorted().
+        """
+        tmpdir = tempfile.mkdtemp(prefix='cluster-sort-', dir=workdir)
+        chunkfnames = []
+        chunkfiles = []
+        try:
+            chunk = []
+            for iline, line in enumerate(input_scores):
+                chunk.append((float(line['score']), iline, line['id_a'], line['id_b']))  # <iline> breaks ties
+                if len(chunk) >= max_scores_in_memory:
+                    chunkfnames.append(self.write_sorted_chunk(chunk, tmpdir, len(chunkfnames)))
+                    chunk = []
+            if len(chunk) > 0:
+                chunkfnames.append(self.write_sorted_chunk(chunk, tmpdir, len(chunkfnames)))
+                chunk = []
+            chunkfiles = [open(fname, 'rb') for fname in chunkfnames]
+            for score, _, id_a, id_b in heapq.merge(*[self.read_sorted_chunk(chunkfile) for chunkfile in chunkfiles]):
+                yield {'id_a':id_a, 'id_b':id_b, 'score':score}
+        finally:
+            for chunkfile in chunkfiles:
+                chunkfile.close()
+            for fname in chunkfnames:
+                os.remove(fname)
+            os.rmdir(tmpdir)
+
+    # ----------------------------------------------------------------------------------------
+    def write_sorted_chunk(self, chunk, tmpdir, ichunk):
+        """ sort <chunk> and write it to a file in <tmpdir>, returning the file name """
+        chunk.sort()
+        fname = tmpdir + '/chunk-' + str(ichunk)
+        with open(fname, 'wb') as chunkfile:
+            for entry in chunk:
+                marshal.dump(entry, chunkfile)  # marshal keeps int and str query names as they were
+        return fname
+
+    # ----------------------------------------------------------------------------------------
+    def read_sorted_chunk(self, chunkfile):
+        while True:
+            try:
+                yield marshal.load(chunkfile)
+            except EOFError:
+                return
+
     # ----------------------------------------------------------------------------------------
     def add_new_cluster(self, query_name, dbg_str_list):
         dbg_str_list.append('    new cluster ' + str(query_name))
         assert query_name not in self.query_clusters
         self.max_id += 1
         self.query_clusters[query_name] = self.max_id
-        self.cluster_ids.append(self.max_id)
+        self.parents[self.max_id] = self.max_id
+        self.ranks[self.max_id] = 0
+        self.cluster_ids.add(self.max_id)
+
+    # ----------------------------------------------------------------------------------------
+    def find_root(self, cluster_id):
+        """ return the root of <cluster_id>'s tree, compressing the path along the way """
+        root = cluster_id
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[cluster_id] != root:  # point everybody we passed directly at the root
+            next_id = self.parents[cluster_id]
+            self.parents[cluster_id] = root
+            cluster_id = next_id
+        return root
+
+    # ----------------------------------------------------------------------------------------
+    def find_cluster(self, query_name):
+        """ return the (root) id of the cluster to which <query_name> currently belongs """
+        return self.find_root(self.query_clusters[query_name])
 
     # ----------------------------------------------------------------------------------------
     def merge_clusters(self, query_name, second_query_name, dbg_str_list):
-        """ move all queries with same id as <second_query_name> to <query_name>'s cluster """
-        if self.query_clusters[query_name] == self.query_clusters[second_query_name]:
+        """ merge <query_name>'s cluster with <second_query_name>'s (union by rank, so this is effectively constant time) """
+        first_cluster_id = self.find_cluster(query_name)
+        second_cluster_id = self.find_cluster(second_query_name)
+        if first_cluster_id == second_cluster_id:  # already in the same cluster
             dbg_str_list.append('     already together')
             return
-        dbg_str_list.append('     merging ' + str(self.query_clusters[query_name]) + ' and ' + str(self.query_clusters[second_query_name]))
-        first_cluster_id = self.query_clusters[query_name]
-        second_cluster_id = self.query_clusters[second_query_name]
+        dbg_str_list.append('     merging ' + str(first_cluster_id) + ' and ' + str(second_cluster_id))
 
-        if first_cluster_id == second_cluster_id:  # already in the same cluster
-            return
-        for name,cluster_id in self.query_clusters.iteritems():
-            if cluster_id == second_cluster_id:
-                self.query_clusters[name] = first_cluster_id
+        if self.ranks[first_cluster_id] < self.ranks[second_cluster_id]:  # hang the shorter tree off the taller one
+            first_cluster_id, second_cluster_id = second_cluster_id, first_cluster_id
+        self.parents[second_cluster_id] = first_cluster_id
+        if self.ranks[first_cluster_id] == self.ranks[second_cluster_id]:
+            self.ranks[first_cluster_id] += 1
+        del self.ranks[second_cluster_id]  # only need ranks for roots
 
         if second_cluster_id in self.cluster_ids:
             self.cluster_ids.remove(second_cluster_id)
         else:
             print 'oh, man, something\'s wrong'
             print 'uniqe_id,reco_id'
-            for name,cluster_id in self.query_clusters.iteritems():
-                print '%s,%d' % (name, cluster_id)
+            for name in self.query_clusters:
+                print '%s,%d' % (name, self.find_cluster(name))
             sys.exit()
 
     # ----------------------------------------------------------------------------------------
@@ -157,9 +263,9 @@ class Clusterer(object):
         if query_name in self.query_clusters and second_query_name in self.query_clusters:  # if both seqs are already in clusters
             self.merge_clusters(query_name, second_query_name, dbg_str_list)
         elif query_name in self.query_clusters:
-            self.add_to_cluster(self.query_clusters[query_name], second_query_name, dbg_str_list)
+            self.add_to_cluster(self.find_cluster(query_name), second_query_name, dbg_str_list)
         elif second_query_name in self.query_clusters:
-            self.add_to_cluster(self.query_clusters[second_query_name], query_name, dbg_str_list)
+            self.add_to_cluster(self.find_cluster(second_query_name), query_name, dbg_str_list)
         else:
             self.add_new_cluster(query_name, dbg_str_list)
             self.add_to_cluster(self.query_clusters[query_name], second_query_name, dbg_str_list)
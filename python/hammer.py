@@ -0,0 +1,139 @@
+""" Vectorized hamming distances between query sequences """
+
+import itertools
+import math
+import numpy
+
+worker_hammer = None  # Hammer for each pool worker process (set by init_worker())
+
+# ----------------------------------------------------------------------------------------
+def init_worker(matrix_fname, shape, lengths, truncate):
+    """
+    multiprocessing.Pool initializer: memory-map the sequence matrix that the parent wrote with Hammer.write_matrix(), so that work items only
+    need to contain pairs of row indices (see get_index_fractions()) rather than copies of the sequences.
+    """
+    global worker_hammer
+    worker_hammer = Hammer({}, truncate=truncate)
+    worker_hammer.lengths = lengths
+    worker_hammer.matrix = numpy.memmap(matrix_fname, dtype=numpy.uint8, mode='r', shape=shape)
+
+# ----------------------------------------------------------------------------------------
+def get_index_fractions(index_pairs):
+    """ For use with multiprocessing.Pool.map() after init_worker(): return mutation fractions for <index_pairs> (from Hammer.get_index_pairs()) """
+    return worker_hammer.get_fractions(index_pairs[:, 0], index_pairs[:, 1])
+
+# ----------------------------------------------------------------------------------------
+class Hammer(object):
+    """
+    Encode a set of sequences once into a uint8 matrix, then compute the fraction of mismatched bases for blocks of pairs at a time.
+    Sequences are right-aligned in the matrix (i.e. left-padded with zeros), so comparing two rows while ignoring padded columns is the
+    same as chopping off the left side of the longer sequence (as in --truncate-pairs).
+    """
+    def __init__(self, seqs, truncate=True, block_size=10000):
+        """ <seqs> is a dict mapping query name to sequence """
+        self.truncate = truncate
+        self.block_size = block_size  # number of pairs to compare at once (memory usage is about 3 * <block_size> * <max sequence length> bytes)
+        self.names = list(seqs.keys())
+        self.indices = {name:iname for iname, name in enumerate(self.names)}
+        self.lengths = numpy.array([len(seqs[name]) for name in self.names], dtype=numpy.int32)
+        max_length = 0 if len(self.names) == 0 else int(self.lengths.max())
+        self.matrix = numpy.zeros((len(self.names), max_length), dtype=numpy.uint8)  # zero is padding, which no nucleotide will ever be
+        for iname, name in enumerate(self.names):
+            seq = seqs[name]
+            self.matrix[iname, max_length - len(seq) : ] = numpy.frombuffer(seq, dtype=numpy.uint8)
+
+    # ----------------------------------------------------------------------------------------
+    def write_matrix(self, fname):
+        """ write the encoded sequences to <fname> for init_worker() (the shape is <self.matrix.shape>) """
+        self.matrix.tofile(fname)
+
+    # ----------------------------------------------------------------------------------------
+    def get_index_pairs(self, pairs):
+        """ Convert <pairs> (list of name pairs) to an (n, 2) array of row indices """
+        return numpy.array([(self.indices[id_a], self.indices[id_b]) for id_a, id_b in pairs], dtype=numpy.int32).reshape(len(pairs), 2)
+
+    # ----------------------------------------------------------------------------------------
+    def get_fractions(self, ia, ib):
+        """ Return an array of mutation fractions between the rows in index arrays <ia> and <ib> """
+        min_lengths = numpy.minimum(self.lengths[ia], self.lengths[ib])
+        if not self.truncate:
+            assert (self.lengths[ia] == self.lengths[ib]).all()  # utils.hamming() requires this too
+        rows_a = self.matrix[ia]
+        rows_b = self.matrix[ib]
+        mismatches = (rows_a != rows_b) & (rows_a != 0) & (rows_b != 0)  # padding only overlaps with the part we would have chopped off
+        return mismatches.sum(axis=1) / min_lengths.astype(numpy.float64)
+
+    # ----------------------------------------------------------------------------------------
+    def get_distances(self, pairs, max_score=None):
+        """
+        Return a list of {'id_a', 'id_b', 'score'} dicts for the name pairs in <pairs> (which can be an iterator).
+        If <max_score> is set, only return pairs with scores less than or equal to it.
+        """
+        return_info = []
+        pairs = iter(pairs)
+        while True:
+            block = list(itertools.islice(pairs, self.block_size))
+            if len(block) == 0:
+                break
+            index_pairs = self.get_index_pairs(block)
+            fractions = self.get_fractions(index_pairs[:, 0], index_pairs[:, 1])
+            for ipair in range(len(block)):
+                if max_score is not None and fractions[ipair] > max_score:
+                    continue
+                return_info.append({'id_a':block[ipair][0], 'id_b':block[ipair][1], 'score':float(fractions[ipair])})
+
+        return return_info
+
+    # ----------------------------------------------------------------------------------------
+    def get_block_width(self, cutoff, min_block_width=8):
+        """
+        Return the widest block such that any pair with mutation fraction at most <cutoff> is guaranteed to have at least one identical block,
+        i.e. such that for every overlap length L we can see, the number of full blocks in L is larger than the number of allowed mismatches.
+        Returns None if that would mean blocks narrower than <min_block_width> (in which case nearly everybody would share a block anyway).
+        """
+        nonzero_lengths = self.lengths[self.lengths > 0]  # empty sequences never share a block with anybody
+        if len(nonzero_lengths) == 0:
+            return None
+        min_length, max_length = int(nonzero_lengths.min()), int(nonzero_lengths.max())
+        n_max_mismatches = {length:int(math.floor(cutoff * length + 1e-9)) for length in range(min_length, max_length + 1)}  # the 1e-9 errs on the side of too many candidates
+        for block_width in range(min_length, min_block_width - 1, -1):
+            if all(length // block_width > n_max_mismatches[length] for length in n_max_mismatches):
+                return block_width
+        return None
+
+    # ----------------------------------------------------------------------------------------
+    def get_candidate_pairs(self, cutoff):
+        """
+        Generate (without duplicates) the name pairs that *could* have a mutation fraction of at most <cutoff>, without looking at all N^2 pairs.
+        Each sequence is chopped into blocks starting from the right-hand side (so blocks line up in the same way as truncated sequences), and
+        each block goes into a hash index. By the pigeonhole principle, a pair that's within <cutoff> has at least one identical block, so only
+        pairs that share a bucket in the index are candidates.
+        Returns None if <cutoff> is too large for this to be worthwhile.
+        """
+        if len(self.names) < 2:
+            return iter([])
+        block_width = self.get_block_width(cutoff)
+        if block_width is None:
+            return None
+        max_length = self.matrix.shape[1]
+        buckets = {}  # map from (block index, block contents) to list of sequence indices
+        block_keys = []  # block contents for each sequence, so we can tell if a pair has already been yielded by an earlier block
+        for iseq in range(len(self.names)):
+            keys = []
+            for iblock in range(self.lengths[iseq] // block_width):
+                stop = max_length - iblock * block_width
+                key = self.matrix[iseq, stop - block_width : stop].tobytes()
+                keys.append(key)
+                if (iblock, key) not in buckets:
+                    buckets[(iblock, key)] = []
+                buckets[(iblock, key)].append(iseq)
+            block_keys.append(keys)
+
+        def generate():
+            for (iblock, _), members in buckets.iteritems():
+                for ia, ib in itertools.combinations(members, 2):
+                    if any(block_keys[ia][jblock] == block_keys[ib][jblock] for jblock in range(iblock)):  # already yielded this pair for the first block they had in common
+                        continue
+                    yield self.names[ia], self.names[ib]
+
+        return generate()
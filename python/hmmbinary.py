@@ -0,0 +1,230 @@
+"""
+Binary columnar versions of the files we pass to and from bcrham (with --hmm-io-format binary), so neither side spends its time formatting
+and parsing text on million-pair passes. Everything is little-endian.
+
+input file:
+    'BCRHAMI1'
+    name table: uint32 n_names, then for each name uint16 length and the name's bytes
+    gene table: same as the name table, for the gene names in only_genes
+    uint32 n_records (one record for each set of queries, i.e. each line of the text format)
+    uint16 n_seqs[n_records], uint16 seq_lengths[n_records], uint16 n_genes[n_records]
+    int32 k_v_min[n_records], k_v_max[n_records], k_d_min[n_records], k_d_max[n_records]
+    uint32 name_ids[sum(n_seqs)]  (indices into the name table)
+    uint32 gene_ids[sum(n_genes)]  (indices into the gene table)
+    uint8 seqs[ceil(sum(n_seqs * seq_lengths) / 4)]  (each base as its two-bit index in bcrham's nucleotide track, i.e. in 'ACGT', four to a byte
+                                                     with the first one in the high bits, running on from one sequence to the next)
+
+forward output file:
+    'BCRHAMO1'
+    name table (the same one as in the input file)
+    uint32 n_records
+    uint16 n_seqs[n_records], float64 scores[n_records], uint8 errors[n_records] (bit 0 set for boundary errors)
+    uint32 name_ids[sum(n_seqs)]
+
+Viterbi output has lots of variable-length strings in it and is never very long, so it's still csv.
+"""
+
+import struct
+import string
+import numpy
+
+input_magic = 'BCRHAMI1'
+output_magic = 'BCRHAMO1'
+nukes = 'ACGT'  # same order as bcrham's nucleotide track
+kbound_keys = ('k_v_min', 'k_v_max', 'k_d_min', 'k_d_max')
+record_keys = ('n_seqs', 'seq_lengths', 'n_genes') + kbound_keys  # columns with one entry per record, in the order they're in the file
+encoding_table = string.maketrans(nukes + ''.join([chr(i) for i in range(256) if chr(i) not in nukes]), '\x00\x01\x02\x03' + '\xff' * (256 - len(nukes)))
+
+# ----------------------------------------------------------------------------------------
+def check_range(name, values, min_value, max_value):
+    """ make sure the numpy array <values> fits in the file's column type (which would otherwise silently wrap, and leave bcrham reading garbage) """
+    if len(values) > 0 and (values.min() < min_value or values.max() > max_value):
+        raise Exception('ERROR %s out of range for binary hmm io: %d to %d (must be between %d and %d)' % (name, values.min(), values.max(), min_value, max_value))
+
+# ----------------------------------------------------------------------------------------
+def write_table(outfile, entries):
+    outfile.write(struct.pack('<I', len(entries)))
+    for entry in entries:
+        if len(entry) > 0xffff:
+            raise Exception('ERROR name too long for binary hmm io (%d characters, max %d): %s...' % (len(entry), 0xffff, entry[:50]))
+        outfile.write(struct.pack('<H', len(entry)) + entry)
+
+# ----------------------------------------------------------------------------------------
+def read_table(infile):
+    n_entries, = struct.unpack('<I', infile.read(4))
+    entries = []
+    for _ in range(n_entries):
+        length, = struct.unpack('<H', infile.read(2))
+        entries.append(infile.read(length))
+    return entries
+
+# ----------------------------------------------------------------------------------------
+def pack_bases(codes):
+    """ pack the uint8 array <codes> (each of which is 0-3) four to a byte """
+    padded = numpy.zeros(4 * ((len(codes) + 3) // 4), dtype=numpy.uint8)
+    padded[:len(codes)] = codes
+    quads = padded.reshape(-1, 4)
+    return (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+
+# ----------------------------------------------------------------------------------------
+def unpack_bases(packed, n_bases):
+    """ inverse of pack_bases() """
+    return ((packed[:, numpy.newaxis] >> numpy.array([6, 4, 2, 0], dtype=numpy.uint8)) & 3).reshape(-1)[:n_bases]
+
+# ----------------------------------------------------------------------------------------
+def read_array(infile, dtype, count):
+    array = numpy.fromfile(infile, dtype=dtype, count=count)
+    if len(array) != count:
+        raise Exception('ERROR unexpected end of file in %s (wanted %d %s values, got %d)' % (infile.name, count, dtype, len(array)))
+    return array
+
+# ----------------------------------------------------------------------------------------
+def intify_name(name):
+    """ same as what utils.intify() does to each query name in the text format """
+    try:
+        return int(name)
+    except ValueError:
+        return name
+
+# ----------------------------------------------------------------------------------------
+def read_forward_output(fname):
+    """ generate a dict for each record in bcrham's binary forward output <fname>, with the same keys (and, once intified, values) as the csv lines """
+    with open(fname, 'rb') as infile:
+        if infile.read(len(output_magic)) != output_magic:
+            raise Exception('ERROR %s isn\'t a binary bcrham output file' % fname)
+        names = [intify_name(name) for name in read_table(infile)]  # only intify each name once, instead of every time it appears
+        n_records, = struct.unpack('<I', infile.read(4))
+        n_seqs = read_array(infile, '<u2', n_records)
+        scores = read_array(infile, '<f8', n_records)
+        errors = read_array(infile, 'u1', n_records)
+        name_ids = read_array(infile, '<u4', int(n_seqs.astype(numpy.int64).sum()))
+    name_ids = name_ids.tolist()
+    istart = 0
+    for n_seq, score, error in zip(n_seqs.tolist(), scores.tolist(), errors.tolist()):
+        yield {'unique_ids':[names[iname] for iname in name_ids[istart : istart + n_seq]], 'score':score, 'errors':('boundary' if error & 1 else '')}
+        istart += n_seq
+
+# ----------------------------------------------------------------------------------------
+class BinaryHmmInput(object):
+    """
+    Columns of a binary bcrham input file. Either add() records one at a time and then write(), or read() an existing file.
+    add() is called once for every pair on big k=2 passes, so it does as little as possible, and leaves the rest (including checking) to numpy.
+    """
+    def __init__(self):
+        self.name_indices, self.gene_indices = {}, {}  # map from each query/gene name to its index in the table
+        self.records = []  # the <record_keys> values for each add()ed record, one after another
+        self.name_ids, self.gene_ids = [], []
+        self.gene_id_lists = {}  # map from each tuple of genes we've been passed to the list of their indices
+        self.seqs = []  # sequence strings, encoded and joined when we convert to arrays
+        self.arrays = None  # numpy arrays for each column, if we were read() from a file
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.records) // len(record_keys) if self.arrays is None else len(self.arrays['n_seqs'])
+
+    # ----------------------------------------------------------------------------------------
+    def get_table(self, indices):
+        """ list of the entries in <indices>, in index order """
+        entries = [None] * len(indices)
+        for entry, index in indices.iteritems():
+            entries[index] = entry
+        return entries
+
+    # ----------------------------------------------------------------------------------------
+    def add(self, names, k_v_min, k_v_max, k_d_min, k_d_max, only_genes, seqs):
+        """ add a record for the queries <names>, all of whose sequences <seqs> must be the same length """
+        self.records += (len(names), len(seqs[0]), len(only_genes), k_v_min, k_v_max, k_d_min, k_d_max)
+        name_indices = self.name_indices
+        try:  # most queries are in lots of sets, so we've usually seen them before
+            self.name_ids += [name_indices[name] for name in names]
+        except KeyError:
+            self.name_ids += [name_indices.setdefault(name, len(name_indices)) for name in names]
+        gene_key = tuple(only_genes)  # and there aren't very many different gene lists
+        if gene_key not in self.gene_id_lists:
+            self.gene_id_lists[gene_key] = [self.gene_indices.setdefault(gene, len(self.gene_indices)) for gene in only_genes]
+        self.gene_ids += self.gene_id_lists[gene_key]
+        self.seqs += seqs
+
+    # ----------------------------------------------------------------------------------------
+    def get_arrays(self):
+        """ return a dict of numpy arrays for the columns (with the bases unpacked, as one uint8 each) """
+        if self.arrays is not None:
+            return dict(self.arrays)
+        arrays = {}
+        records = numpy.array(self.records, dtype=numpy.int64).reshape(len(self), len(record_keys))
+        for ikey, key in enumerate(record_keys):
+            if key in kbound_keys:
+                check_range(key, records[:, ikey], -2**31, 2**31 - 1)
+                arrays[key] = records[:, ikey].astype('<i4')
+            else:
+                check_range(key, records[:, ikey], 0, 0xffff)
+                arrays[key] = records[:, ikey].astype('<u2')
+        arrays['name_ids'] = numpy.array(self.name_ids, dtype='<u4')
+        arrays['gene_ids'] = numpy.array(self.gene_ids, dtype='<u4')
+        seq_lengths = numpy.fromiter((len(seq) for seq in self.seqs), dtype=numpy.int64, count=len(self.seqs))
+        if (seq_lengths != numpy.repeat(arrays['seq_lengths'], arrays['n_seqs'])).any():
+            raise Exception('ERROR sequences in the same record have different lengths')
+        encoded_seqs = ''.join(self.seqs).translate(encoding_table)
+        if '\xff' in encoded_seqs:
+            raise Exception('ERROR unexpected characters in sequences (only %s allowed)' % nukes)
+        arrays['seqs'] = numpy.frombuffer(encoded_seqs, dtype='u1')
+        return arrays
+
+    # ----------------------------------------------------------------------------------------
+    def get_costs(self):
+        """ vectorized version of PartitionDriver.estimate_hmm_cost() for every record """
+        arrays = self.get_arrays()
+        k_v_ranges = numpy.maximum(1, arrays['k_v_max'].astype(numpy.int64) - arrays['k_v_min'])
+        k_d_ranges = numpy.maximum(1, arrays['k_d_max'].astype(numpy.int64) - arrays['k_d_min'])
+        return (arrays['n_seqs'].astype(numpy.int64) * arrays['seq_lengths'] * arrays['n_genes'] * k_v_ranges * k_d_ranges).tolist()
+
+    # ----------------------------------------------------------------------------------------
+    def get_first_names(self):
+        """ name of the first query in each record """
+        arrays = self.get_arrays()
+        first_ids = arrays['name_ids'][numpy.cumsum(arrays['n_seqs'].astype(numpy.int64)) - arrays['n_seqs']]
+        names = self.get_table(self.name_indices)
+        return [names[iname] for iname in first_ids.tolist()]
+
+    # ----------------------------------------------------------------------------------------
+    def write(self, fname, irecords=None):
+        """ write the records with indices <irecords> (all of them, if not set) to <fname>, keeping the full name and gene tables """
+        arrays = self.get_arrays()
+        if irecords is not None:
+            irecords = numpy.asarray(irecords, dtype=numpy.int64)
+            for key, size_key in (('name_ids', 'n_seqs'), ('gene_ids', 'n_genes'), ('seqs', None)):
+                sizes = arrays['n_seqs'].astype(numpy.int64) * arrays['seq_lengths'] if size_key is None else arrays[size_key].astype(numpy.int64)
+                starts = numpy.cumsum(sizes) - sizes
+                positions = numpy.arange(sizes[irecords].sum(), dtype=numpy.int64) - numpy.repeat(numpy.cumsum(sizes[irecords]) - sizes[irecords], sizes[irecords]) + numpy.repeat(starts[irecords], sizes[irecords])
+                arrays[key] = arrays[key][positions]
+            for key in record_keys:
+                arrays[key] = arrays[key][irecords]
+
+        with open(fname, 'wb') as outfile:
+            outfile.write(input_magic)
+            write_table(outfile, self.get_table(self.name_indices))
+            write_table(outfile, self.get_table(self.gene_indices))
+            outfile.write(struct.pack('<I', len(arrays['n_seqs'])))
+            for key in record_keys + ('name_ids', 'gene_ids'):
+                outfile.write(arrays[key].tostring())
+            outfile.write(pack_bases(arrays['seqs']).tostring())
+
+    # ----------------------------------------------------------------------------------------
+    @classmethod
+    def read(cls, fname):
+        hmm_input = cls()
+        with open(fname, 'rb') as infile:
+            if infile.read(len(input_magic)) != input_magic:
+                raise Exception('ERROR %s isn\'t a binary bcrham input file' % fname)
+            hmm_input.name_indices = {name:iname for iname, name in enumerate(read_table(infile))}
+            hmm_input.gene_indices = {gene:igene for igene, gene in enumerate(read_table(infile))}
+            n_records, = struct.unpack('<I', infile.read(4))
+            arrays = {}
+            for key in record_keys:
+                arrays[key] = read_array(infile, '<i4' if key in kbound_keys else '<u2', n_records)
+            arrays['name_ids'] = read_array(infile, '<u4', int(arrays['n_seqs'].astype(numpy.int64).sum()))  # sum in 64 bits, not the column's 16
+            arrays['gene_ids'] = read_array(infile, '<u4', int(arrays['n_genes'].astype(numpy.int64).sum()))
+            n_bases = int((arrays['n_seqs'].astype(numpy.int64) * arrays['seq_lengths']).sum())
+            arrays['seqs'] = unpack_bases(read_array(infile, 'u1', (n_bases + 3) // 4), n_bases)
+        hmm_input.arrays = arrays
+        return hmm_input
@@ -0,0 +1,98 @@
+"""
+Compiled bundle of all the hmms in an hmm directory, so bcrham can memory-map one file (shared through the page cache by all the processes
+on a machine) and read each model's states, transitions and emissions directly, rather than parsing its yaml. The yamls are still written,
+and bcrham falls back to them for any model that isn't in the bundle, or whose yaml has changed since the bundle was written (i.e. its size
+or mtime isn't what's in the index). Everything is little-endian, and every string is a uint16 length followed by that many bytes.
+
+    'HAMBNDL2'
+    index: uint32 n_models, then for each model its name (the sanitized gene name), uint64 offset of its record from the start of the file, uint64 record size,
+           and the size (uint64) and mtime (float64 seconds, as from os.stat()) of its yaml when the bundle was written (both zero if there wasn't one)
+    records, each of which is:
+        name, float64 gene_prob
+        uint16 n_tracks, then for each track its name, uint16 n_symbols, and the symbols
+        uint16 n_states (including init), then the state names (in the same order as in the yaml)
+        then for each state:
+            name
+            uint16 n_transitions, then for each transition uint16 to-state index (0xffff for 'end') and float64 prob
+            uint8 has_emission, and if it's set the emission's track name, uint16 n_probs, and float64 probs (in the order of the track's symbols)
+"""
+
+import os
+import struct
+
+magic = 'HAMBNDL2'
+old_magics = ('HAMBNDL1', )  # formats we don't read any more (NOTE also in packages/ham/src/bundle.cc)
+bundle_fname = 'bundle.bin'  # in each hmm directory (NOTE also set in packages/ham/src/jobholder.cc)
+end_index = 0xffff
+
+# ----------------------------------------------------------------------------------------
+def pack_str(strval):
+    return struct.pack('<H', len(strval)) + strval
+
+# ----------------------------------------------------------------------------------------
+def get_record(hmm):
+    """ serialize hmmwriter.HMM <hmm> (pair emissions are left out, since bcrham doesn't use them) """
+    record = [pack_str(hmm.name), struct.pack('<d', hmm.extras.get('gene_prob', 0.))]
+    record.append(struct.pack('<H', len(hmm.tracks)))
+    for track_name, symbols in sorted(hmm.tracks.items()):
+        record.append(pack_str(track_name) + struct.pack('<H', len(symbols)) + ''.join([pack_str(symbol) for symbol in symbols]))
+
+    state_indices = {state.name : istate for istate, state in enumerate(hmm.states)}
+    record.append(struct.pack('<H', len(hmm.states)) + ''.join([pack_str(state.name) for state in hmm.states]))
+    for state in hmm.states:
+        record.append(pack_str(state.name) + struct.pack('<H', len(state.transitions)))
+        for to_state, prob in sorted(state.transitions.items()):  # sorted so the same hmm always gives the same bytes
+            record.append(struct.pack('<Hd', end_index if to_state == 'end' else state_indices[to_state], prob))
+        if state.emissions is None:
+            record.append(struct.pack('<B', 0))
+        else:
+            symbols = hmm.tracks[state.emissions['track']]
+            record.append(struct.pack('<B', 1) + pack_str(state.emissions['track']) + struct.pack('<H', len(symbols)))
+            record.append(struct.pack('<%dd' % len(symbols), *[state.emissions['probs'][symbol] for symbol in symbols]))
+
+    return ''.join(record)
+
+# ----------------------------------------------------------------------------------------
+def get_yaml_stats(yaml_fname):
+    """ size and mtime of <yaml_fname>, for bcrham to check whether a bundle record is stale """
+    if not os.path.exists(yaml_fname):
+        return 0, 0.
+    fstat = os.stat(yaml_fname)
+    return fstat.st_size, fstat.st_mtime
+
+# ----------------------------------------------------------------------------------------
+def write_bundle(fname, records):
+    """ write <records> (a dict of serialized records, keyed by model name) to <fname>, along with the stats of the corresponding yamls in the same directory """
+    names = sorted(records)
+    index_size = len(magic) + 4 + sum([2 + len(name) + 32 for name in names])
+    tmpfname = fname + '.tmp'
+    with open(tmpfname, 'wb') as outfile:
+        outfile.write(magic + struct.pack('<I', len(names)))
+        offset = index_size
+        for name in names:
+            yaml_size, yaml_mtime = get_yaml_stats(os.path.dirname(fname) + '/' + name + '.yaml')
+            outfile.write(pack_str(name) + struct.pack('<QQQd', offset, len(records[name]), yaml_size, yaml_mtime))
+            offset += len(records[name])
+        for name in names:
+            outfile.write(records[name])
+    os.rename(tmpfname, fname)  # replace rather than overwrite, so any bcrham that already has the old one mapped doesn't see it change underneath it
+
+# ----------------------------------------------------------------------------------------
+def read_records(fname):
+    """ return a dict of the serialized records in bundle <fname>, keyed by model name (empty if it's in an old format, so they all get rewritten) """
+    with open(fname, 'rb') as infile:
+        contents = infile.read()
+    if contents[:len(magic)] in old_magics:
+        return {}
+    if contents[:len(magic)] != magic:
+        raise Exception('ERROR %s isn\'t an hmm bundle' % fname)
+    n_models, = struct.unpack_from('<I', contents, len(magic))
+    pos = len(magic) + 4
+    records = {}
+    for _ in range(n_models):
+        length, = struct.unpack_from('<H', contents, pos)
+        name = contents[pos + 2 : pos + 2 + length]
+        offset, size = struct.unpack_from('<QQ', contents, pos + 2 + length)  # don't need the yaml stats, since we write new ones
+        pos += 2 + length + 32
+        records[name] = contents[offset : offset + size]
+    return records
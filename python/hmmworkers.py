@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import select
+import collections
+from subprocess import Popen, PIPE
+
+# ----------------------------------------------------------------------------------------
+class HmmWorkerPool(object):
+    """
+    Long-lived bcrham processes (run with --worker) which read jobs from their stdin.
+    Each worker only parses a given hmm yaml file the first time it needs it, so we don't pay for process startup and model
+    parsing on every pass (k=1, k=2, k=preclusters, each baum-welch iteration...).
+    """
+    def __init__(self, cmd_str, n_procs):
+        self.cmd_str = cmd_str
+        self.procs = []
+        for iproc in range(n_procs):
+            self.procs.append(Popen(cmd_str.split(), stdin=PIPE, stdout=PIPE))
+
+    # ----------------------------------------------------------------------------------------
+    def run(self, jobs):
+        """
+        Run each of <jobs>, a list of (algorithm, hmmdir, infname, outfname) tuples, handing it to the next free worker.
+        Returns once they've all finished, with a map from worker index to the list of run times of the jobs it ran.
+        """
+        worker_times = {}
+        for _ in self.iter_run(jobs, worker_times):
+            pass
+        return worker_times
+
+    # ----------------------------------------------------------------------------------------
+    def iter_run(self, jobs, worker_times):
+        """
+        Same as run(), but yield each job's output file name as soon as that job finishes, so the caller can start reading it while the others are
+        still going. Fills <worker_times> as we go.
+        """
+        pending = collections.deque(jobs)
+        busy = {}  # map from stdout file descriptor to index of the worker that's on the other end of it
+        buffers = {}  # partial lines we've read from each worker
+        idle = range(len(self.procs))
+        job_starts = {}  # map from worker index to start time of its current job
+        for iproc in idle:
+            worker_times[iproc] = []
+        finished = []  # output files of jobs that finished since we last yielded
+        while len(pending) > 0 or len(busy) > 0:
+            while len(pending) > 0 and len(idle) > 0:
+                iproc = idle.pop(0)
+                self.procs[iproc].stdin.write(' '.join(pending.popleft()) + '\n')
+                self.procs[iproc].stdin.flush()
+                busy[self.procs[iproc].stdout.fileno()] = iproc
+                job_starts[iproc] = time.time()
+            for outfname in finished:  # only yield after giving idle workers their next job, so they don't sit around while the caller reads
+                yield outfname
+            finished = []
+            readable, _, _ = select.select(busy.keys(), [], [])
+            for fd in readable:
+                data = os.read(fd, 65536)
+                if data == '':
+                    raise Exception('ERROR bcrham worker %d died (exit code %s)' % (busy[fd], self.procs[busy[fd]].wait()))
+                buffers[fd] = buffers.get(fd, '') + data
+                while '\n' in buffers[fd]:
+                    line, buffers[fd] = buffers[fd].split('\n', 1)
+                    if line.startswith('bcrham-done '):  # worker's finished its job
+                        iproc = busy.pop(fd)
+                        worker_times[iproc].append(time.time() - job_starts[iproc])
+                        idle.append(iproc)
+                        finished.append(line.replace('bcrham-done ', '', 1).strip())
+                    else:  # pass along anything else it says (e.g. debug printing)
+                        print line
+            sys.stdout.flush()
+        for outfname in finished:
+            yield outfname
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        for proc in self.procs:
+            proc.stdin.write('exit\n')
+            proc.stdin.close()
+        for proc in self.procs:
+            if proc.wait() != 0:
+                raise Exception('ERROR bcrham worker exited with code %d' % proc.returncode)
+        self.procs = []
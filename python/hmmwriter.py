@@ -3,6 +3,9 @@ import os
 import re
 import math
 import collections
+import hashlib
+import json
+import numpy
 import yaml
 from scipy.stats import norm
 import csv
@@ -10,6 +13,7 @@ import csv
 import utils
 from opener import opener
 import paramutils
+import hmmbundle
 
 # ----------------------------------------------------------------------------------------
 def get_bin_list(values, bin_type):
@@ -105,6 +109,89 @@ def interpolate_bins(values, n_max_to_interpolate, bin_eps, debug=False, max_bin
         for x in sorted(values.keys()):
             print '     %3d %f' % (x, values[x])
 
+# ----------------------------------------------------------------------------------------
+writer_version = 1  # goes into each yaml's fingerprint, so bump it whenever a change here changes what gets written (or how)
+
+# ----------------------------------------------------------------------------------------
+def get_sorted_repr(obj):
+    """ repr() of nested dicts and lists, with dict keys sorted so it doesn't depend on insertion order """
+    if isinstance(obj, dict):
+        return '{' + ', '.join(['%r: %s' % (key, get_sorted_repr(obj[key])) for key in sorted(obj)]) + '}'
+    elif isinstance(obj, (list, tuple)):
+        return '[' + ', '.join([get_sorted_repr(val) for val in obj]) + ']'
+    else:
+        return repr(obj)
+
+# ----------------------------------------------------------------------------------------
+plain_yaml_strs = {}  # cache of whether each string we've seen can be written unquoted
+def get_yaml_repr(obj):
+    """ yaml flow-style representation of nested dicts and lists of strs and numbers, the same as what yaml.dump() would give you (except for whitespace) """
+    if isinstance(obj, dict):
+        return '{' + ', '.join(['%s: %s' % (get_yaml_repr(key), get_yaml_repr(obj[key])) for key in sorted(obj)]) + '}'
+    elif isinstance(obj, (list, tuple)):
+        return '[' + ', '.join([get_yaml_repr(val) for val in obj]) + ']'
+    elif obj is None:
+        return 'null'
+    elif isinstance(obj, bool):
+        return 'true' if obj else 'false'
+    elif isinstance(obj, (int, long)):
+        return str(obj)
+    elif isinstance(obj, float):  # same as yaml.representer.SafeRepresenter.represent_float()
+        if obj != obj:
+            return '.nan'
+        elif obj in (float('inf'), -float('inf')):
+            return '.inf' if obj > 0 else '-.inf'
+        strval = repr(float(obj)).lower()
+        if '.' not in strval and 'e' in strval:  # yaml needs the dot to know it's a float
+            strval = strval.replace('e', '.0e', 1)
+        return strval
+    elif isinstance(obj, str):
+        if obj not in plain_yaml_strs:  # only write it without quotes if yaml would read it back as the same string
+            plain_yaml_strs[obj] = re.match(r'^[A-Za-z_][A-Za-z0-9_\-\.]*$', obj) is not None and yaml.resolver.Resolver().resolve(yaml.ScalarNode, obj, (True, False)) == yaml.resolver.BaseResolver.DEFAULT_SCALAR_TAG
+        return obj if plain_yaml_strs[obj] else json.dumps(obj)  # json strings are valid double-quoted yaml strings
+    else:
+        raise Exception('ERROR can\'t write %s (type %s) to yaml' % (obj, type(obj)))
+
+# ----------------------------------------------------------------------------------------
+def dump_hmm(hmm, outfile):
+    """
+    Write <hmm> to <outfile> as yaml, directly rather than with yaml.dump() (which, in pure python, takes most of the time in write_hmms).
+    Reads back (with yaml.load()) into the same HMM and State objects, and has the same tags and layout, but without line wrapping.
+    """
+    def write_attrs(obj, indent):
+        for attr, val in sorted(vars(obj).items()):
+            if attr != 'states' or len(val) == 0:
+                outfile.write('%s%s: %s\n' % (indent, attr, get_yaml_repr(val)))
+            else:
+                outfile.write('%sstates:\n' % indent)
+                for state in val:
+                    outfile.write('- !!python/object:%s.%s\n' % (type(state).__module__, type(state).__name__))
+                    write_attrs(state, '  ')
+    outfile.write('!!python/object:%s.%s\n' % (type(hmm).__module__, type(hmm).__name__))
+    write_attrs(hmm, '')
+
+# ----------------------------------------------------------------------------------------
+def write_hmm(info):
+    """
+    Write the yaml for one gene, for use with multiprocessing.Pool.map().
+    <info> has the HmmWriter arguments, plus 'old_fingerprint', the fingerprint of the existing yaml (None if there isn't one), and 'have_old_record',
+    whether the existing bundle has a record for it. If the fingerprint hasn't changed we don't rewrite the file.
+    Returns (gene, fingerprint, whether we wrote it, its hmmbundle record (None if we didn't write it)).
+    """
+    writer = HmmWriter(info['parameter_dir'], info['hmm_dir'], info['gene'], info['naivety'], info['germline_seq'], info['args'])
+    fingerprint = writer.get_fingerprint()
+    if fingerprint == info['old_fingerprint'] and info['have_old_record'] and os.path.exists(info['hmm_dir'] + '/' + writer.saniname + '.yaml'):
+        return info['gene'], fingerprint, False, None
+    writer.write()
+    return info['gene'], fingerprint, True, hmmbundle.get_record(writer.hmm)
+
+# ----------------------------------------------------------------------------------------
+nuke_index_table = numpy.full(256, -1, dtype=numpy.int8)  # index in utils.nukes of each byte value (-1 if it isn't a nuke)
+for inuke, nuke in enumerate(utils.nukes):
+    nuke_index_table[ord(nuke)] = inuke
+for nuke in 'NY':
+    nuke_index_table[ord(nuke)] = utils.nukes.index('A')  # same replacement as in HmmWriter.add_internal_state()
+
 # ----------------------------------------------------------------------------------------
 class Track(object):
     def __init__(self, name, letters):
@@ -245,7 +332,17 @@ class HmmWriter(object):
         self.add_states()
         assert os.path.exists(self.outdir)
         with opener('w')(self.outdir + '/' + self.saniname + '.yaml') as outfile:
-            yaml.dump(self.hmm, outfile, width=150)
+            dump_hmm(self.hmm, outfile)
+
+    # ----------------------------------------------------------------------------------------
+    def get_fingerprint(self):
+        """
+        Digest of everything (that we've already read from the parameter files in __init__) that goes into the yaml file, plus <writer_version>, so
+        we can tell whether an existing yaml is still up to date without actually building the hmm.
+        """
+        inputs = [writer_version, self.saniname, self.germline_seq, self.naivety, self.precision, self.insertions, self.allow_unphysical_insertions, self.args.joint_emission,
+                  self.hmm.extras['gene_prob'], self.erosion_probs, self.insertion_probs, getattr(self, 'insertion_content_probs', None), getattr(self, 'mute_freqs', None)]
+        return hashlib.sha1(get_sorted_repr(inputs)).hexdigest()
 
     # ----------------------------------------------------------------------------------------
     def add_states(self):
@@ -257,6 +354,7 @@ class HmmWriter(object):
             self.add_lefthand_insert_states(insertion)
         # then write internal states
         assert self.smallest_entry_index >= 0  # should have been set in add_region_entry_transitions
+        self.internal_emission_probs = self.get_internal_emission_probs()
         for inuke in range(self.smallest_entry_index, len(self.germline_seq)):
             self.add_internal_state(inuke)
         # and finally right side insertions
@@ -326,24 +424,22 @@ class HmmWriter(object):
                 continue
             self.erosion_probs[erosion] = {}
             deps = utils.column_dependencies[erosion + '_del']
-            with opener('r')(self.indir + '/' + utils.get_parameter_fname(column=erosion + '_del', deps=deps)) as infile:
-                reader = csv.DictReader(infile)
-                for line in reader:
-                    # first see if we want to use this line (if <region>_gene isn't in the line, this erosion doesn't depend on gene version)
-                    if self.region + '_gene' in line and line[self.region + '_gene'] not in approved_genes:  # NOTE you'll need to change this if you want it to depend on another region's genes
-                        continue
-                    # then skip nonsense erosions that're too long for this gene, but were ok for another
-                    if int(line[erosion + '_del']) >= len(self.germline_seq):
-                        continue
-
-                    # then add in this erosion's counts
-                    n_eroded = int(line[erosion + '_del'])
-                    if n_eroded not in self.erosion_probs[erosion]:
-                        self.erosion_probs[erosion][n_eroded] = 0.0
-                    self.erosion_probs[erosion][n_eroded] += float(line['count'])
-
-                    if self.region + '_gene' in line:
-                        genes_used.add(line[self.region + '_gene'])
+            for line in utils.read_parameter_csv(self.indir + '/' + utils.get_parameter_fname(column=erosion + '_del', deps=deps)):
+                # first see if we want to use this line (if <region>_gene isn't in the line, this erosion doesn't depend on gene version)
+                if self.region + '_gene' in line and line[self.region + '_gene'] not in approved_genes:  # NOTE you'll need to change this if you want it to depend on another region's genes
+                    continue
+                # then skip nonsense erosions that're too long for this gene, but were ok for another
+                if int(line[erosion + '_del']) >= len(self.germline_seq):
+                    continue
+
+                # then add in this erosion's counts
+                n_eroded = int(line[erosion + '_del'])
+                if n_eroded not in self.erosion_probs[erosion]:
+                    self.erosion_probs[erosion][n_eroded] = 0.0
+                self.erosion_probs[erosion][n_eroded] += float(line['count'])
+
+                if self.region + '_gene' in line:
+                    genes_used.add(line[self.region + '_gene'])
 
             assert len(self.erosion_probs[erosion]) > 0
 
@@ -379,22 +475,20 @@ class HmmWriter(object):
         for insertion in self.insertions:
             self.insertion_probs[insertion] = {}
             deps = utils.column_dependencies[insertion + '_insertion']
-            with opener('r')(self.indir + '/' + utils.get_parameter_fname(column=insertion + '_insertion', deps=deps)) as infile:
-                reader = csv.DictReader(infile)
-                for line in reader:
-                    # first see if we want to use this line (if <region>_gene isn't in the line, this erosion doesn't depend on gene version)
-                    if self.region + '_gene' in line and line[self.region + '_gene'] not in approved_genes:  # NOTE you'll need to change this if you want it to depend on another region's genes
-                        continue
-
-                    # then add in this insertion's counts
-                    n_inserted = 0
-                    n_inserted = int(line[insertion + '_insertion'])
-                    if n_inserted not in self.insertion_probs[insertion]:
-                        self.insertion_probs[insertion][n_inserted] = 0.0
-                    self.insertion_probs[insertion][n_inserted] += float(line['count'])
-
-                    if self.region + '_gene' in line:
-                        genes_used.add(line[self.region + '_gene'])
+            for line in utils.read_parameter_csv(self.indir + '/' + utils.get_parameter_fname(column=insertion + '_insertion', deps=deps)):
+                # first see if we want to use this line (if <region>_gene isn't in the line, this erosion doesn't depend on gene version)
+                if self.region + '_gene' in line and line[self.region + '_gene'] not in approved_genes:  # NOTE you'll need to change this if you want it to depend on another region's genes
+                    continue
+
+                # then add in this insertion's counts
+                n_inserted = 0
+                n_inserted = int(line[insertion + '_insertion'])
+                if n_inserted not in self.insertion_probs[insertion]:
+                    self.insertion_probs[insertion][n_inserted] = 0.0
+                self.insertion_probs[insertion][n_inserted] += float(line['count'])
+
+                if self.region + '_gene' in line:
+                    genes_used.add(line[self.region + '_gene'])
 
             assert len(self.insertion_probs[insertion]) > 0
 
@@ -436,17 +530,15 @@ class HmmWriter(object):
     def read_insertion_content(self, insertion):
         self.insertion_content_probs[insertion] = {}
         if self.args.insertion_base_content:
-            with opener('r')(self.indir + '/' + insertion + '_insertion_content.csv') as icfile:
-                reader = csv.DictReader(icfile)
-                total = 0
-                for line in reader:
-                    self.insertion_content_probs[insertion][line[insertion + '_insertion_content']] = int(line['count'])
-                    total += int(line['count'])
-                for nuke in utils.nukes:
-                    if nuke not in self.insertion_content_probs[insertion]:
-                        print '    %s not in insertion content probs, adding with zero' % nuke
-                        self.insertion_content_probs[insertion][nuke] = 0
-                    self.insertion_content_probs[insertion][nuke] /= float(total)
+            total = 0
+            for line in utils.read_parameter_csv(self.indir + '/' + insertion + '_insertion_content.csv'):
+                self.insertion_content_probs[insertion][line[insertion + '_insertion_content']] = int(line['count'])
+                total += int(line['count'])
+            for nuke in utils.nukes:
+                if nuke not in self.insertion_content_probs[insertion]:
+                    print '    %s not in insertion content probs, adding with zero' % nuke
+                    self.insertion_content_probs[insertion][nuke] = 0
+                self.insertion_content_probs[insertion][nuke] /= float(total)
         else:
             self.insertion_content_probs[insertion] = {'A':0.25, 'C':0.25, 'G':0.25, 'T':0.25}
 
@@ -642,19 +734,61 @@ class HmmWriter(object):
 
         return prob
 
+    # ----------------------------------------------------------------------------------------
+    def get_internal_emission_probs(self):
+        """
+        Emission probs for every position in the germline sequence in one go, as a list (indexed by position) of the dicts that add_emission()
+        (or, with --joint-emission, add_pair_emission()) wants. Same values as get_emission_prob() with is_insert=False.
+        """
+        germline_indices = nuke_index_table[numpy.frombuffer(self.germline_seq, dtype=numpy.uint8)]
+        is_germline = germline_indices[:, None] == numpy.arange(len(utils.nukes))  # position x nuke
+        mute_freqs = numpy.full(len(self.germline_seq), self.mute_freqs['overall_mean'])  # use the mean for positions we didn't see
+        positions = [pos for pos in self.mute_freqs if pos != 'overall_mean' and pos < len(self.germline_seq)]
+        mute_freqs[positions] = [self.mute_freqs[pos] for pos in positions]
+        mute_freqs = mute_freqs[:, None]
+        if self.args.joint_emission:  # see get_emission_prob() for how we got these
+            mute_freqs = mute_freqs[:, :, None]
+            is_germline1, is_germline2 = is_germline[:, :, None], is_germline[:, None, :]  # position x nuke1 x nuke2
+            cryptic_factor = (2 - mute_freqs) / (6*mute_freqs + 9)
+            probs = numpy.where(is_germline1 | is_germline2, mute_freqs * cryptic_factor, mute_freqs * mute_freqs * cryptic_factor)  # one mutation event, or two
+            probs = numpy.where(numpy.arange(len(utils.nukes))[:, None] == numpy.arange(len(utils.nukes)), mute_freqs * cryptic_factor, probs)  # both mutated to the same base is only one event
+            probs = numpy.where(is_germline1 & is_germline2, (1.0 - mute_freqs)**2, probs)  # no mutations
+            totals = probs.sum(axis=(1, 2))
+        else:
+            assert numpy.all((mute_freqs[self.smallest_entry_index:] != 1.0) & (mute_freqs[self.smallest_entry_index:] != 0.0))
+            probs = numpy.where(is_germline, 1.0 - mute_freqs, mute_freqs / 3.0)
+            totals = probs.sum(axis=1)
+
+        for inuke in numpy.flatnonzero(numpy.fabs(totals - 1.0) >= self.eps):
+            if inuke >= self.smallest_entry_index:  # we don't write states before this
+                print 'ERROR emission not normalized at position %d in %s (%f)' % (inuke, self.saniname, totals[inuke])
+                assert False
+
+        emission_probs = [None for _ in range(self.smallest_entry_index)]  # we don't write states before this
+        if self.args.joint_emission:
+            emission_probs += [{nuke1 : dict(zip(utils.nukes, row)) for nuke1, row in zip(utils.nukes, position_probs)} for position_probs in probs[self.smallest_entry_index:].tolist()]
+        else:
+            emission_probs += [dict(zip(utils.nukes, position_probs)) for position_probs in probs[self.smallest_entry_index:].tolist()]
+        return emission_probs
+
     # ----------------------------------------------------------------------------------------
     def add_emissions(self, state, inuke=-1, germline_nuke=''):
+        if 'insert' not in state.name:  # internal states just take their entry from the table (which is already checked for normalization)
+            if self.args.joint_emission:
+                state.add_pair_emission(self.track, self.internal_emission_probs[inuke])
+            else:
+                state.add_emission(self.track, self.internal_emission_probs[inuke])
+            return
 
         insertion = ''
-        if 'insert' in state.name:
-            assert len(self.insertions) == 1 or len(self.insertions) == 2
-            if len(self.insertions) == 1:
-                insertion = self.insertions[0]
-            elif 'left' in state.name:
-                insertion = self.insertions[0]
-            elif 'right' in state.name:
-                insertion = self.insertions[1]
-            assert insertion != ''
+        assert len(self.insertions) == 1 or len(self.insertions) == 2
+        if len(self.insertions) == 1:
+            insertion = self.insertions[0]
+        elif 'left' in state.name:
+            insertion = self.insertions[0]
+        elif 'right' in state.name:
+            insertion = self.insertions[1]
+        assert insertion != ''
 
         if self.args.joint_emission:  # add pair emission (NOTE see note below, but really means requiring k=2 but allowing joint emission)
             pair_emission_probs = {}
@@ -662,7 +796,7 @@ class HmmWriter(object):
             for nuke1 in utils.nukes:
                 pair_emission_probs[nuke1] = {}
                 for nuke2 in utils.nukes:
-                    pair_emission_probs[nuke1][nuke2] = self.get_emission_prob(nuke1, nuke2, is_insert=('insert' in state.name), inuke=inuke, germline_nuke=germline_nuke, insertion=insertion)
+                    pair_emission_probs[nuke1][nuke2] = self.get_emission_prob(nuke1, nuke2, is_insert=True, inuke=inuke, germline_nuke=germline_nuke, insertion=insertion)
                     total += pair_emission_probs[nuke1][nuke2]
             if math.fabs(total - 1.0) >= self.eps:
                 print 'ERROR pair emission not normalized in state %s in %s (%f)' % (state.name, 'X', total)  #utils.color_gene(gene_name), total)
@@ -675,7 +809,7 @@ class HmmWriter(object):
             emission_probs = {}
             total = 0.0
             for nuke in utils.nukes:
-                emission_probs[nuke] = self.get_emission_prob(nuke, is_insert=('insert' in state.name), inuke=inuke, germline_nuke=germline_nuke, insertion=insertion)
+                emission_probs[nuke] = self.get_emission_prob(nuke, is_insert=True, inuke=inuke, germline_nuke=germline_nuke, insertion=insertion)
                 total += emission_probs[nuke]
             if math.fabs(total - 1.0) >= self.eps:
                 print 'ERROR emission not normalized in state %s in %s (%f)' % (state.name, 'X', total)  #utils.color_gene(gene_name), total)
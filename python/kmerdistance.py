@@ -0,0 +1,75 @@
+""" K-mer profile distances between query sequences """
+
+import numpy
+
+from hammer import Hammer
+
+# ----------------------------------------------------------------------------------------
+class KmerDistance(Hammer):
+    """
+    Distance between k-mer count profiles, i.e. one minus the cosine similarity of the vectors of counts of each k-mer in the two sequences.
+    Doesn't need the sequences to be aligned or the same length, and isn't thrown off by indels.
+    Uses Hammer's name indexing and batching (get_distances() etc.), but not its sequence matrix, and can't do get_candidate_pairs().
+    Profiles are stored in compressed sparse row form: the sorted ids of the k-mers in each sequence, and their counts, concatenated, with
+    <self.row_starts> giving the start of each sequence's row.
+    """
+    def __init__(self, seqs, k=5, block_size=10000):
+        """ <seqs> is a dict mapping query name to sequence """
+        self.k = k
+        self.block_size = block_size
+        self.truncate = True
+        self.names = list(seqs.keys())
+        self.indices = {name:iname for iname, name in enumerate(self.names)}
+        self.lengths = numpy.array([len(seqs[name]) for name in self.names], dtype=numpy.int32)
+        self.n_kmers = 4**k  # number of possible k-mer ids (k-mers with ambiguous bases are skipped)
+
+        base_codes = numpy.zeros(256, dtype=numpy.int64) + 4  # map from ascii code to 0-3 for ACGT, and 4 for anything else
+        for ibase, base in enumerate('ACGT'):
+            base_codes[ord(base)] = ibase
+        place_values = 4**numpy.arange(k - 1, -1, -1, dtype=numpy.int64)
+        row_kmer_ids, row_counts = [], []
+        for name in self.names:
+            codes = base_codes[numpy.frombuffer(seqs[name], dtype=numpy.uint8)]
+            n_windows = max(0, len(codes) - k + 1)
+            windows = numpy.array([codes[ipos : ipos + n_windows] for ipos in range(k)], dtype=numpy.int64).reshape(k, n_windows)  # row i is the i-th base of each k-mer
+            windows = windows[:, (windows < 4).all(axis=0)]
+            kmer_ids, counts = numpy.unique(place_values.dot(windows), return_counts=True)
+            row_kmer_ids.append(kmer_ids.astype(numpy.int64))
+            row_counts.append(counts.astype(numpy.float64))
+        self.row_starts = numpy.zeros(len(self.names) + 1, dtype=numpy.int64)
+        self.row_starts[1:] = numpy.cumsum([len(ids) for ids in row_kmer_ids])
+        self.kmer_ids = numpy.concatenate(row_kmer_ids) if len(self.names) > 0 else numpy.zeros(0, dtype=numpy.int64)
+        self.counts = numpy.concatenate(row_counts) if len(self.names) > 0 else numpy.zeros(0, dtype=numpy.float64)
+        self.norms = numpy.sqrt(numpy.array([(counts**2).sum() for counts in row_counts], dtype=numpy.float64))
+
+    # ----------------------------------------------------------------------------------------
+    def get_row_keys(self, rows):
+        """
+        Return the k-mers in each of <rows> as keys <index in rows> * <n_kmers> + <k-mer id> (which come out sorted, since each row's ids are
+        sorted), along with the corresponding index in <rows> and count for each key.
+        """
+        sizes = self.row_starts[rows + 1] - self.row_starts[rows]
+        irows = numpy.repeat(numpy.arange(len(rows), dtype=numpy.int64), sizes)
+        positions = numpy.arange(sizes.sum(), dtype=numpy.int64) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes) + numpy.repeat(self.row_starts[rows], sizes)
+        return irows * self.n_kmers + self.kmer_ids[positions], irows, self.counts[positions]
+
+    # ----------------------------------------------------------------------------------------
+    def get_fractions(self, ia, ib):
+        """ Return an array of profile distances between the sequences in index arrays <ia> and <ib> """
+        keys_a, irows_a, counts_a = self.get_row_keys(ia)
+        keys_b, _, counts_b = self.get_row_keys(ib)
+        if len(keys_b) == 0:
+            return numpy.ones(len(ia), dtype=numpy.float64)
+        ikeys = numpy.minimum(numpy.searchsorted(keys_b, keys_a), len(keys_b) - 1)  # for each key in a, where it'd be in b
+        shared = keys_b[ikeys] == keys_a
+        dot_products = numpy.bincount(irows_a[shared], weights=counts_a[shared] * counts_b[ikeys[shared]], minlength=len(ia))
+        norm_products = self.norms[ia] * self.norms[ib]
+        similarities = numpy.zeros(len(ia), dtype=numpy.float64)
+        nonzero = norm_products > 0
+        similarities[nonzero] = dot_products[nonzero] / norm_products[nonzero]
+        return numpy.clip(1. - similarities, 0., 1.)
+
+    # ----------------------------------------------------------------------------------------
+    def get_candidate_pairs(self, cutoff):
+        """ no index for profile distances, so the caller has to look at all pairs """
+        return None
@@ -0,0 +1,87 @@
+""" Persistent store of pair hmm forward scores, so repeated partition runs only run bcrham on pairs they haven't seen before """
+
+import os
+import csv
+import glob
+import hashlib
+
+import utils
+from opener import opener
+
+# ----------------------------------------------------------------------------------------
+class PairScoreCache(object):
+    """
+    Scores are keyed by the (unordered) pair of query names plus a hash of everything else that goes into the bcrham input line for the pair
+    (sequences, k_v and k_d ranges, and gene list), and stored in a separate file for each set of hmms (i.e. a digest of <parameter_dir>/hmms).
+    """
+    def __init__(self, cachedir, parameter_dir):
+        self.cachedir = cachedir
+        self.fname = cachedir + '/pair-scores-' + self.get_hmm_digest(parameter_dir) + '.csv'
+        self.scores = {}  # map from (pair key, input hash) to score
+        self.pending = {}  # map from pair key to input hash for pairs we've asked about but didn't have, so we can add them once bcrham is done
+        self.new_scores = {}  # scores to append to the cache file
+        if os.path.exists(self.fname):
+            with opener('r')(self.fname) as cachefile:
+                reader = csv.DictReader(cachefile)
+                for line in reader:
+                    self.scores[(line['unique_ids'], line['input_hash'])] = float(line['score'])
+
+    # ----------------------------------------------------------------------------------------
+    def get_hmm_digest(self, parameter_dir):
+        """
+        Identify the hmms in <parameter_dir>/hmms without reading them all: use the fingerprints file that PartitionDriver.write_hmms() writes next
+        to them (which already has a digest of everything that goes into each yaml), or, for hmms that weren't written that way, each yaml's name, size and mtime.
+        """
+        digest = hashlib.sha1()
+        fingerprint_fname = parameter_dir + '/hmms/fingerprints.csv'
+        if os.path.exists(fingerprint_fname):
+            with opener('r')(fingerprint_fname) as fingerprint_file:
+                digest.update(fingerprint_file.read())
+        else:
+            for fname in sorted(glob.glob(parameter_dir + '/hmms/*.yaml')):
+                fstat = os.stat(fname)
+                digest.update('%s %d %r\n' % (os.path.basename(fname), fstat.st_size, fstat.st_mtime))
+        return digest.hexdigest()[:16]
+
+    # ----------------------------------------------------------------------------------------
+    def get_input_hash(self, combined_query):
+        """ hash of the parts of the bcrham input line that aren't the query names (sorted, so it doesn't depend on the order of the pair) """
+        input_str = '%d %d %d %d %s %s' % (combined_query['k_v']['min'], combined_query['k_v']['max'], combined_query['k_d']['min'], combined_query['k_d']['max'],
+                                           ':'.join(sorted(combined_query['only_genes'])), ':'.join(sorted(combined_query['seqs'])))
+        return hashlib.sha1(input_str).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def lookup(self, query_names, combined_query):
+        """ return the cached score for this pair, or None if we don't have it (in which case we remember it so add_score() can fill it in) """
+        key = utils.get_key(query_names)
+        input_hash = self.get_input_hash(combined_query)
+        if (key, input_hash) in self.scores:
+            return self.scores[(key, input_hash)]
+        self.pending[key] = input_hash
+        return None
+
+    # ----------------------------------------------------------------------------------------
+    def add_score(self, id_a, id_b, score):
+        """ add a fresh score from bcrham (ignored unless it's for a pair that lookup() didn't find) """
+        key = utils.get_key((id_a, id_b))
+        if key not in self.pending:
+            return
+        self.scores[(key, self.pending[key])] = score
+        self.new_scores[(key, self.pending[key])] = score
+        del self.pending[key]
+
+    # ----------------------------------------------------------------------------------------
+    def write(self):
+        """ append new scores to the cache file """
+        if len(self.new_scores) == 0:
+            return
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+        write_header = not os.path.exists(self.fname)
+        with open(self.fname, 'a') as cachefile:
+            writer = csv.DictWriter(cachefile, ('unique_ids', 'input_hash', 'score'))
+            if write_header:
+                writer.writeheader()
+            for key, input_hash in self.new_scores:
+                writer.writerow({'unique_ids':key, 'input_hash':input_hash, 'score':repr(self.new_scores[(key, input_hash)])})
+        self.new_scores = {}
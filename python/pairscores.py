@@ -0,0 +1,103 @@
+""" Compact storage for scores of (unordered) query pairs """
+
+import array
+import numpy
+
+# ----------------------------------------------------------------------------------------
+class PairScores(object):
+    """
+    Sparse edge list of pair scores. Query names are interned to integer indices, and pairs and scores are appended to typed arrays, which
+    are merged into sorted numpy arrays the first time we need to look something up. Uses a few tens of bytes per pair, instead of the
+    hundreds it takes to keep a dict keyed by utils.get_key() strings.
+    Each pair's key is the smaller index in the high 32 bits and the larger one in the low 32, so adding names never changes existing keys, and
+    merging only has to sort the pairs added since the last merge.
+    Scores are float64 so comparisons to cluster thresholds come out exactly the same as they did with python floats.
+    """
+    def __init__(self):
+        self.names = []  # map from index to query name
+        self.indices = {}  # map from query name to index
+        self.new_a = array.array('i')  # pairs (smaller index first) and scores that have been added since we last merged
+        self.new_b = array.array('i')
+        self.new_scores = array.array('d')
+        self.keys = numpy.zeros(0, dtype=numpy.int64)  # sorted pair keys (see get_key())
+        self.scores = numpy.zeros(0, dtype=numpy.float64)  # score for each entry in <self.keys>
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        """ number of pairs, without merging (so a pair that was add()ed again since the last merge is counted twice) """
+        return len(self.keys) + len(self.new_scores)
+
+    # ----------------------------------------------------------------------------------------
+    def __contains__(self, pair):
+        return self.get(pair[0], pair[1]) is not None
+
+    # ----------------------------------------------------------------------------------------
+    def get_index(self, name, add=False):
+        if name not in self.indices:
+            if not add:
+                return None
+            self.indices[name] = len(self.names)
+            self.names.append(name)
+        return self.indices[name]
+
+    # ----------------------------------------------------------------------------------------
+    def get_key(self, ia, ib):
+        return (min(ia, ib) << 32) | max(ia, ib)
+
+    # ----------------------------------------------------------------------------------------
+    def add(self, name_a, name_b, score):
+        """ set the score for the pair (overwriting any previous score for it) """
+        ia, ib = sorted((self.get_index(name_a, add=True), self.get_index(name_b, add=True)))
+        self.new_a.append(ia)
+        self.new_b.append(ib)
+        self.new_scores.append(score)
+
+    # ----------------------------------------------------------------------------------------
+    def finalize(self):
+        """ merge any newly-added pairs into the sorted arrays (sorting only the new ones, so interleaving adds and lookups doesn't re-sort everything) """
+        if len(self.new_scores) == 0:
+            return
+        new_keys = (numpy.frombuffer(self.new_a, dtype=numpy.int32).astype(numpy.int64) << 32) | numpy.frombuffer(self.new_b, dtype=numpy.int32)
+        new_scores = numpy.frombuffer(self.new_scores, dtype=numpy.float64)
+        order = numpy.argsort(new_keys, kind='mergesort')  # stable, so for duplicate pairs the last one added comes last...
+        new_keys, new_scores = new_keys[order], new_scores[order]
+        keep = numpy.append(new_keys[1:] != new_keys[:-1], True)  # ...and that's the one we keep
+        new_keys, new_scores = new_keys[keep], new_scores[keep]
+
+        positions = numpy.searchsorted(self.keys, new_keys)
+        existing = self.keys[numpy.minimum(positions, len(self.keys) - 1)] == new_keys if len(self.keys) > 0 else numpy.zeros(len(new_keys), dtype=bool)
+        self.scores[positions[existing]] = new_scores[existing]  # overwrite the pairs we already had...
+        self.keys = numpy.insert(self.keys, positions[~existing], new_keys[~existing])  # ...and insert the rest in order
+        self.scores = numpy.insert(self.scores, positions[~existing], new_scores[~existing])
+        self.new_a, self.new_b, self.new_scores = array.array('i'), array.array('i'), array.array('d')
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, name_a, name_b, default=None):
+        """ return the score for the pair, or <default> if we don't have it """
+        ia, ib = self.get_index(name_a), self.get_index(name_b)
+        if ia is None or ib is None:
+            return default
+        self.finalize()
+        key = self.get_key(ia, ib)
+        ikey = numpy.searchsorted(self.keys, key)
+        if ikey == len(self.keys) or self.keys[ikey] != key:
+            return default
+        return float(self.scores[ikey])
+
+    # ----------------------------------------------------------------------------------------
+    def iteritems(self):
+        """ generate (name_a, name_b, score) for every pair, sorted by index """
+        self.finalize()
+        for key, score in zip(self.keys.tolist(), self.scores.tolist()):
+            yield self.names[key >> 32], self.names[key & 0xffffffff], score
+
+    # ----------------------------------------------------------------------------------------
+    def get_partners(self, name):
+        """ generate (other name, score) for each pair in which <name> has the smaller index (so doing this for every name gives each pair once) """
+        ia = self.get_index(name)
+        if ia is None:
+            return
+        self.finalize()
+        istart, istop = numpy.searchsorted(self.keys, [ia << 32, (ia + 1) << 32])
+        for key, score in zip(self.keys[istart : istop].tolist(), self.scores[istart : istop].tolist()):
+            yield self.names[key & 0xffffffff], score
@@ -25,21 +25,19 @@ def read_mute_info(indir, this_gene, approved_genes=None):
     # add an observation for each position, for each gene where we observed that position
     for gene in approved_genes:
         mutefname = indir + '/mute-freqs/' + utils.sanitize_name(gene) + '.csv'
-        if not os.path.exists(mutefname):
+        if mutefname not in utils.parameter_tables and not os.path.exists(mutefname):
             continue
-        with opener('r')(mutefname) as mutefile:
-            reader = csv.DictReader(mutefile)
-            for line in reader:
-                pos = int(line['position'])
-                freq = float(line['mute_freq'])
-                lo_err = float(line['lo_err'])  # NOTE lo_err in the file is really the lower *bound*
-                hi_err = float(line['hi_err'])  #   same deal
-                assert freq >= 0.0 and lo_err >= 0.0 and hi_err >= 0.0  # you just can't be too careful
-                if freq < utils.eps or abs(1.0 - freq) < utils.eps:  # if <freq> too close to 0 or 1, replace it with the midpoint of its uncertainty band
-                    freq = 0.5 * (lo_err + hi_err)
-                if pos not in observed_freqs:
-                    observed_freqs[pos] = []
-                observed_freqs[pos].append({'freq':freq, 'err':max(abs(freq-lo_err), abs(freq-hi_err))})
+        for line in utils.read_parameter_csv(mutefname):
+            pos = int(line['position'])
+            freq = float(line['mute_freq'])
+            lo_err = float(line['lo_err'])  # NOTE lo_err in the file is really the lower *bound*
+            hi_err = float(line['hi_err'])  #   same deal
+            assert freq >= 0.0 and lo_err >= 0.0 and hi_err >= 0.0  # you just can't be too careful
+            if freq < utils.eps or abs(1.0 - freq) < utils.eps:  # if <freq> too close to 0 or 1, replace it with the midpoint of its uncertainty band
+                freq = 0.5 * (lo_err + hi_err)
+            if pos not in observed_freqs:
+                observed_freqs[pos] = []
+            observed_freqs[pos].append({'freq':freq, 'err':max(abs(freq-lo_err), abs(freq-hi_err))})
 
     # set final mute_freqs[pos] to the (inverse error-weighted) average over all the observations for each position
     mute_freqs = {}
@@ -8,14 +8,27 @@ import os
 import glob
 import csv
 import re
+import threading
+import select
+from collections import OrderedDict
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, check_call
 
 import utils
 from opener import opener
 from seqfileopener import get_seqfile_info
 from clusterer import Clusterer
+from agglomerator import Agglomerator
 from waterer import Waterer
+from hammer import Hammer
+import hammer
+from kmerdistance import KmerDistance
+from cdr3hammer import Cdr3Hammer
+from hmmworkers import HmmWorkerPool
+import hmmbinary
+from hmmbinary import BinaryHmmInput
+from pairscorecache import PairScoreCache
 from hist import Hist
 from parametercounter import ParameterCounter
 from performanceplotter import PerformancePlotter
@@ -26,6 +39,8 @@ import plotting
 def from_same_event(is_data, pair_hmm, reco_info, query_names):
     if is_data:
         return False
+    if any(query not in reco_info for query in query_names):  # e.g. representatives of clusters from --existing-partition that aren't in the seqfile
+        return False
     if len(query_names) > 1:
         reco_id = reco_info[query_names[0]]['reco_id']  # the first one's reco id
         for iq in range(1, len(query_names)):  # then loop through the rest of 'em to see if they're all the same
@@ -48,6 +63,8 @@ class PartitionDriver(object):
             self.tryp_positions = {row[0]:row[1] for row in tryp_reader}  # WARNING: this doesn't filter out the header line
 
         self.precluster_info = {}
+        self.hmm_workers = None  # persistent bcrham processes (only used with --persistent-hmm-workers)
+        self.in_process_hmms = {}  # map from hmm directory to its pybcrham.Ham (only used with --in-process-hmm)
 
         if self.args.seqfile is not None:
             self.input_info, self.reco_info = get_seqfile_info(self.args.seqfile, self.args.is_data,
@@ -66,7 +83,7 @@ class PartitionDriver(object):
             return
         if not self.args.read_cached_parameters:  # ha ha I don't have this arg any more
             waterer.clean()  # remove all the parameter files that the waterer's ParameterCounter made
-            for fname in glob.glob(waterer.parameter_dir + '/hmms/*.yaml'):  # remove all the hmm files from the same directory
+            for fname in glob.glob(waterer.parameter_dir + '/hmms/*.yaml') + glob.glob(waterer.parameter_dir + '/hmms/fingerprints.csv') + glob.glob(waterer.parameter_dir + '/hmms/bundle.bin'):  # remove all the hmm files from the same directory
                 os.remove(fname)
             os.rmdir(waterer.parameter_dir + '/hmms')
             os.rmdir(waterer.parameter_dir)
@@ -98,34 +115,253 @@ class PartitionDriver(object):
             self.write_hmms(parameter_out_dir, waterer.info['all_best_matches'])
             parameter_in_dir = parameter_out_dir
 
+        self.close_hmm_workers()
         if not self.args.no_clean:
             os.rmdir(self.args.workdir)
 
     # ----------------------------------------------------------------------------------------
     def partition(self):
         assert os.path.exists(self.args.parameter_dir)
+        if self.args.agglomerate and self.args.representative_cutoff is not None:
+            raise Exception('ERROR --agglomerate needs pair scores for every linked pair of queries, so can\'t be used with --representative-cutoff')
+        if self.args.existing_partition is not None:
+            if self.args.precluster_distance == 'cdr3-hamming':
+                raise Exception('ERROR --precluster-distance cdr3-hamming needs sw info, which we don\'t have yet when preclustering with --existing-partition')
+            self.incremental_partition()
+            return
 
         # run smith-waterman
         waterer = Waterer(self.args, self.input_info, self.reco_info, self.germline_seqs, parameter_dir=self.args.parameter_dir, write_parameters=False)
         waterer.run()
 
-        # cdr3 length partitioning
-        cdr3_cluster = False  # don't precluster on cdr3 length for the moment -- I cannot accurately infer cdr3 length in some sequences, so I need a way to pass query seqs to the clusterer with several possible cdr3 lengths (and I don't know how to do that!)
-        cdr3_length_clusters = None
-        if cdr3_cluster:
-            cdr3_length_clusters = self.cdr3_length_precluster(waterer)
+        # cdr3 length blocking (each query goes in a block for each of its plausible cdr3 lengths, since we can't always tell which is right)
+        cdr3_blocks = None
+        if self.args.cdr3_length_blocking:
+            cdr3_blocks = self.get_cdr3_length_blocks(waterer)
 
-        hamming_clusters = self.hamming_precluster(cdr3_length_clusters)
+        hamming_clusters = self.hamming_precluster(cdr3_blocks=cdr3_blocks, sw_info=waterer.info)
         # stripped_clusters = self.run_hmm('forward', waterer.info, self.args.parameter_dir, preclusters=hamming_clusters, stripped=True)
-        hmm_clusters = self.run_hmm('forward', waterer.info, self.args.parameter_dir, preclusters=hamming_clusters, hmm_type='k=2', make_clusters=True)
+        if self.args.representative_cutoff is not None:
+            hmm_clusters = self.representative_pair_hmm(waterer, hamming_clusters)
+        else:
+            hmm_clusters = self.run_hmm('forward', waterer.info, self.args.parameter_dir, preclusters=hamming_clusters, hmm_type='k=2', make_clusters=True)
 
-        self.run_hmm('forward', waterer.info, self.args.parameter_dir, preclusters=hmm_clusters, hmm_type='k=preclusters', prefix='k-', make_clusters=False)
-        # self.run_hmm('viterbi', waterer.info, self.args.parameter_dir, preclusters=hmm_clusters, hmm_type='k=preclusters', prefix='k-', make_clusters=False)
+        if self.args.agglomerate:
+            final_clusters = self.agglomerate(waterer, hmm_clusters)
+        else:
+            self.run_hmm('forward', waterer.info, self.args.parameter_dir, preclusters=hmm_clusters, hmm_type='k=preclusters', prefix='k-', make_clusters=False)
+            # self.run_hmm('viterbi', waterer.info, self.args.parameter_dir, preclusters=hmm_clusters, hmm_type='k=preclusters', prefix='k-', make_clusters=False)
+            final_clusters = hmm_clusters.id_clusters.values()
+        if self.args.partition_outfname is not None:
+            self.write_partition(self.args.partition_outfname, self.get_partition(final_clusters, self.input_info))
 
+        self.close_hmm_workers()
         # self.clean(waterer)
         if not self.args.no_clean:
             os.rmdir(self.args.workdir)
 
+    # ----------------------------------------------------------------------------------------
+    def agglomerate(self, waterer, hmm_clusters):
+        """
+        Starting from single queries, greedily merge clusters using k>2 forward scores (see Agglomerator), beginning with the k=2 scores in
+        <hmm_clusters>. Each round runs bcrham once, on all the sets that the previous round's merges need. Returns a list of lists of query names.
+        """
+        start = time.time()
+        agglomerator = Agglomerator(self.args.pair_hmm_cluster_cutoff, hmm_clusters.query_clusters.keys(), hmm_clusters.pairscores)
+        iround = 0
+        while True:
+            nsets = agglomerator.get_missing_sets()
+            if len(nsets) > 0:
+                hmminfo = self.run_hmm('forward', waterer.info, self.args.parameter_dir, hmm_type='k=sets', nsets=nsets, prefix='agglom-%d-' % iround)
+                agglomerator.add_set_scores(nsets, hmminfo)
+            n_merges = agglomerator.merge(debug=self.args.debug)
+            print '    agglomeration round %d: %d new sets, %d merges' % (iround, len(nsets), n_merges)
+            if n_merges == 0:
+                break
+            iround += 1
+        clusters = agglomerator.get_clusters()
+        if agglomerator.n_failed_sets > 0:
+            print '    WARNING %d sets didn\'t get forward scores (e.g. sw failures), so weren\'t merged' % agglomerator.n_failed_sets
+
+        out_str_list = ['  %d agglomerated clusters (%d merges):\n' % (len(clusters), agglomerator.n_merges), ]
+        for cluster in clusters:
+            out_str_list.append('   ' + ' '.join([str(query) for query in cluster]) + '\n')
+        if self.outfile is not None:
+            self.outfile.write(''.join(out_str_list))
+        else:
+            print ''.join(out_str_list)
+        print '    agglomeration time: %.3f' % (time.time()-start)
+        return clusters
+
+    # ----------------------------------------------------------------------------------------
+    def get_representative_groups(self, hamming_clusters):
+        """
+        Split the queries in <hamming_clusters> into groups whose members are within --representative-cutoff of each other (single linkage), and
+        choose as each group's representative the member with the most links inside the group (a cheap stand-in for the medoid).
+        Returns a map from representative to the list of members of its group.
+        """
+        queries = [query for query in self.input_info if query in hamming_clusters.query_clusters]
+        links = []
+        n_links = {query:0 for query in queries}
+        for id_a, id_b, score in hamming_clusters.pairscores.iteritems():
+            if score <= self.args.representative_cutoff and id_a in n_links and id_b in n_links:
+                links.append({'id_a':id_a, 'id_b':id_b, 'score':score})
+                n_links[id_a] += 1
+                n_links[id_b] += 1
+        tight_clusters = Clusterer(self.args.representative_cutoff, greater_than=False, singletons=list(queries))
+        tight_clusters.cluster(input_scores=links, outfile=self.outfile, max_scores_in_memory=self.args.max_scores_in_memory, workdir=self.args.workdir)
+        groups = {}
+        for members in tight_clusters.id_clusters.values():
+            groups[max(members, key=lambda query: n_links[query])] = members  # max() returns the first one in case of ties
+        print '    %d representatives for %d queries' % (len(groups), len(queries))
+        return groups
+
+    # ----------------------------------------------------------------------------------------
+    def representative_pair_hmm(self, waterer, hamming_clusters):
+        """
+        Alternative to running the pair hmm on every pair in <hamming_clusters>: collapse each precluster into groups (see get_representative_groups()),
+        and run the pair hmm only on pairs of representatives whose groups have a hamming link. Where a representative score is within
+        --representative-score-margin of --pair-hmm-cluster-cutoff, also score the member pairs between the two groups (the ones the all-pairs pass would
+        have scored), and link the groups if any of them is over the cutoff. Returns the resulting clusters of queries.
+        """
+        groups = self.get_representative_groups(hamming_clusters)
+        representatives = {}  # map from query to the representative of its group
+        for rep, members in groups.items():
+            for query in members:
+                representatives[query] = rep
+
+        # links between groups (the smallest hamming distance between any of their members)
+        group_links = {}
+        for id_a, id_b, score in hamming_clusters.pairscores.iteritems():
+            if id_a not in representatives or id_b not in representatives or hamming_clusters.is_removable(score):
+                continue
+            rep_pair = tuple(sorted((representatives[id_a], representatives[id_b])))
+            if rep_pair[0] != rep_pair[1] and (rep_pair not in group_links or score < group_links[rep_pair]):
+                group_links[rep_pair] = score
+        rep_preclusters = Clusterer(self.args.hamming_cluster_cutoff, greater_than=False, singletons=[rep for rep in groups if not any(rep in pair for pair in group_links)])
+        rep_preclusters.cluster(input_scores=[{'id_a':id_a, 'id_b':id_b, 'score':score} for (id_a, id_b), score in group_links.items()], outfile=self.outfile)
+        rep_clusters = self.run_hmm('forward', waterer.info, self.args.parameter_dir, preclusters=rep_preclusters, hmm_type='k=2', prefix='rep-', make_clusters=True)
+
+        # sort representative scores into clear-cut and ambiguous
+        group_scores = []
+        ambiguous_pairs = set()
+        for id_a, id_b, score in rep_clusters.pairscores.iteritems():
+            if abs(score - self.args.pair_hmm_cluster_cutoff) < self.args.representative_score_margin:
+                ambiguous_pairs.add(tuple(sorted((id_a, id_b))))
+            else:
+                group_scores.append({'id_a':id_a, 'id_b':id_b, 'score':score})
+        print '    %d representative pair scores (%d ambiguous)' % (len(group_scores) + len(ambiguous_pairs), len(ambiguous_pairs))
+
+        # score all the member pairs for ambiguous groups
+        member_links = []
+        for id_a, id_b, score in hamming_clusters.pairscores.iteritems():
+            if id_a in representatives and id_b in representatives and tuple(sorted((representatives[id_a], representatives[id_b]))) in ambiguous_pairs:
+                member_links.append({'id_a':id_a, 'id_b':id_b, 'score':score})
+        if len(member_links) > 0:
+            member_preclusters = Clusterer(self.args.hamming_cluster_cutoff, greater_than=False, singletons=[])
+            member_preclusters.cluster(input_scores=member_links, outfile=self.outfile)
+            member_clusters = self.run_hmm('forward', waterer.info, self.args.parameter_dir, preclusters=member_preclusters, hmm_type='k=2', prefix='rep-full-', make_clusters=True)
+            for id_a, id_b, score in member_clusters.pairscores.iteritems():  # single linkage, so one link over the cutoff is enough to join the groups
+                group_scores.append({'id_a':representatives[id_a], 'id_b':representatives[id_b], 'score':score})
+
+        # cluster the representatives, then add each group's members to its representative's cluster
+        if self.outfile is not None:
+            self.outfile.write('hmm clusters\n')
+        else:
+            print 'hmm clusters'
+        linked_reps = set([info['id_a'] for info in group_scores] + [info['id_b'] for info in group_scores])
+        clusters = Clusterer(self.args.pair_hmm_cluster_cutoff, greater_than=True, singletons=[rep for rep in groups if rep not in linked_reps])
+        clusters.add_scores(group_scores, debug=self.args.debug, reco_info=self.reco_info, outfile=self.outfile)
+        for rep, members in groups.items():
+            for query in members:
+                if query != rep:
+                    clusters.add_to_cluster(clusters.find_cluster(rep), query, [])
+        clusters.finalize(outfile=self.outfile)
+        return clusters
+
+    # ----------------------------------------------------------------------------------------
+    def incremental_partition(self):
+        """
+        Add the input queries to the partition in --existing-partition, without re-clustering the queries that are already in it.
+        New queries get hamming distances to each other and to every member of the existing clusters, but sw and the pair hmm only run on the new
+        queries plus the representative of each existing cluster that one of them is linked to, so the cost scales with the number of new queries.
+        """
+        existing_partition = self.read_partition(self.args.existing_partition)
+        existing_queries = set([uid for cluster in existing_partition for uid in cluster['unique_ids']])
+        all_input_info = self.input_info
+        self.input_info = OrderedDict([(query, info) for query, info in all_input_info.items() if query not in existing_queries])
+        print '  %d new queries (%d already in %d existing clusters)' % (len(self.input_info), len(all_input_info) - len(self.input_info), len(existing_partition))
+        if len(self.input_info) == 0:
+            new_partition = existing_partition
+        else:
+            hamming_clusters = self.hamming_precluster(existing_partition=existing_partition)
+            existing_clusters = {cluster['representative']:cluster for cluster in existing_partition}  # map from representative to its cluster
+            for rep, cluster in existing_clusters.items():
+                if rep in hamming_clusters.query_clusters:  # linked to at least one new query, so it needs sw info for the pair hmm
+                    self.input_info[rep] = {'unique_id':rep, 'seq':cluster['seqs'][cluster['unique_ids'].index(rep)]}
+
+            waterer = Waterer(self.args, self.input_info, self.reco_info, self.germline_seqs, parameter_dir=self.args.parameter_dir, write_parameters=False)
+            waterer.run()
+            hmm_clusters = self.run_hmm('forward', waterer.info, self.args.parameter_dir, preclusters=hamming_clusters, hmm_type='k=2', make_clusters=True)
+
+            id_clusters = hmm_clusters.id_clusters.values()
+            id_clusters += [[query] for query in self.input_info if query not in hmm_clusters.query_clusters]  # e.g. sw failures
+            new_partition = self.get_partition(id_clusters, all_input_info, existing_clusters=existing_clusters)
+            new_partition += [cluster for rep, cluster in existing_clusters.items() if rep not in self.input_info]  # existing clusters that none of the new queries were linked to
+        print '  %d clusters in updated partition' % len(new_partition)
+        if self.args.partition_outfname is not None:
+            self.write_partition(self.args.partition_outfname, new_partition)
+
+        self.close_hmm_workers()
+        if not self.args.no_clean and os.path.exists(self.args.workdir):
+            os.rmdir(self.args.workdir)
+
+    # ----------------------------------------------------------------------------------------
+    def get_partition(self, id_clusters, input_info, existing_clusters=None):
+        """
+        Convert <id_clusters> (list of lists of query names) to a list of {'unique_ids', 'representative', 'seqs'} dicts, for write_partition().
+        A name that's a key in <existing_clusters> (map from representative to cluster) stands in for all the members of that cluster. Each cluster's
+        representative is the one from the largest existing cluster that it contains, or else its first query.
+        """
+        if existing_clusters is None:
+            existing_clusters = {}
+        partition = []
+        for queries in id_clusters:
+            cluster = {'unique_ids':[], 'representative':queries[0], 'seqs':[]}
+            largest = 0
+            for query in queries:
+                if query in existing_clusters:
+                    cluster['unique_ids'] += existing_clusters[query]['unique_ids']
+                    cluster['seqs'] += existing_clusters[query]['seqs']
+                    if len(existing_clusters[query]['unique_ids']) > largest:
+                        cluster['representative'] = query
+                        largest = len(existing_clusters[query]['unique_ids'])
+                else:
+                    cluster['unique_ids'].append(query)
+                    cluster['seqs'].append(input_info[query]['seq'])
+            partition.append(cluster)
+        return partition
+
+    # ----------------------------------------------------------------------------------------
+    def read_partition(self, fname):
+        """ read a partition written by write_partition() """
+        partition = []
+        with opener('r')(fname) as partfile:
+            reader = csv.DictReader(partfile)
+            for line in reader:
+                utils.intify(line, splitargs=('unique_ids', 'seqs'))
+                partition.append(line)
+        return partition
+
+    # ----------------------------------------------------------------------------------------
+    def write_partition(self, fname, partition):
+        """ write <partition> (see get_partition()) to csv, one line per cluster """
+        with opener('w')(fname) as partfile:
+            writer = csv.DictWriter(partfile, ('unique_ids', 'representative', 'seqs'))
+            writer.writeheader()
+            for cluster in partition:
+                writer.writerow({'unique_ids':':'.join([str(uid) for uid in cluster['unique_ids']]), 'representative':cluster['representative'], 'seqs':':'.join(cluster['seqs'])})
+
     # ----------------------------------------------------------------------------------------
     def run_algorithm(self, algorithm):
         if not os.path.exists(self.args.parameter_dir):
@@ -136,6 +372,7 @@ class PartitionDriver(object):
         self.run_hmm(algorithm, waterer.info, parameter_in_dir=self.args.parameter_dir, hmm_type='k=nsets', \
                      count_parameters=self.args.plot_parameters, plotdir=self.args.plotdir)
 
+        self.close_hmm_workers()
         # self.clean(waterer)
         if not self.args.no_clean:
             os.rmdir(self.args.workdir)
@@ -144,85 +381,323 @@ class PartitionDriver(object):
         #     plotting.compare_directories(self.args.plotdir + '/hmm-vs-sw', self.args.plotdir + '/hmm/plots', 'hmm', self.args.plotdir + '/sw/plots', 'smith-water', xtitle='inferred - true', stats='rms')
 
     # ----------------------------------------------------------------------------------------
-    def get_hmm_cmd_str(self, algorithm, csv_infname, csv_outfname, parameter_dir, iproc=-1):
+    def get_base_hmm_cmd_str(self):
+        """ options that are the same for every bcrham process (and thus also for the persistent workers) """
         cmd_str = os.getenv('PWD') + '/packages/ham/bcrham'
         if self.args.slurm:
             cmd_str = 'srun ' + cmd_str
-        cmd_str += ' --algorithm ' + algorithm
         cmd_str += ' --chunk-cache '
         cmd_str += ' --n_best_events ' + str(self.args.n_best_events)
         cmd_str += ' --debug ' + str(self.args.debug)
-        cmd_str += ' --hmmdir ' + parameter_dir + '/hmms'
         cmd_str += ' --datadir ' + self.args.datadir
+        if self.args.hmm_io_format == 'binary':
+            cmd_str += ' --binary-io'
+        return cmd_str
+
+    # ----------------------------------------------------------------------------------------
+    def get_hmm_cmd_str(self, algorithm, csv_infname, csv_outfname, parameter_dir):
+        cmd_str = self.get_base_hmm_cmd_str()
+        cmd_str += ' --algorithm ' + algorithm
+        cmd_str += ' --hmmdir ' + parameter_dir + '/hmms'
         cmd_str += ' --infile ' + csv_infname
         cmd_str += ' --outfile ' + csv_outfname
+        return cmd_str
 
-        workdir = self.args.workdir
-        if iproc >= 0:
-            workdir += '/hmm-' + str(iproc)
-            cmd_str = cmd_str.replace(self.args.workdir, workdir)
+    # ----------------------------------------------------------------------------------------
+    def get_hmm_workers(self):
+        """ start up the persistent bcrham workers if they aren't already running """
+        if self.hmm_workers is None:
+            self.hmm_workers = HmmWorkerPool(self.get_base_hmm_cmd_str() + ' --worker', self.args.n_procs)
+        return self.hmm_workers
 
-        return cmd_str
+    # ----------------------------------------------------------------------------------------
+    def close_hmm_workers(self):
+        if self.hmm_workers is not None:
+            self.hmm_workers.close()
+            self.hmm_workers = None
+        self.in_process_hmms = {}
+
+    # ----------------------------------------------------------------------------------------
+    def get_in_process_hmm(self, hmm_dir):
+        """ pybcrham model for the hmms in <hmm_dir>, which reads each hmm file the first time it's needed, and is then kept for later passes """
+        if hmm_dir not in self.in_process_hmms:
+            ham_dir = os.getenv('PWD') + '/packages/ham'
+            if ham_dir not in sys.path:
+                sys.path.insert(1, ham_dir)
+            try:
+                import pybcrham
+            except ImportError:
+                raise Exception('ERROR --in-process-hmm needs the pybcrham extension (run \'python setup.py build_ext --inplace\' in packages/ham/)')
+            self.in_process_hmms[hmm_dir] = pybcrham.Ham(hmm_dir, self.args.datadir, n_best_events=self.args.n_best_events, chunk_cache=True, debug=self.args.debug)
+        return self.in_process_hmms[hmm_dir]
 
     # ----------------------------------------------------------------------------------------
     def run_hmm(self, algorithm, sw_info, parameter_in_dir, parameter_out_dir='', preclusters=None, hmm_type='', stripped=False, prefix='', \
-                count_parameters=False, plotdir=None, make_clusters=False):  # @parameterfetishist
+                count_parameters=False, plotdir=None, make_clusters=False, nsets=None):  # @parameterfetishist
+        """ Run bcrham on the query sets for <hmm_type> (see write_hmm_input()). Returns the clusters if <make_clusters> is set, otherwise bcrham's output info. """
 
         if prefix == '' and stripped:
             prefix = 'stripped'
         print '\n%shmm' % prefix
-        csv_infname = self.args.workdir + '/' + prefix + '_hmm_input.csv'
-        csv_outfname = self.args.workdir + '/' + prefix + '_hmm_output.csv'
-        self.write_hmm_input(csv_infname, sw_info, preclusters=preclusters, hmm_type=hmm_type, stripped=stripped, parameter_dir=parameter_in_dir)
+        binary_input = self.args.hmm_io_format == 'binary'
+        binary_output = binary_input and algorithm == 'forward'  # viterbi output is always csv
+        csv_infname = self.args.workdir + '/' + prefix + '_hmm_input' + ('.bin' if binary_input else '.csv')
+        csv_outfname = self.args.workdir + '/' + prefix + '_hmm_output' + ('.bin' if binary_output else '.csv')
+        pair_score_cache = None
+        if algorithm == 'forward' and hmm_type == 'k=2' and self.args.pair_score_cache_dir is not None:
+            pair_score_cache = PairScoreCache(self.args.pair_score_cache_dir, parameter_in_dir)
+        components = None  # map from query name to hamming precluster id, if we're sharding the pair hmm by precluster
+        if algorithm == 'forward' and hmm_type == 'k=2' and self.args.shard_pair_hmm and preclusters is not None:
+            components = {str(name):cluster_id for name, cluster_id in preclusters.query_clusters.iteritems()}
+        query_sets = [] if self.args.in_process_hmm else None  # with --in-process-hmm, the input goes straight to pybcrham instead of to a file
+        cached_pairscores = self.write_hmm_input(csv_infname, sw_info, preclusters=preclusters, hmm_type=hmm_type, stripped=stripped, parameter_dir=parameter_in_dir, pair_score_cache=pair_score_cache,
+                                                 nsets=nsets, query_sets=query_sets)
+
+        outpath = None
+        if self.args.outfname is not None:
+            outpath = self.args.outfname
+            if self.args.outfname[0] != '/':  # if full output path wasn't specified on the command line
+                outpath = os.getcwd() + '/' + outpath
+
         print '    running'
         sys.stdout.flush()
         start = time.time()
-        if self.args.n_procs > 1:
-            self.split_input(self.args.n_procs, infname=csv_infname, prefix='hmm')
-            procs = []
-            for iproc in range(self.args.n_procs):
-                cmd_str = self.get_hmm_cmd_str(algorithm, csv_infname, csv_outfname, parameter_dir=parameter_in_dir, iproc=iproc)
-                procs.append(Popen(cmd_str.split()))
-                time.sleep(0.1)
-            for proc in procs:
-                proc.wait()
-            for iproc in range(self.args.n_procs):
-                if not self.args.no_clean:
-                    os.remove(csv_infname.replace(self.args.workdir, self.args.workdir + '/hmm-' + str(iproc)))
-            self.merge_hmm_outputs(csv_outfname)
+        worker_times = {}
+        if query_sets is not None:
+            hmm_output_lines = self.run_hmm_in_process(algorithm, parameter_in_dir, query_sets, worker_times, components=components, outpath=outpath)
         else:
-            cmd_str = self.get_hmm_cmd_str(algorithm, csv_infname, csv_outfname, parameter_dir=parameter_in_dir)
-            check_call(cmd_str.split())
+            if self.args.n_procs > 1:
+                n_chunks = self.split_hmm_input(csv_infname, self.args.n_procs * self.args.hmm_chunks_per_proc, components=components)
+                jobs = []
+                for ichunk in range(n_chunks):
+                    subworkdir = self.args.workdir + '/hmm-' + str(ichunk)
+                    jobs.append((algorithm, parameter_in_dir, csv_infname.replace(self.args.workdir, subworkdir), csv_outfname.replace(self.args.workdir, subworkdir)))
+                if self.args.persistent_hmm_workers:
+                    finished_outfnames = self.get_hmm_workers().iter_run([(algo, pdir + '/hmms', infname, outfname) for algo, pdir, infname, outfname in jobs], worker_times)
+                else:
+                    finished_outfnames = self.run_hmm_procs(jobs, worker_times)
+            else:
+                if self.args.persistent_hmm_workers:
+                    self.get_hmm_workers().run([(algorithm, parameter_in_dir + '/hmms', csv_infname, csv_outfname), ])
+                else:
+                    cmd_str = self.get_hmm_cmd_str(algorithm, csv_infname, csv_outfname, parameter_dir=parameter_in_dir)
+                    check_call(cmd_str.split())
+                finished_outfnames = [csv_outfname, ]
+            hmm_output_lines = self.stream_hmm_output(finished_outfnames, outpath=outpath)
+
+        clusters = None
+        if make_clusters:  # make it before reading, so (if we're sharding) we can add each precluster's scores as they come in
+            clusters = Clusterer(self.args.pair_hmm_cluster_cutoff, greater_than=True, singletons=preclusters.singletons)
 
+        # read each chunk's output as soon as it's finished (i.e. while the others are still running)
+        hmminfo = self.read_hmm_output(algorithm, hmm_output_lines, make_clusters=make_clusters, count_parameters=count_parameters,
+                                       parameter_out_dir=parameter_out_dir, plotdir=plotdir, clusters=clusters, pair_score_cache=pair_score_cache)
         sys.stdout.flush()
         print '      hmm run time: %.3f' % (time.time()-start)
-
-        hmminfo = self.read_hmm_output(algorithm, csv_outfname, make_clusters=make_clusters, count_parameters=count_parameters, parameter_out_dir=parameter_out_dir, plotdir=plotdir)
+        if len(worker_times) > 0:
+            self.print_worker_times(worker_times)
+        if pair_score_cache is not None:
+            pair_score_cache.write()
 
         if self.args.pants_seated_clustering:
             viterbicluster.cluster(hmminfo)
 
-        clusters = None
-        if make_clusters:
+        if clusters is not None:
             if self.outfile is not None:
                 self.outfile.write('hmm clusters\n')
             else:
                 print '%shmm clusters' % prefix
-            clusters = Clusterer(self.args.pair_hmm_cluster_cutoff, greater_than=True, singletons=preclusters.singletons)
-            clusters.cluster(input_scores=hmminfo, debug=self.args.debug, reco_info=self.reco_info, outfile=self.outfile, plotdir=self.args.plotdir+'/pairscores')
-
-        if self.args.outfname is not None:
-            outpath = self.args.outfname
-            if self.args.outfname[0] != '/':  # if full output path wasn't specified on the command line
-                outpath = os.getcwd() + '/' + outpath
-            shutil.copyfile(csv_outfname, outpath)
+            clusters.add_scores(cached_pairscores, debug=self.args.debug, reco_info=self.reco_info, outfile=self.outfile, plotdir=self.args.plotdir+'/pairscores')  # the fresh scores were already added as they came in
+            clusters.finalize(outfile=self.outfile, plotdir=self.args.plotdir+'/pairscores')
+        else:
+            hmminfo += cached_pairscores
 
         if not self.args.no_clean:
-            if os.path.exists(csv_infname):  # if only one proc, this will already be deleted
+            if os.path.exists(csv_infname):
                 os.remove(csv_infname)
-            os.remove(csv_outfname)
 
-        return clusters
+        if make_clusters:
+            return clusters
+        else:
+            return hmminfo
+
+    # ----------------------------------------------------------------------------------------
+    def run_hmm_procs(self, jobs, worker_times):
+        """
+        Run a separate bcrham process for each of <jobs> (list of (algorithm, parameter_dir, infname, outfname)), with at most <n_procs> at a time.
+        A new process starts as soon as any of the running ones finishes, so one slow chunk doesn't hold up the rest.
+        Yields each job's output file name as soon as it finishes, and fills <worker_times> with a map from process slot to the run times of its jobs.
+        """
+        pending = list(reversed(jobs))  # pop() from the end, i.e. start with the first (most expensive) chunk
+        running = {}  # map from the read end of each proc's exit pipe to (proc, slot, start time, outfname)
+        free_slots = range(self.args.n_procs)
+        for islot in free_slots:
+            worker_times[islot] = []
+        finished = []  # output files of jobs that finished since we last yielded
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(free_slots) > 0:
+                    algorithm, parameter_dir, infname, outfname = pending.pop()
+                    exit_read_fd, exit_write_fd = os.pipe()  # only the bcrham proc keeps the write end open, so the read end hits eof when it exits
+                    try:
+                        proc = Popen(self.get_hmm_cmd_str(algorithm, infname, outfname, parameter_dir=parameter_dir).split(), close_fds=False)
+                    except:
+                        os.close(exit_read_fd)
+                        raise
+                    finally:
+                        os.close(exit_write_fd)
+                    running[exit_read_fd] = (proc, free_slots.pop(0), time.time(), outfname)
+                for outfname in finished:  # only yield after filling the free slots, so they don't sit idle while the caller reads
+                    yield outfname
+                finished = []
+                if len(running) == 0:
+                    continue
+                exited_fds, _, _ = select.select(running.keys(), [], [])  # block until at least one of them exits (without reaping anybody else's children)
+                for exit_read_fd in exited_fds:
+                    proc, islot, job_start, outfname = running.pop(exit_read_fd)
+                    os.close(exit_read_fd)
+                    proc.wait()
+                    if proc.returncode != 0:
+                        raise Exception('ERROR bcrham process exited with status %d' % proc.returncode)
+                    worker_times[islot].append(time.time() - job_start)  # hand its slot to the next chunk
+                    free_slots.append(islot)
+                    finished.append(outfname)
+            for outfname in finished:
+                yield outfname
+        finally:  # if one of them failed, or the caller stopped reading, don't leave the rest writing into the workdir
+            for exit_read_fd, (proc, _, _, _) in running.items():
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+                os.close(exit_read_fd)
+
+    # ----------------------------------------------------------------------------------------
+    def run_hmm_in_process(self, algorithm, parameter_dir, query_sets, worker_times, components=None, outpath=None):
+        """
+        Run <algorithm> on <query_sets> (from write_hmm_input()) with pybcrham, split into chunks with get_hmm_chunks(). pybcrham releases the GIL
+        while it runs, so <n_procs> threads each take the next chunk as soon as they finish their previous one.
+        Yields each chunk's output lines as soon as that chunk finishes. These have the same keys as bcrham's csv output, but with the values already
+        split and intified (as for binary output), and are also written to <outpath>, if it's set. Fills <worker_times> with each thread's run times.
+        """
+        ham = self.get_in_process_hmm(parameter_dir + '/hmms')
+        import pybcrham  # get_in_process_hmm() made sure we can
+        costs = [self.estimate_hmm_cost(qset) for qset in query_sets]
+        chunks = self.get_hmm_chunks(costs, [qset['names'][0] for qset in query_sets], self.args.n_procs * self.args.hmm_chunks_per_proc, components=components)
+        thread_indices = {}  # map from thread name to index in <worker_times>
+
+        def run_chunk(chunk):
+            chunk_start = time.time()
+            lines = getattr(ham, algorithm)([query_sets[iset] for iset in chunk])
+            return threading.current_thread().name, time.time() - chunk_start, lines
+
+        pool = None
+        if self.args.n_procs > 1:
+            pool = ThreadPool(self.args.n_procs)
+            chunk_results = pool.imap_unordered(run_chunk, chunks)
+        else:
+            chunk_results = itertools.imap(run_chunk, chunks)
+        outfile, writer = None, None
+        try:
+            if outpath is not None:
+                outfile = opener('w')(outpath)
+                writer = csv.DictWriter(outfile, pybcrham.columns[algorithm])
+                writer.writeheader()
+            for thread_name, run_time, lines in chunk_results:
+                worker_times.setdefault(thread_indices.setdefault(thread_name, len(thread_indices)), []).append(run_time)
+                for line in lines:
+                    line['unique_ids'] = [hmmbinary.intify_name(uid) for uid in line['unique_ids']]
+                    if writer is not None:
+                        writer.writerow({key:(':'.join([str(v) for v in val]) if isinstance(val, list) else val) for key, val in line.items()})
+                    yield line
+        finally:
+            if outfile is not None:
+                outfile.close()
+            if pool is not None:
+                pool.terminate()
+
+    # ----------------------------------------------------------------------------------------
+    def print_worker_times(self, worker_times):
+        totals = {iworker:sum(times) for iworker, times in worker_times.items()}
+        print '      per-proc busy time (chunks): %s   (max/mean %.2f)' % (' '.join(['%.1f (%d)' % (totals[iw], len(worker_times[iw])) for iw in sorted(totals)]),
+                                                                     max(totals.values()) / max(utils.eps, sum(totals.values()) / len(totals)))
+
+    # ----------------------------------------------------------------------------------------
+    def estimate_hmm_cost(self, line):
+        """
+        Rough estimate of how long bcrham will take on one line of hmm input (i.e. one set of queries), for load balancing.
+        <line> can also be one of the query sets from write_hmm_input() (which have lists instead of colon-separated strings).
+        """
+        seqs = line['seqs'] if isinstance(line['seqs'], list) else line['seqs'].split(':')
+        only_genes = line['only_genes'] if isinstance(line['only_genes'], list) else line['only_genes'].split(':')
+        n_seqs = len(seqs)
+        seq_length = len(seqs[0])
+        n_genes = len(only_genes)
+        k_v_range = max(1, int(line['k_v_max']) - int(line['k_v_min']))
+        k_d_range = max(1, int(line['k_d_max']) - int(line['k_d_min']))
+        return n_seqs * seq_length * n_genes * k_v_range * k_d_range
+
+    # ----------------------------------------------------------------------------------------
+    def get_hmm_chunks(self, costs, first_names, n_chunks, components=None):
+        """
+        Divide the hmm query sets, whose estimated bcrham costs are <costs>, into (at most) <n_chunks> chunks of about the same total cost (assigning the
+        most expensive query sets first, each to whichever chunk is currently cheapest).
+        If <components> (map from query name to precluster id) is set, consecutive query sets from the same precluster (according to the
+        first query in each set, <first_names>) are kept together in one chunk.
+        Returns a list with the query set indices in each chunk, from most to least expensive chunk.
+        """
+        units, unit_costs = [], []  # groups of query sets (well, their indices) that have to go in the same chunk, and their total cost
+        last_component = None
+        for iset in range(len(costs)):
+            this_component = None if components is None else components[first_names[iset]]
+            if components is None or len(units) == 0 or this_component != last_component:
+                units.append([])
+                unit_costs.append(0)
+            units[-1].append(iset)
+            unit_costs[-1] += costs[iset]
+            last_component = this_component
+
+        n_chunks = max(1, min(n_chunks, len(units)))
+        chunks = [[] for _ in range(n_chunks)]
+        chunk_costs = [0] * n_chunks
+        for iunit in sorted(range(len(units)), key=lambda iu: unit_costs[iu], reverse=True):
+            ichunk = chunk_costs.index(min(chunk_costs))
+            chunks[ichunk] += units[iunit]
+            chunk_costs[ichunk] += unit_costs[iunit]
+
+        return [chunks[ichunk] for ichunk in sorted(range(n_chunks), key=lambda ic: chunk_costs[ic], reverse=True)]
+
+    # ----------------------------------------------------------------------------------------
+    def split_hmm_input(self, infname, n_chunks, components=None):
+        """
+        Split the hmm input file <infname> into (at most) <n_chunks> files in subdirectories 'hmm-<ichunk>' of <self.args.workdir>, according to
+        get_hmm_chunks() (so chunks are numbered from most to least expensive). Returns the number of chunks.
+        """
+        binary_input = self.args.hmm_io_format == 'binary'
+        if binary_input:
+            hmm_input = BinaryHmmInput.read(infname)
+            costs = hmm_input.get_costs()
+            first_names = hmm_input.get_first_names()
+        else:
+            with opener('r')(infname) as infile:
+                header = infile.readline()
+                lines = [line for line in infile if line.strip() != '']
+            headfo = header.split()
+            costs = [self.estimate_hmm_cost(dict(zip(headfo, line.split()))) for line in lines]
+            first_names = [line.split()[0].split(':')[0] for line in lines]
+        chunks = self.get_hmm_chunks(costs, first_names, n_chunks, components=components)
+
+        for ichunk in range(len(chunks)):
+            subworkdir = self.args.workdir + '/hmm-' + str(ichunk)
+            utils.prep_dir(subworkdir)
+            sub_infname = subworkdir + '/' + os.path.basename(infname)
+            if binary_input:
+                hmm_input.write(sub_infname, irecords=chunks[ichunk])
+            else:
+                with opener('w')(sub_infname) as sub_outfile:
+                    sub_outfile.write(header)
+                    for iline in chunks[ichunk]:
+                        sub_outfile.write(lines[iline])
+        return len(chunks)
 
     # ----------------------------------------------------------------------------------------
     def split_input(self, n_procs, infname=None, info=None, prefix='sub'):
@@ -263,132 +738,258 @@ class PartitionDriver(object):
             return outlists
 
     # ----------------------------------------------------------------------------------------
-    def merge_hmm_outputs(self, outfname):
-        header = None
-        outfo = []
-        for iproc in range(self.args.n_procs):
-            workdir = self.args.workdir + '/hmm-' + str(iproc)
-            with opener('r')(workdir + '/' + os.path.basename(outfname)) as sub_outfile:
-                reader = csv.DictReader(sub_outfile)
-                header = reader.fieldnames
-                for line in reader:
-                    outfo.append(line)
-            if not self.args.no_clean:
-                os.remove(workdir + '/' + os.path.basename(outfname))
-                os.rmdir(workdir)
+    def stream_hmm_output(self, outfnames, outpath=None):
+        """
+        Generate the lines from each hmm output file in <outfnames>, which can be a generator that yields each chunk's file as soon as it's finished.
+        If <outpath> is set, the lines are also written there as they go by (so the final output is only written once, and never held in memory).
+        Binary (forward) output files (see hmmbinary.py) come out with the ids already split and intified, and the score as a float, and are written to <outpath> as csv.
+        """
+        outfile, writer = None, None
+        try:
+            for outfname in outfnames:
+                binary_output = os.path.splitext(outfname)[1] == '.bin'
+                chunkfile = None
+                if binary_output:
+                    fieldnames = ['unique_ids', 'score', 'errors']
+                    lines = hmmbinary.read_forward_output(outfname)
+                else:
+                    chunkfile = opener('r')(outfname)
+                    lines = csv.DictReader(chunkfile)
+                    fieldnames = lines.fieldnames
+                if outpath is not None and writer is None:
+                    outfile = opener('w')(outpath)
+                    writer = csv.DictWriter(outfile, fieldnames)
+                    writer.writeheader()
+                for line in lines:
+                    if writer is not None:  # write it before yielding, since the caller modifies it
+                        if binary_output:
+                            writer.writerow(dict(line, unique_ids=':'.join([str(uid) for uid in line['unique_ids']])))
+                        else:
+                            writer.writerow(line)
+                    yield line
+                if chunkfile is not None:
+                    chunkfile.close()
+                if not self.args.no_clean:
+                    os.remove(outfname)
+                    subworkdir = os.path.dirname(outfname)
+                    if subworkdir != self.args.workdir:  # chunk subdirectory
+                        for infname in glob.glob(subworkdir + '/' + os.path.basename(outfname).split('_hmm_output')[0] + '_hmm_input.*'):  # input can be binary even if the output isn't
+                            os.remove(infname)
+                        os.rmdir(subworkdir)
+        finally:
+            if outfile is not None:
+                outfile.close()
 
-        with opener('w')(outfname) as outfile:
-            writer = csv.DictWriter(outfile, header)
-            writer.writeheader()
-            for line in outfo:
-                writer.writerow(line)
+    # ----------------------------------------------------------------------------------------
+    def get_cdr3_length_blocks(self, waterer):
+        """ return a map from cdr3 length to the list of queries for which that length is plausible (so a query can be in several blocks) """
+        cdr3_blocks = {}
+        for query in self.input_info:
+            if query not in waterer.info:  # sw failure
+                continue
+            for cdr3_length in waterer.info[query]['cdr3_lengths']:
+                if cdr3_length not in cdr3_blocks:
+                    cdr3_blocks[cdr3_length] = []
+                cdr3_blocks[cdr3_length].append(query)
+        n_ambiguous = len([query for query in self.input_info if query in waterer.info and len(waterer.info[query]['cdr3_lengths']) > 1])
+        print '    %d cdr3 length blocks (%d queries with more than one plausible length)' % (len(cdr3_blocks), n_ambiguous)
+        return cdr3_blocks
 
     # ----------------------------------------------------------------------------------------
-    def cdr3_length_precluster(self, waterer, preclusters=None):
-        cdr3lengthfname = self.args.workdir + '/cdr3lengths.csv'
-        with opener('w')(cdr3lengthfname) as outfile:
-            writer = csv.DictWriter(outfile, ('unique_id', 'second_unique_id', 'cdr3_length', 'second_cdr3_length', 'score'))
-            writer.writeheader()
-            for query_name, second_query_name in self.get_pairs(preclusters):
-                cdr3_length = waterer.info[query_name]['cdr3_length']
-                second_cdr3_length = waterer.info[second_query_name]['cdr3_length']
-                same_length = cdr3_length == second_cdr3_length
-                if not self.args.is_data:
-                    assert cdr3_length == int(self.reco_info[query_name]['cdr3_length'])
-                    if second_cdr3_length != int(self.reco_info[second_query_name]['cdr3_length']):
-                        print 'WARNING did not infer correct cdr3 length'
-                        assert False
-                writer.writerow({'unique_id':query_name, 'second_unique_id':second_query_name, 'cdr3_length':cdr3_length, 'second_cdr3_length':second_cdr3_length, 'score':int(same_length)})
-
-        clust = Clusterer(0.5, greater_than=True)  # i.e. cluster together if same_length == True
-        clust.cluster(cdr3lengthfname, debug=False)
-        os.remove(cdr3lengthfname)
-        return clust
+    def get_blocked_pairs(self, cdr3_blocks):
+        """ generate each pair of queries that share at least one block in <cdr3_blocks> (only once, from the smallest cdr3 length that they share) """
+        cdr3_lengths = {}  # map from query to the set of blocks it's in
+        for cdr3_length, queries in cdr3_blocks.items():
+            for query in queries:
+                if query not in cdr3_lengths:
+                    cdr3_lengths[query] = set()
+                cdr3_lengths[query].add(cdr3_length)
+        for cdr3_length in sorted(cdr3_blocks):
+            for id_a, id_b in itertools.combinations(cdr3_blocks[cdr3_length], 2):
+                if min(cdr3_lengths[id_a] & cdr3_lengths[id_b]) == cdr3_length:
+                    yield id_a, id_b
 
     # ----------------------------------------------------------------------------------------
     def get_pairs(self, preclusters=None):
-        """ Get all unique the pairs of sequences in input_info, skipping where preclustered out """
-        all_pairs = itertools.combinations(self.input_info.keys(), 2)
+        """
+        Generate all the unique pairs of sequences in input_info, skipping where preclustered out.
+        With <preclusters>, only pairs in the same precluster which have a (non-removable) score can make it through, so we only look at
+        those: either by walking all the pairs of each precluster's members, or by walking each member's scored pairs, whichever is fewer. So this is
+        O(min(sum of cluster size^2, number of scored pairs)) rather than O(N^2), nothing is kept in memory, and the pairs come out grouped by precluster.
+        """
         if preclusters == None:
             print '    ?? lines (no preclustering)'  # % len(list(all_pairs)) NOTE I'm all paranoid the list conversion will be slow (although it doesn't seem to be a.t.m.)
-            return all_pairs
-        else:  # if we've already run preclustering, skip the pairs that we know aren't matches
-            preclustered_pairs = []
-            n_lines, n_preclustered, n_previously_preclustered, n_removable, n_singletons = 0, 0, 0, 0, 0
-            for a_name, b_name in all_pairs:
-                key = utils.get_key((a_name, b_name))
-                # NOTE shouldn't need this any more:
-                if a_name not in preclusters.query_clusters or b_name not in preclusters.query_clusters:  # singletons (i.e. they were already preclustered into their own group)
-                    n_singletons += 1
-                    continue
-                if key not in preclusters.pairscores:  # preclustered out in a previous preclustering step
-                    n_previously_preclustered += 1
-                    continue
-                if preclusters.query_clusters[a_name] != preclusters.query_clusters[b_name]:  # not in same cluster
-                    n_preclustered += 1
-                    continue
-                if preclusters.is_removable(preclusters.pairscores[key]):  # in same cluster, but score (link) is long. i.e. *this* pair is far apart, but other seqs to which they are linked are close to each other
-                    n_removable += 1
-                    continue
-                preclustered_pairs.append((a_name, b_name))
-                n_lines += 1
-            print '    %d lines (%d preclustered out, %d removable links, %d singletons, %d previously preclustered)' % (n_lines, n_preclustered, n_removable, n_singletons, n_previously_preclustered)
-            return preclustered_pairs
-
-    # ----------------------------------------------------------------------------------------
-    def get_hamming_distances(self, pairs):  #, return_info):
-        # NOTE duplicates a function in utils
-        return_info = []
-        for query_a, query_b in pairs:
-            seq_a = self.input_info[query_a]['seq']
-            seq_b = self.input_info[query_b]['seq']
-            if self.args.truncate_pairs:  # chop off the left side of the longer one if they're not the same length
-                min_length = min(len(seq_a), len(seq_b))
-                seq_a = seq_a[-min_length : ]
-                seq_b = seq_b[-min_length : ]
-                chopped_off_left_sides = True
-            mutation_frac = utils.hamming(seq_a, seq_b) / float(len(seq_a))
-            return_info.append({'id_a':query_a, 'id_b':query_b, 'score':mutation_frac})
-
-        return return_info
-
-    # ----------------------------------------------------------------------------------------
-    def hamming_precluster(self, preclusters=None):
+            for pair in itertools.combinations(self.input_info.keys(), 2):
+                yield pair
+            return
+
+        clusters = {cluster_id:[query for query in cluster if query in self.input_info] for cluster_id, cluster in preclusters.id_clusters.items()}
+        n_same_cluster = sum([len(cluster) * (len(cluster) - 1) / 2 for cluster in clusters.values()])
+        if n_same_cluster <= len(preclusters.pairscores):  # e.g. if we calculated hamming distances for all pairs
+            scored_pairs = ((a_name, b_name, preclusters.pairscores.get(a_name, b_name)) for cluster in clusters.values() for a_name, b_name in itertools.combinations(cluster, 2))
+        else:  # e.g. with indexed preclustering, where we only have scores for a few of the pairs in each precluster
+            scored_pairs = ((a_name, b_name, score) for cluster_id, cluster in clusters.items() for a_name in cluster for b_name, score in preclusters.pairscores.get_partners(a_name)
+                            if b_name in self.input_info and preclusters.query_clusters[b_name] == cluster_id)
+
+        n_lines, n_removable = 0, 0
+        for a_name, b_name, score in scored_pairs:
+            if score is None:  # preclustered out in a previous preclustering step
+                continue
+            if preclusters.is_removable(score):  # in same cluster, but score (link) is long. i.e. *this* pair is far apart, but other seqs to which they are linked are close to each other
+                n_removable += 1
+                continue
+            n_lines += 1
+            yield a_name, b_name
+
+        n_clustered = sum([len(cluster) for cluster in clusters.values()])
+        n_singletons = len(self.input_info) * (len(self.input_info) - 1) / 2 - n_clustered * (n_clustered - 1) / 2  # pairs where at least one of them was already preclustered into its own group
+        n_preclustered = n_clustered * (n_clustered - 1) / 2 - n_lines - n_removable  # in different preclusters, or preclustered out in a previous step
+        print '    %d lines (%d preclustered out, %d removable links, %d singletons)' % (n_lines, n_preclustered, n_removable, n_singletons)
+
+    # ----------------------------------------------------------------------------------------
+    def get_pair_chunks(self, pairs, chunk_size=10000):
+        """ generate lists of (at most) <chunk_size> of the pairs in the iterable <pairs> """
+        pairs = iter(pairs)
+        while True:
+            chunk = list(itertools.islice(pairs, chunk_size))
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+    # ----------------------------------------------------------------------------------------
+    def get_distance_backend(self, seqs, sw_info=None):
+        """
+        Return the object that calculates preclustering distances between the sequences in <seqs> (dict keyed by query name), according to
+        --precluster-distance. All of them have Hammer's interface, and all of them return distances between 0 and 1 (smaller is closer).
+        """
+        if self.args.precluster_distance == 'hamming':
+            return Hammer(seqs, truncate=self.args.truncate_pairs)  # if truncating, chop off the left side of the longer one if they're not the same length
+        elif self.args.precluster_distance == 'kmer':
+            return KmerDistance(seqs, k=self.args.kmer_length)
+        elif self.args.precluster_distance == 'cdr3-hamming':
+            if sw_info is None:
+                raise Exception('ERROR --precluster-distance cdr3-hamming needs sw info')
+            return Cdr3Hammer(seqs, sw_info)
+        else:
+            raise Exception('ERROR unknown --precluster-distance %s' % self.args.precluster_distance)
+
+    # ----------------------------------------------------------------------------------------
+    def get_hamming_distances(self, pairs, sw_info=None):
+        """ distance (with the --precluster-distance backend) for each pair of query names in <pairs> """
+        seqs = {query:self.input_info[query]['seq'] for query in self.input_info}
+        return self.get_distance_backend(seqs, sw_info=sw_info).get_distances(pairs)
+
+    # ----------------------------------------------------------------------------------------
+    def get_indexed_hamming_distances(self, sw_info=None):
+        """
+        Only calculate hamming distances for pairs that could possibly be under --hamming-cluster-cutoff (see Hammer.get_candidate_pairs()).
+        Pairs above the cutoff would just be removable links, so we don't return them. Queries without any links come back in a separate list
+        of singletons so the clusterer still knows about them.
+        """
+        seqs = {query:self.input_info[query]['seq'] for query in self.input_info}
+        hmr = self.get_distance_backend(seqs, sw_info=sw_info)
+        candidate_pairs = hmr.get_candidate_pairs(self.args.hamming_cluster_cutoff)
+        if candidate_pairs is None:
+            print '    WARNING can\'t index %s distances with cutoff %.3f, so falling back to all pairs' % (self.args.precluster_distance, self.args.hamming_cluster_cutoff)
+            return hmr.get_distances(self.get_pairs()), []
+        hamming_info = hmr.get_distances(candidate_pairs, max_score=self.args.hamming_cluster_cutoff)
+        singletons = self.get_unlinked_queries(hamming_info, self.input_info)
+        print '    %d links (%d singletons)' % (len(hamming_info), len(singletons))
+        return hamming_info, singletons
+
+    # ----------------------------------------------------------------------------------------
+    def get_blocked_hamming_distances(self, cdr3_blocks, sw_info=None):
+        """ Like get_indexed_hamming_distances(), but only for pairs that share a cdr3 length block (see get_blocked_pairs()) """
+        seqs = {query:self.input_info[query]['seq'] for query in self.input_info}
+        hmr = self.get_distance_backend(seqs, sw_info=sw_info)
+        hamming_info = hmr.get_distances(self.get_blocked_pairs(cdr3_blocks), max_score=self.args.hamming_cluster_cutoff)
+        singletons = self.get_unlinked_queries(hamming_info, self.input_info)
+        print '    %d links (%d singletons)' % (len(hamming_info), len(singletons))
+        return hamming_info, singletons
+
+    # ----------------------------------------------------------------------------------------
+    def get_unlinked_queries(self, hamming_info, queries):
+        """ return the queries in <queries> that don't appear in any of the links in <hamming_info> """
+        linked_queries = set()
+        for info in hamming_info:
+            linked_queries.add(info['id_a'])
+            linked_queries.add(info['id_b'])
+        return [query for query in queries if query not in linked_queries]
+
+    # ----------------------------------------------------------------------------------------
+    def get_incremental_hamming_distances(self, existing_partition):
+        """
+        Hamming distances for the queries in <self.input_info> (which aren't in <existing_partition>) to each other, and to every member of the
+        clusters in <existing_partition>. Each existing cluster is then treated as a single query named after its representative, whose distance to a new
+        query is the smallest distance to any of its members (i.e. single linkage). Only returns links under --hamming-cluster-cutoff, plus a
+        list of new queries without any links.
+        """
+        seqs = {query:self.input_info[query]['seq'] for query in self.input_info}
+        representatives = {}  # map from each existing query to the representative of its cluster
+        for cluster in existing_partition:
+            for uid, seq in zip(cluster['unique_ids'], cluster['seqs']):
+                seqs[uid] = seq
+                representatives[uid] = cluster['representative']
+        hmr = self.get_distance_backend(seqs)
+        new_queries = self.input_info.keys()
+        pairs = itertools.chain(itertools.combinations(new_queries, 2), itertools.product(new_queries, representatives.keys()))
+        hamming_info = []
+        min_scores = {}  # map from (new query, representative) to the smallest distance between the new query and a member of the representative's cluster
+        for info in hmr.get_distances(pairs, max_score=self.args.hamming_cluster_cutoff):
+            if info['id_b'] in representatives:
+                key = (info['id_a'], representatives[info['id_b']])
+                if key not in min_scores or info['score'] < min_scores[key]:
+                    min_scores[key] = info['score']
+            else:
+                hamming_info.append(info)
+        hamming_info += [{'id_a':id_a, 'id_b':rep, 'score':score} for (id_a, rep), score in min_scores.items()]
+        singletons = self.get_unlinked_queries(hamming_info, new_queries)
+        print '    %d links (%d to existing clusters, %d singletons)' % (len(hamming_info), len(min_scores), len(singletons))
+        return hamming_info, singletons
+
+    # ----------------------------------------------------------------------------------------
+    def hamming_precluster(self, preclusters=None, existing_partition=None, cdr3_blocks=None, sw_info=None):
+        """ single-linkage cluster with --precluster-distance (which, despite the name, isn't necessarily hamming distance) """
         assert self.args.truncate_pairs
         start = time.time()
         print 'hamming clustering'
         chopped_off_left_sides = False
         hamming_info = []
-        all_pairs = self.get_pairs(preclusters)
-        # print '    getting pairs: %.3f' % (time.time()-start); start = time.time()
-        # all_pairs = itertools.combinations(self.input_info.keys(), 2)
-        if self.args.n_fewer_procs > 1:
-            pool = Pool(processes=self.args.n_fewer_procs)
-            subqueries = self.split_input(self.args.n_fewer_procs, info=list(all_pairs), prefix='hamming')  # NOTE 'casting' to a list here makes me nervous!
-            sublists = []
-            for queries in subqueries:
-                sublists.append([])
-                for id_a, id_b in queries:
-                    sublists[-1].append({'id_a':id_a, 'id_b':id_b, 'seq_a':self.input_info[id_a]['seq'], 'seq_b':self.input_info[id_b]['seq']})
-            
-            # print '    preparing info: %.3f' % (time.time()-start); start = time.time()
-            subinfos = pool.map(utils.get_hamming_distances, sublists)
-            # NOTE this starts the proper number of processes, but they seem to end up i/o blocking or something (wait % stays at zero, but they each only get 20 or 30 %cpu on stoat)
+        singletons = []
+        if existing_partition is not None:
+            assert preclusters is None
+            hamming_info, singletons = self.get_incremental_hamming_distances(existing_partition)
+        elif cdr3_blocks is not None:
+            assert preclusters is None
+            hamming_info, singletons = self.get_blocked_hamming_distances(cdr3_blocks, sw_info=sw_info)
+        elif preclusters is None and self.args.indexed_hamming_precluster:
+            hamming_info, singletons = self.get_indexed_hamming_distances(sw_info=sw_info)
+        elif self.args.n_fewer_procs > 1 and self.args.precluster_distance == 'hamming':
+            # the workers memory-map the encoded sequences, so we only have to send them pairs of indices
+            hmr = Hammer({query:self.input_info[query]['seq'] for query in self.input_info}, truncate=self.args.truncate_pairs)
+            matrix_fname = self.args.workdir + '/hamming-seqs.bin'
+            hmr.write_matrix(matrix_fname)
+            pool = Pool(processes=self.args.n_fewer_procs, initializer=hammer.init_worker, initargs=(matrix_fname, hmr.matrix.shape, hmr.lengths, hmr.truncate))
+            pair_chunks = self.get_pair_chunks(self.get_pairs(preclusters))
+            while True:  # hand out chunks a few per proc at a time, so we never have more than that many pairs in memory
+                chunks = list(itertools.islice(pair_chunks, 2 * self.args.n_fewer_procs))
+                if len(chunks) == 0:
+                    break
+                subfractions = pool.map(hammer.get_index_fractions, [hmr.get_index_pairs(chunk) for chunk in chunks])
+                for chunk, fractions in zip(chunks, subfractions):
+                    hamming_info += [{'id_a':id_a, 'id_b':id_b, 'score':float(fraction)} for (id_a, id_b), fraction in zip(chunk, fractions)]
             pool.close()
             pool.join()
-            # print '    starting pools: %.3f' % (time.time()-start); start = time.time()
-    
-            for isub in range(len(subinfos)):
-                hamming_info += subinfos[isub]
-            # print '    merging pools: %.3f' % (time.time()-start); start = time.time()
+            if not self.args.no_clean:
+                os.remove(matrix_fname)
         else:
-            hamming_info = self.get_hamming_distances(all_pairs)
+            hamming_info = self.get_hamming_distances(self.get_pairs(preclusters), sw_info=sw_info)
 
         if self.outfile is not None:
             self.outfile.write('hamming clusters\n')
 
-        clust = Clusterer(self.args.hamming_cluster_cutoff, greater_than=False)  # NOTE this 0.5 is reasonable but totally arbitrary
-        clust.cluster(input_scores=hamming_info, debug=self.args.debug, outfile=self.outfile, reco_info=self.reco_info)
+        clust = Clusterer(self.args.hamming_cluster_cutoff, greater_than=False, singletons=singletons)  # NOTE this 0.5 is reasonable but totally arbitrary
+        clust.cluster(input_scores=hamming_info, debug=self.args.debug, outfile=self.outfile, reco_info=self.reco_info, max_scores_in_memory=self.args.max_scores_in_memory, workdir=self.args.workdir)
         # print '    clustering: %.3f' % (time.time()-start); start = time.time()
 
         if chopped_off_left_sides:
@@ -399,11 +1000,31 @@ class PartitionDriver(object):
     
     # ----------------------------------------------------------------------------------------
     def write_hmms(self, parameter_dir, sw_matches):
+        """
+        Write an hmm yaml for each gene in <sw_matches> (or --only-genes), and a compiled bundle of all of them (see hmmbundle.py) for bcrham to map.
+        With --incremental-hmm-writing, keep any existing yaml whose fingerprint (see HmmWriter.get_fingerprint()) hasn't changed.
+        """
         print 'writing hmms with info from %s' % parameter_dir
         start = time.time()
-        from hmmwriter import HmmWriter
+        import hmmwriter
+        import hmmbundle
         hmm_dir = parameter_dir + '/hmms'
-        utils.prep_dir(hmm_dir, '*.yaml')
+        self.in_process_hmms.pop(hmm_dir, None)  # don't keep running on the old versions
+        if self.hmm_workers is not None:  # the persistent workers never reread an hmm they've already read, so start them over
+            self.hmm_workers.close()
+            self.hmm_workers = None
+        fingerprint_fname = hmm_dir + '/fingerprints.csv'
+        bundle_fname = hmm_dir + '/' + hmmbundle.bundle_fname
+        old_fingerprints, old_records = {}, {}
+        if self.args.incremental_hmm_writing and os.path.exists(fingerprint_fname):
+            with opener('r')(fingerprint_fname) as fingerprint_file:
+                reader = csv.DictReader(fingerprint_file)
+                for line in reader:
+                    old_fingerprints[line['gene']] = line['fingerprint']
+            if os.path.exists(bundle_fname):
+                old_records = hmmbundle.read_records(bundle_fname)
+        else:
+            utils.prep_dir(hmm_dir, multilings=('*.yaml', 'fingerprints.csv', hmmbundle.bundle_fname))
 
         gene_list = self.args.only_genes
         if gene_list == None:  # if specific genes weren't specified, do the ones for which we have matches
@@ -413,15 +1034,45 @@ class PartitionDriver(object):
                     if sw_matches == None or gene in sw_matches:  # shouldn't be None really, but I'm testing something
                         gene_list.append(gene)
 
+        if self.args.incremental_hmm_writing:  # remove yamls for genes we're not writing this time, so we end up with the same files as if we'd started from scratch
+            yaml_fnames = set([hmm_dir + '/' + utils.sanitize_name(gene) + '.yaml' for gene in gene_list])
+            for fname in glob.glob(hmm_dir + '/*.yaml'):
+                if fname not in yaml_fnames:
+                    os.remove(fname)
+
+        writer_info = []
         for gene in gene_list:
             if self.args.debug:
                 print '  %s' % utils.color_gene(gene)
-            writer = HmmWriter(parameter_dir, hmm_dir, gene, self.args.naivety,
-                               self.germline_seqs[utils.get_region(gene)][gene],
-                               self.args)
-            writer.write()
+            writer_info.append({'parameter_dir':parameter_dir, 'hmm_dir':hmm_dir, 'gene':gene, 'naivety':self.args.naivety,
+                                'germline_seq':self.germline_seqs[utils.get_region(gene)][gene], 'args':self.args, 'old_fingerprint':old_fingerprints.get(gene),
+                                'have_old_record':utils.sanitize_name(gene) in old_records})
+        utils.load_parameter_tables(parameter_dir)  # parse the parameter csvs once (before forking the pool, so the workers inherit them)
+        try:
+            if self.args.n_fewer_procs > 1 and len(writer_info) > 1:
+                pool = Pool(processes=self.args.n_fewer_procs)
+                results = pool.map(hmmwriter.write_hmm, writer_info)
+                pool.close()
+                pool.join()
+            else:
+                results = [hmmwriter.write_hmm(info) for info in writer_info]
+        finally:
+            utils.clear_parameter_tables()
+
+        with opener('w')(fingerprint_fname) as fingerprint_file:
+            writer = csv.DictWriter(fingerprint_file, ('gene', 'fingerprint'))
+            writer.writeheader()
+            for gene, fingerprint, _, _ in results:
+                writer.writerow({'gene':gene, 'fingerprint':fingerprint})
 
-        print '    time to write hmms: %.3f' % (time.time()-start)
+        records = {}
+        for gene, _, wrote, record in results:
+            name = utils.sanitize_name(gene)
+            records[name] = record if wrote else old_records[name]
+        hmmbundle.write_bundle(bundle_fname, records)
+
+        n_written = len([wrote for _, _, wrote, _ in results if wrote])
+        print '    wrote %d hmms (%d unchanged), time: %.3f' % (n_written, len(results) - n_written, time.time()-start)
 
     # ----------------------------------------------------------------------------------------
     def check_hmm_existence(self, gene_list, skipped_gene_matches, parameter_dir, query_name, second_query_name=None):
@@ -522,27 +1173,41 @@ class PartitionDriver(object):
         return return_names
 
     # ----------------------------------------------------------------------------------------
-    def write_hmm_input(self, csv_fname, sw_info, parameter_dir, preclusters=None, hmm_type='', pair_hmm=False, stripped=False):
+    def write_hmm_input(self, csv_fname, sw_info, parameter_dir, preclusters=None, hmm_type='', pair_hmm=False, stripped=False, pair_score_cache=None, nsets=None,
+                        query_sets=None):
+        """
+        Write the bcrham input file for <hmm_type>.
+        If <query_sets> is set (a list), the query sets are instead appended to it, as dicts with the input file's columns (but with lists instead of
+        colon-separated strings), which is what pybcrham wants (see run_hmm_in_process()).
+        If <pair_score_cache> is set, pairs that it already has scores for are left out, and their scores are returned (as a list of {'id_a', 'id_b', 'score'} dicts).
+        For hmm_type 'k=sets', writes the query sets in <nsets> (list of lists of query names).
+        """
         print '    writing input'
-        csvfile = opener('w')(csv_fname)
         start = time.time()
-
-        # write header
-        header = ['names', 'k_v_min', 'k_v_max', 'k_d_min', 'k_d_max', 'only_genes', 'seqs']  # I wish I had a good c++ csv reader 
-        csvfile.write(' '.join(header) + '\n')
+        binary_input, csvfile = None, None
+        if query_sets is not None:  # nothing to write
+            pass
+        elif self.args.hmm_io_format == 'binary':  # accumulate the columns, and write them all at the end
+            binary_input = BinaryHmmInput()
+        else:
+            csvfile = opener('w')(csv_fname)
+            header = ['names', 'k_v_min', 'k_v_max', 'k_d_min', 'k_d_max', 'only_genes', 'seqs']  # I wish I had a good c++ csv reader 
+            csvfile.write(' '.join(header) + '\n')
 
         skipped_gene_matches = set()
         assert hmm_type != ''
         if hmm_type == 'k=1':  # single vanilla hmm
             nsets = [[qn] for qn in self.input_info.keys()]
         elif hmm_type == 'k=2':  # pair hmm
-            nsets = self.get_pairs(preclusters)
+            nsets = self.get_pairs(preclusters)  # grouped by precluster, which get_hmm_chunks() relies on if we're sharding
         elif hmm_type == 'k=preclusters':  # run the k-hmm on each cluster in <preclusters>
             assert preclusters != None
             nsets = [ val for key, val in preclusters.id_clusters.items() if len(val) > 1 ]  # <nsets> is a list of sets (well, lists) of query names
             # nsets = []
             # for cluster in preclusters.id_clusters.values():
             #     nsets += itertools.combinations(cluster, 5)
+        elif hmm_type == 'k=sets':  # run on the sets we were given
+            assert nsets is not None
         elif hmm_type == 'k=nsets':  # run on *every* combination of queries which has length <self.args.n_sets>
             if self.args.all_combinations:
                 nsets = itertools.combinations(self.input_info.keys(), self.args.n_sets)
@@ -561,6 +1226,7 @@ class PartitionDriver(object):
         else:
             assert False
 
+        cached_pairscores = []
         for query_names in nsets:
             non_failed_names = self.remove_sw_failures(query_names, sw_info)
             if len(non_failed_names) == 0:
@@ -568,6 +1234,19 @@ class PartitionDriver(object):
             combined_query = self.combine_queries(sw_info, non_failed_names, parameter_dir, stripped=stripped, skipped_gene_matches=skipped_gene_matches)
             if len(combined_query) == 0:  # didn't find all regions
                 continue
+            if pair_score_cache is not None and len(non_failed_names) == 2:
+                score = pair_score_cache.lookup(non_failed_names, combined_query)
+                if score is not None:
+                    cached_pairscores.append({'id_a':non_failed_names[0], 'id_b':non_failed_names[1], 'score':score})
+                    continue
+            if query_sets is not None:
+                query_sets.append({'names':[str(qn) for qn in non_failed_names], 'k_v_min':combined_query['k_v']['min'], 'k_v_max':combined_query['k_v']['max'],
+                                   'k_d_min':combined_query['k_d']['min'], 'k_d_max':combined_query['k_d']['max'], 'only_genes':combined_query['only_genes'], 'seqs':combined_query['seqs']})
+                continue
+            if binary_input is not None:
+                binary_input.add([str(qn) for qn in non_failed_names], combined_query['k_v']['min'], combined_query['k_v']['max'], combined_query['k_d']['min'], combined_query['k_d']['max'],
+                                 combined_query['only_genes'], combined_query['seqs'])
+                continue
             csvfile.write('%s %d %d %d %d %s %s\n' %  # NOTE csv.DictWriter can handle tsvs, so this should really be switched to use that
                           (':'.join([str(qn) for qn in non_failed_names]),
                            combined_query['k_v']['min'], combined_query['k_v']['max'],
@@ -580,11 +1259,22 @@ class PartitionDriver(object):
             for region in utils.regions:
                 print '      %s: %s' % (region, ' '.join([utils.color_gene(gene) for gene in skipped_gene_matches if utils.get_region(gene) == region]))
 
-        csvfile.close()
+        if binary_input is not None:
+            binary_input.write(csv_fname)
+        elif csvfile is not None:
+            csvfile.close()
+        if pair_score_cache is not None:
+            print '        %d cached pair scores' % len(cached_pairscores)
         print '        input write time: %.3f' % (time.time()-start)
+        return cached_pairscores
 
     # ----------------------------------------------------------------------------------------
-    def read_hmm_output(self, algorithm, hmm_csv_outfname, make_clusters=True, count_parameters=False, parameter_out_dir=None, plotdir=None):
+    def read_hmm_output(self, algorithm, hmm_output_lines, make_clusters=True, count_parameters=False, parameter_out_dir=None, plotdir=None, clusters=None, pair_score_cache=None):
+        """
+        <hmm_output_lines> is an iterable of csv lines (dicts) from bcrham, e.g. from stream_hmm_output().
+        If <clusters> is set, forward pair scores are added to it (and to <pair_score_cache>, if set) as they're read, instead of being returned, so
+        we never hold the whole score table in memory. The caller is responsible for calling clusters.finalize().
+        """
         print '    read output'
         if count_parameters:
             assert parameter_out_dir is not None
@@ -595,60 +1285,65 @@ class PartitionDriver(object):
 
         n_processed = 0
         hmminfo = []
-        with opener('r')(hmm_csv_outfname) as hmm_csv_outfile:
-            reader = csv.DictReader(hmm_csv_outfile)
-            last_key = None
-            boundary_error_queries = []
-            for line in reader:
+        last_key = None
+        boundary_error_queries = []
+        for line in hmm_output_lines:
+            if not isinstance(line['unique_ids'], list):  # binary output comes already intified
                 utils.intify(line, splitargs=('unique_ids', 'seqs'))
-                ids = line['unique_ids']
-                this_key = utils.get_key(ids)
-                same_event = from_same_event(self.args.is_data, True, self.reco_info, ids)
-                id_str = ''.join(['%20s ' % i for i in ids])
-
-                # check for errors
-                if last_key != this_key:  # if this is the first line for this set of ids (i.e. the best viterbi path or only forward score)
-                    if line['errors'] != None and 'boundary' in line['errors'].split(':'):
-                        boundary_error_queries.append(':'.join([str(uid) for uid in ids]))
-                    else:
-                        assert len(line['errors']) == 0
-
-                if algorithm == 'viterbi':
-                    line['seq'] = line['seqs'][0]  # add info for the best match as 'seq'
-                    line['unique_id'] = ids[0]
-                    utils.add_match_info(self.germline_seqs, line, self.cyst_positions, self.tryp_positions, debug=(self.args.debug > 0))
-
-                    if last_key != this_key or self.args.plot_all_best_events:  # if this is the first line (i.e. the best viterbi path) for this query (or query pair), print the true event
-                        n_processed += 1
-                        if self.args.debug:
-                            print '%s   %d' % (id_str, same_event)
-                        if line['cdr3_length'] != -1 or not self.args.skip_unproductive:  # if it's productive, or if we're not skipping unproductive rearrangements
-                            hmminfo.append(dict([('unique_id', line['unique_ids'][0]), ] + line.items()))
-                            if pcounter is not None:  # increment counters (but only for the best [first] match)
-                                pcounter.increment(line)
-                            if true_pcounter is not None:  # increment true counters
-                                true_pcounter.increment(self.reco_info[ids[0]])
-                            if perfplotter is not None:
-                                perfplotter.evaluate(self.reco_info[ids[0]], line)
+            ids = line['unique_ids']
+            this_key = utils.get_key(ids)
+            same_event = from_same_event(self.args.is_data, True, self.reco_info, ids)
+            id_str = ''.join(['%20s ' % i for i in ids])
+
+            # check for errors
+            if last_key != this_key:  # if this is the first line for this set of ids (i.e. the best viterbi path or only forward score)
+                if line['errors'] != None and 'boundary' in line['errors'].split(':'):
+                    boundary_error_queries.append(':'.join([str(uid) for uid in ids]))
+                else:
+                    assert len(line['errors']) == 0
+
+            if algorithm == 'viterbi':
+                line['seq'] = line['seqs'][0]  # add info for the best match as 'seq'
+                line['unique_id'] = ids[0]
+                utils.add_match_info(self.germline_seqs, line, self.cyst_positions, self.tryp_positions, debug=(self.args.debug > 0))
 
+                if last_key != this_key or self.args.plot_all_best_events:  # if this is the first line (i.e. the best viterbi path) for this query (or query pair), print the true event
+                    n_processed += 1
                     if self.args.debug:
-                        self.print_hmm_output(line, print_true=(last_key != this_key), perfplotter=perfplotter)
-                    line['seq'] = None
-                    line['unique_id'] = None
-
-                else:  # for forward, write the pair scores to file to be read by the clusterer
-                    if not make_clusters:  # self.args.debug or 
-                        print '%3d %10.3f    %s' % (same_event, float(line['score']), id_str)
-                    if line['score'] == '-nan':
-                        print '    WARNING encountered -nan, setting to -999999.0'
-                        score = -999999.0
+                        print '%s   %d' % (id_str, same_event)
+                    if line['cdr3_length'] != -1 or not self.args.skip_unproductive:  # if it's productive, or if we're not skipping unproductive rearrangements
+                        hmminfo.append(dict([('unique_id', line['unique_ids'][0]), ] + line.items()))
+                        if pcounter is not None:  # increment counters (but only for the best [first] match)
+                            pcounter.increment(line)
+                        if true_pcounter is not None and ids[0] in self.reco_info:  # increment true counters
+                            true_pcounter.increment(self.reco_info[ids[0]])
+                        if perfplotter is not None and ids[0] in self.reco_info:
+                            perfplotter.evaluate(self.reco_info[ids[0]], line)
+
+                if self.args.debug:
+                    self.print_hmm_output(line, print_true=(last_key != this_key), perfplotter=perfplotter)
+                line['seq'] = None
+                line['unique_id'] = None
+
+            else:  # for forward, write the pair scores to file to be read by the clusterer
+                if not make_clusters:  # self.args.debug or 
+                    print '%3d %10.3f    %s' % (same_event, float(line['score']), id_str)
+                score = float(line['score'])
+                if math.isnan(score):
+                    print '    WARNING encountered -nan, setting to -999999.0'
+                    score = -999999.0
+                if len(ids) == 2:
+                    if pair_score_cache is not None:
+                        pair_score_cache.add_score(ids[0], ids[1], score)
+                    if clusters is not None:
+                        clusters.add_score(ids[0], ids[1], score, debug=self.args.debug, reco_info=self.reco_info, outfile=self.outfile, plotdir=self.args.plotdir+'/pairscores')
                     else:
-                        score = float(line['score'])
-                    if len(ids) == 2:
-                        hmminfo.append({'id_a':line['unique_ids'][0], 'id_b':line['unique_ids'][1], 'score':score})
-                    n_processed += 1
+                        hmminfo.append({'id_a':ids[0], 'id_b':ids[1], 'score':score})
+                elif len(ids) > 2:
+                    hmminfo.append({'unique_ids':ids, 'score':score})
+                n_processed += 1
 
-                last_key = utils.get_key(ids)
+            last_key = utils.get_key(ids)
 
         if pcounter is not None:
             pcounter.write(parameter_out_dir)
@@ -671,6 +1366,8 @@ class PartitionDriver(object):
     def get_true_clusters(self, ids):
         clusters = {}
         for uid in ids:
+            if uid not in self.reco_info:  # no truth info for it (see from_same_event())
+                continue
             rid = self.reco_info[uid]['reco_id']
             found = False
             for clid in clusters:
@@ -714,6 +714,32 @@ def are_same_primary_version(gene1, gene2):
     str_2 = gene2[0 : gene2.find('-')]
     return str_1 == str_2
 
+# ----------------------------------------------------------------------------------------
+parameter_tables = {}  # map from parameter csv file name to its (already parsed) rows, filled by load_parameter_tables()
+
+# ----------------------------------------------------------------------------------------
+def load_parameter_tables(indir):
+    """
+    Parse each parameter csv in <indir> (and <indir>/mute-freqs) once, so read_parameter_csv() doesn't have to go back to disk for every gene.
+    Since this is a module-level variable, processes forked afterwards (e.g. by multiprocessing.Pool) get a copy without any extra work.
+    NOTE call clear_parameter_tables() when you're done, so nobody reads stale tables after the files are rewritten.
+    """
+    for fname in glob.glob(indir + '/*.csv') + glob.glob(indir + '/mute-freqs/*.csv'):
+        with opener('r')(fname) as infile:
+            parameter_tables[fname] = list(csv.DictReader(infile))
+
+# ----------------------------------------------------------------------------------------
+def clear_parameter_tables():
+    parameter_tables.clear()
+
+# ----------------------------------------------------------------------------------------
+def read_parameter_csv(fname):
+    """ Return the rows (as dicts, which you shouldn't modify) of parameter csv <fname>, from the pre-parsed tables if they've been loaded. """
+    if fname in parameter_tables:
+        return parameter_tables[fname]
+    with opener('r')(fname) as infile:
+        return list(csv.DictReader(infile))
+
 # ----------------------------------------------------------------------------------------
 def read_overall_gene_probs(indir, only_gene='', normalize=True):
     """
@@ -725,15 +751,13 @@ def read_overall_gene_probs(indir, only_gene='', normalize=True):
     probs = { region:{} for region in regions }
     for region in regions:
         total = 0
-        with opener('r')(indir + '/' + region + '_gene-probs.csv') as infile:  # NOTE note this ignores correlations... which I think is actually ok, but it wouldn't hurt to think through it again at some point
-            reader = csv.DictReader(infile)
-            for line in reader:
-                line_count = int(line['count'])
-                gene = line[region + '_gene']
-                total += line_count
-                if gene not in counts[region]:
-                    counts[region][gene] = 0
-                counts[region][gene] += line_count
+        for line in read_parameter_csv(indir + '/' + region + '_gene-probs.csv'):  # NOTE note this ignores correlations... which I think is actually ok, but it wouldn't hurt to think through it again at some point
+            line_count = int(line['count'])
+            gene = line[region + '_gene']
+            total += line_count
+            if gene not in counts[region]:
+                counts[region][gene] = 0
+            counts[region][gene] += line_count
         if total < 1:
             assert total == 0
             print 'ERROR zero counts in %s' % indir + '/' + region + '_gene-probs.csv'
@@ -773,18 +797,16 @@ def find_replacement_genes(indir, min_counts, gene_name=None, single_gene=False,
     lists['allele'] = []  # list of genes that are alleles of <gene_name>
     lists['primary_version'] = []  # same primary version as <gene_name>
     lists['all'] = []  # give up and return everything
-    with opener('r')(indir + '/' + region + '_gene-probs.csv') as infile:  # NOTE note this ignores correlations... which I think is actually ok, but it wouldn't hurt to think through it again at some point
-        reader = csv.DictReader(infile)
-        for line in reader:
-            gene = line[region + '_gene']
-            count = int(line['count'])
-            vals = {'gene':gene, 'count':count}
-            if all_from_region == '':
-                if are_alleles(gene, gene_name):
-                    lists['allele'].append(vals)
-                if are_same_primary_version(gene, gene_name):
-                    lists['primary_version'].append(vals)
-            lists['all'].append(vals)
+    for line in read_parameter_csv(indir + '/' + region + '_gene-probs.csv'):  # NOTE note this ignores correlations... which I think is actually ok, but it wouldn't hurt to think through it again at some point
+        gene = line[region + '_gene']
+        count = int(line['count'])
+        vals = {'gene':gene, 'count':count}
+        if all_from_region == '':
+            if are_alleles(gene, gene_name):
+                lists['allele'].append(vals)
+            if are_same_primary_version(gene, gene_name):
+                lists['primary_version'].append(vals)
+        lists['all'].append(vals)
 
     if single_gene:
         for list_type in lists:
@@ -820,22 +842,6 @@ def find_replacement_genes(indir, min_counts, gene_name=None, single_gene=False,
     # return hackey_default_gene_versions[region]
 
 
-# ----------------------------------------------------------------------------------------
-def get_hamming_distances(pairs):
-    return_info = []
-    for info in pairs:
-        seq_a = info['seq_a']
-        seq_b = info['seq_b']
-        if True:  #self.args.truncate_pairs:  # chop off the left side of the longer one if they're not the same length
-            min_length = min(len(seq_a), len(seq_b))
-            seq_a = seq_a[-min_length : ]
-            seq_b = seq_b[-min_length : ]
-            chopped_off_left_sides = True
-        mutation_frac = hamming(seq_a, seq_b) / float(len(seq_a))
-        return_info.append({'id_a':info['id_a'], 'id_b':info['id_b'], 'score':mutation_frac})
-
-    return return_info
-
 # ----------------------------------------------------------------------------------------
 def hamming(seq1, seq2):
     assert len(seq1) == len(seq2)
@@ -906,7 +912,7 @@ def intify(info, splitargs=()):
 
 # ----------------------------------------------------------------------------------------
 def merge_csvs(outfname, csv_list, cleanup=True):
-    """ NOTE copy of merge_hmm_outputs in partitiondriver, I should really combine the two functions """
+    """ NOTE similar to stream_hmm_output in partitiondriver, but reads everything into memory before writing """
     header = None
     outfo = []
     # print 'merging'
@@ -6,6 +6,7 @@ import csv
 import os
 import itertools
 import operator
+import hashlib
 import pysam
 import contextlib
 from subprocess import check_call, check_output, Popen
@@ -50,6 +51,9 @@ class Waterer(object):
         self.n_unproductive = 0
         self.n_total = 0
 
+        self.sw_cache = {}  # map from sequence hash to s-w matches from previous runs (only used with --sw-cache-dir)
+        self.new_sw_cache = {}  # matches for sequences we align this time, to add to the cache
+
     # ----------------------------------------------------------------------------------------
     def __del__(self):
         if self.args.outfname != None:
@@ -69,26 +73,38 @@ class Waterer(object):
         base_infname = 'query-seqs.fa'
         base_outfname = 'query-seqs.bam'
         sys.stdout.flush()
-        self.write_vdjalign_input(base_infname)
-        if self.args.n_procs == 1:
+        self.read_sw_cache()
+        aligned_queries, cached_queries = [], []
+        for query_name in self.input_info:
+            if self.get_seq_hash(self.input_info[query_name]['seq']) in self.sw_cache:
+                cached_queries.append(query_name)
+            else:
+                aligned_queries.append(query_name)
+        if self.args.sw_cache_dir is not None:
+            print '    sw cache: %d / %d queries cached' % (len(cached_queries), len(self.input_info))
+        n_procs = min(self.args.n_procs, len(aligned_queries))  # zero if everybody's cached
+        if n_procs > 0:
+            self.write_vdjalign_input(base_infname, aligned_queries, n_procs)
+        if n_procs == 1:
             cmd_str = self.get_vdjalign_cmd_str(self.args.workdir, base_infname, base_outfname)
             check_call(cmd_str.split())
             if not self.args.no_clean:
                 os.remove(self.args.workdir + '/' + base_infname)
-        else:
+        elif n_procs > 1:
             procs = []
-            for iproc in range(self.args.n_procs):
+            for iproc in range(n_procs):
                 cmd_str = self.get_vdjalign_cmd_str(self.args.workdir + '/sw-' + str(iproc), base_infname, base_outfname, iproc)
                 procs.append(Popen(cmd_str.split()))
                 time.sleep(0.1)
             for proc in procs:
                 proc.wait()
             if not self.args.no_clean:
-                for iproc in range(self.args.n_procs):
+                for iproc in range(n_procs):
                     os.remove(self.args.workdir + '/sw-' + str(iproc) + '/' + base_infname)
 
         sys.stdout.flush()
-        self.read_output(base_outfname, plot_performance=self.args.plot_performance)
+        self.read_output(base_outfname, n_procs, cached_queries, plot_performance=self.args.plot_performance)
+        self.write_sw_cache()
         print '    sw time: %.3f' % (time.time()-start)
         if self.n_unproductive > 0:
             print '    unproductive skipped %d / %d = %.2f' % (self.n_unproductive, self.n_total, float(self.n_unproductive) / self.n_total)
@@ -102,27 +118,23 @@ class Waterer(object):
                     self.true_pcounter.plot(self.plotdir + '/true', subset_by_gene=True, cyst_positions=self.cyst_positions, tryp_positions=self.tryp_positions)
 
     # ----------------------------------------------------------------------------------------
-    def write_vdjalign_input(self, base_infname):
-        # first make a list of query names so we can iterate over an ordered collection
-        ordered_info = []
-        for query_name in self.input_info:
-            ordered_info.append(query_name)
-
-        queries_per_proc = float(len(self.input_info)) / self.args.n_procs
+    def write_vdjalign_input(self, base_infname, query_names, n_procs):
+        """ write the sequences for <query_names> (an ordered list) to fasta input files for <n_procs> vdjalign processes """
+        queries_per_proc = float(len(query_names)) / n_procs
         n_queries_per_proc = int(math.ceil(queries_per_proc))
-        if self.args.n_procs == 1:  # double check for rounding problems or whatnot
-            assert n_queries_per_proc == len(self.input_info)
-        for iproc in range(self.args.n_procs):
+        if n_procs == 1:  # double check for rounding problems or whatnot
+            assert n_queries_per_proc == len(query_names)
+        for iproc in range(n_procs):
             workdir = self.args.workdir
-            if self.args.n_procs > 1:
+            if n_procs > 1:
                 workdir += '/sw-' + str(iproc)
                 utils.prep_dir(workdir)
             infname = workdir + '/' + base_infname
             with opener('w')(workdir + '/' + base_infname) as sub_infile:
                 for iquery in range(iproc*n_queries_per_proc, (iproc + 1)*n_queries_per_proc):
-                    if iquery >= len(ordered_info):
+                    if iquery >= len(query_names):
                         break
-                    query_name = ordered_info[iquery]
+                    query_name = query_names[iquery]
                     sub_infile.write('>' + str(query_name) + ' NUKES\n')
                     sub_infile.write(self.input_info[query_name]['seq'] + '\n')
 
@@ -131,23 +143,75 @@ class Waterer(object):
         """
         Run smith-waterman alignment (from Connor's ighutils package) on the seqs in <base_infname>, and toss all the top matches into <base_outfname>.
         """
-        # large gap-opening penalty: we want *no* gaps in the middle of the alignments
-        # match score larger than (negative) mismatch score: we want to *encourage* some level of shm. If they're equal, we tend to end up with short unmutated alignments, which screws everything up
         os.environ['PATH'] = os.getenv('PWD') + '/packages/samtools:' + os.getenv('PATH')
         check_output(['which', 'samtools'])
         cmd_str = self.args.ighutil_dir + '/bin/vdjalign align-fastq -q'
         if self.args.slurm:
             cmd_str = 'srun ' + cmd_str
-        cmd_str += ' --max-drop 50'
-        cmd_str += ' --match 5 --mismatch 3'
-        cmd_str += ' --gap-open 1000'
+        cmd_str += ' ' + self.get_vdjalign_options()
         cmd_str += ' --vdj-dir ' + self.args.datadir
         cmd_str += ' ' + workdir + '/' + base_infname + ' ' + workdir + '/' + base_outfname
 
         return cmd_str
 
     # ----------------------------------------------------------------------------------------
-    def read_output(self, base_outfname, plot_performance=False):
+    def get_vdjalign_options(self):
+        """ alignment parameters (kept separate so they can go into the s-w cache digest) """
+        # large gap-opening penalty: we want *no* gaps in the middle of the alignments
+        # match score larger than (negative) mismatch score: we want to *encourage* some level of shm. If they're equal, we tend to end up with short unmutated alignments, which screws everything up
+        return '--max-drop 50 --match 5 --mismatch 3 --gap-open 1000'
+
+    # ----------------------------------------------------------------------------------------
+    def get_seq_hash(self, seq):
+        return hashlib.sha1(seq).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def get_sw_cache_fname(self):
+        """ cache file for the current germline set and alignment parameters (if either changes, we get a new file) """
+        digest = hashlib.sha1(self.get_vdjalign_options())
+        for region in utils.regions:
+            for gene in sorted(self.germline_seqs[region]):
+                digest.update('%s %s %s\n' % (region, gene, self.germline_seqs[region][gene]))
+        return self.args.sw_cache_dir + '/sw-cache-' + digest.hexdigest()[:16] + '.csv'
+
+    # ----------------------------------------------------------------------------------------
+    def read_sw_cache(self):
+        """ read the cached matches for any of our input sequences that we've aligned before """
+        if self.args.sw_cache_dir is None or not os.path.exists(self.get_sw_cache_fname()):
+            return
+        seq_hashes = set([self.get_seq_hash(self.input_info[query_name]['seq']) for query_name in self.input_info])
+        with opener('r')(self.get_sw_cache_fname()) as cachefile:
+            reader = csv.DictReader(cachefile)
+            for line in reader:
+                if line['seq_hash'] not in seq_hashes:
+                    continue
+                matches = []
+                for match_str in line['matches'].split(':'):
+                    gene, raw_score, qr_start, qr_end, gl_start, gl_end = match_str.split(';')
+                    matches.append((gene, int(raw_score), (int(qr_start), int(qr_end)), (int(gl_start), int(gl_end))))
+                self.sw_cache[line['seq_hash']] = matches
+
+    # ----------------------------------------------------------------------------------------
+    def write_sw_cache(self):
+        """ append the matches for the sequences we aligned this time to the cache file """
+        if self.args.sw_cache_dir is None or len(self.new_sw_cache) == 0:
+            return
+        if not os.path.exists(self.args.sw_cache_dir):
+            os.makedirs(self.args.sw_cache_dir)
+        cachefname = self.get_sw_cache_fname()
+        write_header = not os.path.exists(cachefname)
+        with open(cachefname, 'a') as cachefile:
+            writer = csv.DictWriter(cachefile, ('seq_hash', 'matches'))
+            if write_header:
+                writer.writeheader()
+            for seq_hash, matches in self.new_sw_cache.iteritems():
+                match_strs = ['%s;%d;%d;%d;%d;%d' % (gene, raw_score, qrbounds[0], qrbounds[1], glbounds[0], glbounds[1]) for gene, raw_score, qrbounds, glbounds in matches]
+                writer.writerow({'seq_hash':seq_hash, 'matches':':'.join(match_strs)})
+        self.new_sw_cache = {}
+
+    # ----------------------------------------------------------------------------------------
+    def read_output(self, base_outfname, n_procs, cached_queries, plot_performance=False):
+        """ process the vdjalign output from each of <n_procs> processes, and then the queries in <cached_queries> using their cached matches """
         perfplotter = None
         if plot_performance:
             assert self.args.plotdir != None
@@ -156,9 +220,9 @@ class Waterer(object):
             perfplotter = PerformancePlotter(self.germline_seqs, self.args.plotdir + '/sw/performance', 'sw')
 
         n_processed = 0
-        for iproc in range(self.args.n_procs):
+        for iproc in range(n_procs):
             workdir = self.args.workdir
-            if self.args.n_procs > 1:
+            if n_procs > 1:
                 workdir += '/sw-' + str(iproc)
             outfname = workdir + '/' + base_outfname
             with contextlib.closing(pysam.Samfile(outfname)) as bam:
@@ -170,9 +234,15 @@ class Waterer(object):
 
             if not self.args.no_clean:
                 os.remove(outfname)
-                if self.args.n_procs > 1:  # still need the top-level workdir
+                if n_procs > 1:  # still need the top-level workdir
                     os.rmdir(workdir)
 
+        for query_name in cached_queries:
+            query_seq = self.input_info[query_name]['seq']
+            self.n_total += 1
+            self.process_matches(query_name, query_seq, self.sw_cache[self.get_seq_hash(query_seq)], perfplotter)
+            n_processed += 1
+
         print '  processed %d queries' % n_processed
 
         if perfplotter != None:
@@ -195,28 +265,32 @@ class Waterer(object):
             query_name = int(primary.qname)  # if it's just one of my hashes, we want it as an int
         except ValueError:
             query_name = primary.qname  # but if it's someone else's random-ass alphasymbolonumeric string we'll just leave it as-is
+        matches = []  # (gene, raw score, query bounds, germline bounds) for each match, in the order vdjalign gave them to us
+        for read in reads:  # loop over the matches found for each query sequence
+            read.seq = query_seq  # only the first one has read.seq set by default, so we need to set the rest by hand
+            matches.append((bam.references[read.tid], read.tags[0][1], (read.qstart, read.qend), (read.pos, read.aend)))
+        if self.args.sw_cache_dir is not None:
+            self.new_sw_cache[self.get_seq_hash(query_seq)] = matches
+        self.process_matches(query_name, query_seq, matches, perfplotter)
+
+    # ----------------------------------------------------------------------------------------
+    def process_matches(self, query_name, query_seq, matches, perfplotter=None):
         raw_best = {}
         all_match_names = {}
         warnings = {}  # ick, this is a messy way to pass stuff around
         for region in utils.regions:
             all_match_names[region] = []
         all_query_bounds, all_germline_bounds = {}, {}
-        for read in reads:  # loop over the matches found for each query sequence
-            read.seq = query_seq  # only the first one has read.seq set by default, so we need to set the rest by hand
-            gene = bam.references[read.tid]
+        for gene, raw_score, qrbounds, glbounds in matches:
             region = utils.get_region(gene)
             warnings[gene] = ''
 
             if region not in raw_best:  # best v, d, and j before multiplying by gene choice probs. needed 'cause *these* are the v and j that get excised
                 raw_best[region] = gene
 
-            raw_score = read.tags[0][1]  # raw because they don't include the gene choice probs
-            score = raw_score
+            score = raw_score  # raw because it doesn't include the gene choice probs
             if self.args.apply_choice_probs_in_sw:  # NOTE I stopped applying the gene choice probs here because the smith-waterman scores don't correspond to log-probs, so throwing on the gene choice probs was dubious (and didn't seem to work that well)
                 score = self.get_choice_prob(region, gene) * raw_score  # multiply by the probability to choose this gene
-            # set bounds
-            qrbounds = (read.qstart, read.qend)
-            glbounds = (read.pos, read.aend)
 
             assert qrbounds[1]-qrbounds[0] == glbounds[1]-glbounds[0]
 
@@ -308,6 +382,24 @@ class Waterer(object):
                 best[r_reg + '_gl_seq'] = self.germline_seqs[r_reg][r_gene][glbounds[r_gene][0] : glbounds[r_gene][1]]
                 best[r_reg + '_qr_seq'] = query_seq[qrbounds[r_gene][0]:qrbounds[r_gene][1]]
 
+    # ----------------------------------------------------------------------------------------
+    def get_plausible_cdr3_lengths(self, match_names, all_germline_bounds, all_query_bounds, best_cdr3_length):
+        """
+        Return a sorted list of the cdr3 lengths implied by each combination of the v and j matches that we're passing on to the hmm (only the
+        in-frame ones, plus the best match's length whatever it is), since when the matches are close we can't really tell which is right.
+        """
+        cdr3_lengths = set([best_cdr3_length, ])
+        for v_gene in match_names['v']:
+            if self.cyst_positions[v_gene]['cysteine-position'] is None:
+                continue
+            v_position = utils.get_conserved_codon_position(self.cyst_positions, self.tryp_positions, 'v', v_gene, all_germline_bounds, all_query_bounds)
+            for j_gene in match_names['j']:
+                j_position = utils.get_conserved_codon_position(self.cyst_positions, self.tryp_positions, 'j', j_gene, all_germline_bounds, all_query_bounds)
+                cdr3_length = j_position - v_position + 3
+                if cdr3_length > 0 and cdr3_length % 3 == 0:
+                    cdr3_lengths.add(cdr3_length)
+        return sorted(cdr3_lengths)
+
     # ----------------------------------------------------------------------------------------
     def add_to_info(self, query_name, query_seq, kvals, match_names, best, all_germline_bounds, all_query_bounds, codon_positions, perfplotter=None):
         assert query_name not in self.info
@@ -320,6 +412,7 @@ class Waterer(object):
         assert codon_positions['v'] != -1
         assert codon_positions['j'] != -1
         self.info[query_name]['cdr3_length'] = codon_positions['j'] - codon_positions['v'] + 3  #tryp_position_in_joined_seq - self.cyst_position + 3
+        self.info[query_name]['cdr3_lengths'] = self.get_plausible_cdr3_lengths(match_names, all_germline_bounds, all_query_bounds, self.info[query_name]['cdr3_length'])
         self.info[query_name]['cyst_position'] = codon_positions['v']
         self.info[query_name]['tryp_position'] = codon_positions['j']
 
@@ -343,16 +436,17 @@ class Waterer(object):
             self.info['all_best_matches'].add(best[region])
 
         self.info[query_name]['seq'] = query_seq  # only need to add this so I can pass it to print_reco_event
+        has_truth = not self.args.is_data and query_name in self.reco_info  # e.g. representatives of clusters from --existing-partition aren't in reco_info unless they're also in the seqfile
         if self.args.debug:
-            if not self.args.is_data:
+            if has_truth:
                 utils.print_reco_event(self.germline_seqs, self.reco_info[query_name], extra_str='      ', label='true:')
             utils.print_reco_event(self.germline_seqs, self.info[query_name], extra_str='      ', label='inferred:')
 
         if self.pcounter != None:
             self.pcounter.increment(self.info[query_name])
-        if self.true_pcounter != None:
+        if self.true_pcounter != None and has_truth:
             self.true_pcounter.increment(self.reco_info[query_name])
-        if perfplotter != None:
+        if perfplotter != None and has_truth:
             perfplotter.evaluate(self.reco_info[query_name], self.info[query_name])  #, subtract_unphysical_erosions=True)
 
     # ----------------------------------------------------------------------------------------
@@ -425,7 +519,7 @@ class Waterer(object):
         for region in utils.regions:
             if region not in best:
                 print '    no',region,'match found for',query_name  # NOTE if no d match found, we should really should just assume entire d was eroded
-                if not self.args.is_data:
+                if not self.args.is_data and query_name in self.reco_info:
                     print '    true:'
                     utils.print_reco_event(self.germline_seqs, self.reco_info[query_name], extra_str='    ')
                 return